@@ -1,6 +1,5 @@
 # Written by https://github.com/s0d3s (https://github.com/s0d3s/PyAudioWPatch/issues/9)
 import speech_recognition as sr
-import audioop
 
 try:
     import pyaudiowpatch
@@ -12,6 +11,9 @@ pyaudio = pyaudiowpatch
 class AudioBridge(sr.AudioSource):
     """
     Capture audio from speakers(via loopback, on Windows)
+
+    Loopback devices only run at the hardware's rate, with all of its channels: the audio is downmixed to mono and
+    resampled to `sample_rate` (the hardware's rate if not specified) by a `sr.PolyphaseResampler`.
     """
     format = pyaudio.paInt16  # 16-bit int sampling
 
@@ -42,9 +44,10 @@ class AudioBridge(sr.AudioSource):
                 assert device_info is not None, "Unable to find loopback for default speakers"
                 device_index = device_info["index"]
 
+            assert isinstance(device_info.get("defaultSampleRate"), (float, int)) and device_info["defaultSampleRate"] > 0, "Invalid device info returned from PyAudio: {}".format(device_info)
+            device_sample_rate = int(device_info["defaultSampleRate"])
             if sample_rate is None:  # automatically set the sample rate to the hardware's default sample rate if not specified
-                assert isinstance(device_info.get("defaultSampleRate"), (float, int)) and device_info["defaultSampleRate"] > 0, "Invalid device info returned from PyAudio: {}".format(device_info)
-                sample_rate = int(device_info["defaultSampleRate"])
+                sample_rate = device_sample_rate
 
             channels = device_info["maxInputChannels"]
         finally:
@@ -54,6 +57,7 @@ class AudioBridge(sr.AudioSource):
         self.channels = channels
         self.SAMPLE_WIDTH = self.pyaudio_module.get_sample_size(self.format)  # size of each sample
         self.SAMPLE_RATE = sample_rate  # sampling rate in Hertz
+        self.device_sample_rate = device_sample_rate  # the rate the device is opened at
         self.CHUNK = chunk_size  # number of frames stored in each buffer
 
         self.audio = None
@@ -66,8 +70,9 @@ class AudioBridge(sr.AudioSource):
             self.stream = self.LoopbackStream(
                 self.audio.open(
                     input_device_index=self.device_index, channels=self.channels, format=self.format,
-                    rate=self.SAMPLE_RATE, frames_per_buffer=self.CHUNK, input=True,
-                )
+                    rate=self.device_sample_rate, frames_per_buffer=self.CHUNK, input=True,
+                ),
+                sr.PolyphaseResampler(self.device_sample_rate, self.SAMPLE_RATE, channels=self.channels),
             )
         except Exception:
             self.audio.terminate()
@@ -86,14 +91,15 @@ class AudioBridge(sr.AudioSource):
         return pyaudiowpatch
 
     class LoopbackStream(object):
-        def __init__(self, pyaudio_stream):
+        def __init__(self, pyaudio_stream, resampler):
             self.pyaudio_stream = pyaudio_stream
+            self.resampler = resampler
 
         def read(self, size):
-            return audioop.tomono(
-                self.pyaudio_stream.read(size, exception_on_overflow=False),
+            # `size` mono samples at `SAMPLE_RATE`, read at the device's rate
+            return self.resampler.process_pcm(
+                self.pyaudio_stream.read(self.resampler.input_frames(size), exception_on_overflow=False),
                 AudioBridge.get_pyaudio().get_sample_size(AudioBridge.format),
-                1, 1
             )
 
         def close(self):
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+
+from inference_executor import InferenceExecutor
+from whisper.decoding import DecodingOptions, DecodingResult, decode_batch
+
+
+@dataclass
+class _Segment:
+    mel: np.ndarray
+    options: DecodingOptions
+    future: asyncio.Future
+
+
+class BatchScheduler:
+    """
+    Micro-batches the decodes of all live sessions.
+
+    A segment submitted with `decode()` waits up to `max_latency` seconds for segments of other sessions, then the
+    pending segments (at most `max_batch_size`) are decoded together on an inference worker: one encoder pass for
+    all of them, and one decoder loop per group of compatible options (see `whisper.decoding.decode_batch`), where
+    the rows of a segment leave the loop as soon as it reaches EOT. Each session awaits its own result.
+    While a batch runs, the next one is collected and can run on another worker.
+
+    Must be used from a single event loop.
+    """
+
+    def __init__(self, executor: InferenceExecutor, max_latency: float = 0.02, max_batch_size: int = 8):
+        assert max_latency >= 0, "The latency budget can't be negative"
+        assert isinstance(max_batch_size, int) and max_batch_size > 0, "The batch size must be a positive integer"
+        self.executor = executor
+        self.max_latency = max_latency
+        self.max_batch_size = max_batch_size
+
+        self._pending: List[_Segment] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._running = set()   # the batch tasks, referenced until they are done
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._segments = 0
+        self._max_batch = 0
+
+    @property
+    def is_multilingual(self) -> bool:
+        return self.executor.registry.is_multilingual
+
+    async def decode(self, mel: np.ndarray, options: DecodingOptions) -> DecodingResult:
+        """
+        Awaits the decoding of one segment, `mel` of shape (80, N_FRAMES), batched with the other sessions' segments.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # the caller may reuse its mel buffer once the result is back, so the pending segment keeps a copy
+        self._pending.append(_Segment(np.array(mel, dtype=np.float32), options, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_latency, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        segments = [segment for segment in self._pending if not segment.future.cancelled()]
+        self._pending = []
+        while segments:
+            batch, segments = segments[: self.max_batch_size], segments[self.max_batch_size :]
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, segments: List[_Segment]):
+        mel = np.stack([segment.mel for segment in segments])
+        options = [segment.options for segment in segments]
+        try:
+            results = await self.executor.run(decode_batch, mel, options)
+        except Exception as e:
+            for segment in segments:
+                if not segment.future.done():
+                    segment.future.set_exception(e)
+            return
+
+        with self._lock:
+            self._batches += 1
+            self._segments += len(segments)
+            self._max_batch = max(self._max_batch, len(segments))
+        for segment, result in zip(segments, results):
+            if not segment.future.done():
+                segment.future.set_result(result)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                "max_latency": self.max_latency,
+                "max_batch_size": self.max_batch_size,
+                "pending": len(self._pending),
+                "batches": self._batches,
+                "segments": self._segments,
+                "mean_batch_size": self._segments / self._batches if self._batches else 0.0,
+                "max_batch": self._max_batch,
+            }
@@ -0,0 +1,363 @@
+"""Micro-benchmarks for the transcription hot paths."""
+import os
+import time
+import argparse
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from whisper.audio import N_FFT, N_FRAMES, HOP_LENGTH, SAMPLE_RATE, mel_filters, pad_or_trim, log_mel_spectrogram, sliding_window_view
+from whisper.decoding import BeamSearchDecoder, Inference, TokenDecoder, log_softmax
+from whisper.model import load_model
+from whisper.tokenizer import get_tokenizer
+
+
+def model_paths(target: str):
+    encoder_target, decoder_target = target.split("-")
+    if encoder_target == "cpu":
+        onnx_encoder_path = os.path.join("models", "float-encoder.onnx")
+    else:
+        onnx_encoder_path = os.path.join("models", "quant-encoder.onnx")
+    if decoder_target == "cpu":
+        onnx_decoder_path = os.path.join("models", "float-decoder.onnx")
+    else:
+        onnx_decoder_path = os.path.join("models", "quant-decoder.onnx")
+    return onnx_encoder_path, onnx_decoder_path, encoder_target, decoder_target
+
+
+def load_benchmark_audio(path: str = None) -> np.ndarray:
+    if path:
+        return path
+    # five seconds of quiet noise when no audio is given
+    return (np.random.default_rng(0).standard_normal(5 * SAMPLE_RATE) * 0.01).astype(np.float32)
+
+
+def print_timings(name: str, timings: List[float]):
+    timings = np.array(timings) * 1000
+    print(f"{name:<40} mean {timings.mean():8.3f}ms  p50 {np.percentile(timings, 50):8.3f}ms  p90 {np.percentile(timings, 90):8.3f}ms")
+
+
+def benchmark_kv_cache(model, audio, steps: int, beam_sizes: List[int]):
+    """
+    Decoder step time (session run plus kv cache bookkeeping) with the shifting and the circular kv cache,
+    with and without the IOBinding decoder runner.
+    """
+    from whisper.decoding import OnnxInference
+
+    tokenizer = get_tokenizer(model.is_multilingual, language="en", task="transcribe")
+    initial_tokens = tokenizer.sot_sequence_including_notimestamps
+    mel = pad_or_trim(log_mel_spectrogram(audio), N_FRAMES)[np.newaxis]
+    audio_features = model.encoder(mel)
+
+    for beam_size in beam_sizes:
+        features = np.repeat(audio_features, beam_size, axis=0)
+        for ring_kv_cache, io_binding in ((False, False), (True, False), (True, True)):
+            inference = OnnxInference(model, len(initial_tokens), ring_kv_cache=ring_kv_cache, io_binding=io_binding)
+            tokens = np.array([initial_tokens] * beam_size)
+            timings = []
+            for _ in range(steps):
+                start = time.perf_counter()
+                logits, _ = inference.logits(tokens, features)
+                timings.append(time.perf_counter() - start)
+                # keep decoding past EOT, only the step time is measured
+                next_tokens = logits[:, -1, :tokenizer.eot].argmax(axis=-1)
+                tokens = np.concatenate([tokens, next_tokens[:, None]], axis=-1)
+            inference.cleanup_caching()
+            name = f"beam_size={beam_size} {'ring' if ring_kv_cache else 'shift'} kv cache{' iobinding' if io_binding else ''}"
+            print_timings(name, timings[1:])
+
+
+class ReferenceBeamSearchDecoder(TokenDecoder):
+    """The dictionary based beam search which BeamSearchDecoder replaced, kept to check its results"""
+    def __init__(self, beam_size: int, eot: int, inference: Inference, patience: Optional[float] = None):
+        self.beam_size = beam_size
+        self.eot = eot
+        self.inference = inference
+        self.patience = patience or 1.0
+        self.max_candidates: int = round(beam_size * self.patience)
+        self.finished_sequences = None
+
+        assert self.max_candidates > 0, f"Invalid beam size ({beam_size}) or patience ({patience})"
+
+    def reset(self):
+        self.finished_sequences = None
+
+    def update(self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray) -> Tuple[np.ndarray, bool]:
+        if tokens.shape[0] % self.beam_size != 0:
+            raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
+
+        n_audio = tokens.shape[0] // self.beam_size
+        if self.finished_sequences is None:  # for the first update
+            self.finished_sequences = [{} for _ in range(n_audio)]
+
+        logprobs = log_softmax(logits, dim=-1)
+        next_tokens, source_indices, finished_sequences = [], [], []
+        for i in range(n_audio):
+            scores, sources, finished = {}, {}, {}
+
+            # STEP 1: calculate the cumulative log probabilities for possible candidates
+            for j in range(self.beam_size):
+                idx = i * self.beam_size + j
+                prefix = list(tokens[idx])
+                topk_values, topk_indices = \
+                    -np.partition(-logprobs[idx], self.beam_size + 1)[:self.beam_size + 1], np.argpartition(-logprobs[idx], self.beam_size + 1)[:self.beam_size + 1]
+
+                sort_indices = np.argsort(-topk_values)
+                topk_values = topk_values[sort_indices]
+                topk_indices = topk_indices[sort_indices]
+                for logprob, token in zip(topk_values, topk_indices):
+                    new_logprob = (sum_logprobs[idx] + logprob)
+                    sequence = tuple(prefix + [token])
+                    scores[sequence] = new_logprob
+                    sources[sequence] = idx
+
+            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
+            saved = 0
+            for sequence in sorted(scores, key=scores.get, reverse=True):
+                if sequence[-1] == self.eot:
+                    finished[sequence] = scores[sequence]
+                else:
+                    sum_logprobs[len(next_tokens)] = scores[sequence]
+                    next_tokens.append(sequence)
+                    source_indices.append(sources[sequence])
+
+                    saved += 1
+                    if saved == self.beam_size:
+                        break
+
+            finished_sequences.append(finished)
+
+        tokens = np.array(next_tokens)
+        self.inference.rearrange_kv_cache(source_indices)
+
+        # add newly finished sequences to self.finished_sequences
+        assert len(self.finished_sequences) == len(finished_sequences)
+        for previously_finished, newly_finished in zip(self.finished_sequences, finished_sequences):
+            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
+                if len(previously_finished) >= self.max_candidates:
+                    break  # the candidate list is full
+                previously_finished[seq] = newly_finished[seq]
+
+        # mark as completed if all audio has enough number of samples
+        completed = all(
+            len(sequences) >= self.max_candidates for sequences in self.finished_sequences
+        )
+        return tokens, completed
+
+    def finalize(self, preceding_tokens: np.ndarray, sum_logprobs: np.ndarray):
+        # collect all finished sequences, including patience, and add unfinished ones if not enough
+        sum_logprobs = sum_logprobs
+        for i, sequences in enumerate(self.finished_sequences):
+            if len(sequences) < self.beam_size:  # when not enough sequences are finished
+                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
+                    sequence = list(preceding_tokens[i, j]) + [self.eot]
+                    sequences[tuple(sequence)] = sum_logprobs[i][j]
+                    if len(sequences) >= self.beam_size:
+                        break
+
+        tokens: List[List[np.ndarray]] = [
+            [np.array(seq) for seq in sequences.keys()] for sequences in self.finished_sequences
+        ]
+        sum_logprobs: List[List[float]] = [
+            list(sequences.values()) for sequences in self.finished_sequences
+        ]
+        return tokens, sum_logprobs
+
+
+class RecordingInference(Inference):
+    """Stands in for the decoder, records the beam rearrangements"""
+    def __init__(self):
+        self.source_indices = []
+
+    def rearrange_kv_cache(self, source_indices):
+        self.source_indices.append(list(source_indices))
+
+
+def run_beam_search(decoder: TokenDecoder, logits: List[np.ndarray], initial_tokens: List[int], beam_size: int):
+    n_batch = logits[0].shape[0]
+    tokens = np.array([initial_tokens] * n_batch)
+    sum_logprobs = np.zeros(n_batch)
+    timings = []
+    decoder.reset()
+    for step_logits in logits:
+        start = time.perf_counter()
+        tokens, completed = decoder.update(tokens, step_logits.copy(), sum_logprobs)
+        timings.append(time.perf_counter() - start)
+        if completed:
+            break
+    finished = decoder.finalize(tokens.reshape(n_batch // beam_size, beam_size, -1), sum_logprobs.reshape(-1, beam_size))
+    return tokens, finished, timings
+
+
+def benchmark_beam_search(steps: int, n_audios: List[int], beam_size: int = 5, n_vocab: int = 51865, eot: int = 50257):
+    """
+    Per step time of BeamSearchDecoder.update against the dictionary based implementation,
+    on random logits (the decoder itself is not run). The selected tokens must be identical.
+    """
+    rng = np.random.default_rng(0)
+    initial_tokens = [50258, 50259, 50359, 50363]
+    for n_audio in n_audios:
+        logits = []
+        for step in range(steps):
+            step_logits = rng.standard_normal((n_audio * beam_size, n_vocab)).astype(np.float32) * 4
+            # make EOT likely enough that some hypotheses finish along the way
+            step_logits[:, eot] += rng.uniform(0, 12, n_audio * beam_size).astype(np.float32)
+            if step == 0:
+                # the beams start from the same sequence, so they share the first logits
+                step_logits = np.repeat(step_logits[::beam_size], beam_size, axis=0)
+            logits.append(step_logits)
+
+        results = {}
+        for name, decoder_class in (("dictionary", ReferenceBeamSearchDecoder), ("array", BeamSearchDecoder)):
+            inference = RecordingInference()
+            decoder = decoder_class(beam_size, eot, inference)
+            tokens, finished, timings = run_beam_search(decoder, logits, initial_tokens, beam_size)
+            results[name] = (tokens, finished, inference.source_indices)
+            print_timings(f"n_audio={n_audio} beam_size={beam_size} {name} beam search", timings[1:])
+
+        reference, array = results["dictionary"], results["array"]
+        assert np.array_equal(reference[0], array[0]), "selected tokens differ"
+        assert reference[2] == array[2], "beam sources differ"
+        for expected, actual in zip(reference[1][0], array[1][0]):
+            assert len(expected) == len(actual) and all(np.array_equal(e, a) for e, a in zip(expected, actual)), "finished sequences differ"
+        assert reference[1][1] == array[1][1], "finished log probabilities differ"
+        print(f"n_audio={n_audio} beam_size={beam_size} results identical over {len(array[2])} steps")
+
+
+def reference_log_mel_spectrogram(audio: np.ndarray) -> np.ndarray:
+    """The float64 STFT and dense filterbank which log_mel_spectrogram replaced, kept to check its results"""
+    window = np.hanning(N_FFT)
+    num_frames = 1 + (audio.size - N_FFT) // HOP_LENGTH
+    if (audio.size - N_FFT) % HOP_LENGTH > 0:
+        num_frames += 1
+    audio_padded = np.pad(audio, pad_width=(N_FFT // 2, N_FFT // 2), mode='constant')
+    frames = sliding_window_view(audio_padded, N_FFT, HOP_LENGTH)[:num_frames]
+    stft = np.fft.rfft(frames * window, axis=-1)
+    magnitudes = (np.abs(stft[:, :N_FFT // 2 + 1]) ** 2).T.astype(audio.dtype)
+
+    mel_spec = mel_filters() @ magnitudes
+    log_spec = np.log10(np.clip(mel_spec, a_min=1e-10, a_max=None))
+    log_spec = np.maximum(log_spec, np.max(log_spec) - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+
+def benchmark_mel(durations: List[float], batch_size: int = 8, repeats: int = 5):
+    """
+    log_mel_spectrogram against the float64 reference implementation, on noise of each duration in seconds,
+    and on a batch of `batch_size` one second waveforms.
+    """
+    rng = np.random.default_rng(0)
+
+    def timed(fn, *args):
+        fn(*args)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = fn(*args)
+            timings.append(time.perf_counter() - start)
+        return result, timings
+
+    for duration in durations:
+        audio = (rng.standard_normal(int(duration * SAMPLE_RATE)) * 0.1).astype(np.float32)
+        expected, reference_timings = timed(reference_log_mel_spectrogram, audio)
+        actual, timings = timed(log_mel_spectrogram, audio)
+        print_timings(f"{duration:g}s reference log-mel", reference_timings)
+        print_timings(f"{duration:g}s log-mel", timings)
+        assert actual.shape == expected.shape, f"{actual.shape} != {expected.shape}"
+        print(f"{duration:g}s max difference {np.abs(actual - expected).max():.2e}, "
+              f"speedup {np.median(reference_timings) / np.median(timings):.2f}x")
+
+    batch = (rng.standard_normal((batch_size, SAMPLE_RATE)) * 0.1).astype(np.float32)
+    expected, reference_timings = timed(lambda: [reference_log_mel_spectrogram(audio) for audio in batch])
+    actual, timings = timed(log_mel_spectrogram, batch)
+    print_timings(f"{batch_size}x1s reference log-mel", reference_timings)
+    print_timings(f"{batch_size}x1s batched log-mel", timings)
+    print(f"{batch_size}x1s max difference {np.abs(actual - np.stack(expected)).max():.2e}")
+
+
+def sine_sweep(rate: int, duration: float, f0: float, f1: float) -> Tuple[np.ndarray, np.ndarray]:
+    """An exponential sine sweep from f0 to f1 Hz sampled at `rate`, and its instantaneous frequency"""
+    t = np.arange(int(duration * rate)) / rate
+    k = np.log(f1 / f0) / duration
+    return np.sin(2 * np.pi * f0 * (np.exp(k * t) - 1) / k), f0 * np.exp(k * t)
+
+
+def benchmark_resample(rates: List[int], to_rate: int = SAMPLE_RATE, channels: int = 2, chunk_size: int = 1024, duration: float = 10.0):
+    """
+    The streaming PolyphaseResampler against audioop.tomono and audioop.ratecv, on `chunk_size` frame blocks of
+    `channels` channel int16 PCM, as a capture device gives them. The accuracy is checked on a sine sweep over the
+    whole band: below 0.8 times the output Nyquist frequency the output must match the sweep sampled at `to_rate`,
+    and above 1.1 times it must be filtered out instead of aliased.
+    """
+    import speech_recognition as sr
+    try:
+        import audioop
+    except ImportError:     # removed in Python 3.13
+        audioop = None
+
+    rng = np.random.default_rng(0)
+    nyquist = to_rate / 2
+    for rate in rates:
+        pcm = (rng.standard_normal((int(duration * rate), channels)) * 3000).astype(np.int16)
+        chunks = [pcm[i:i + chunk_size].tobytes() for i in range(0, len(pcm), chunk_size)]
+
+        resampler = sr.PolyphaseResampler(rate, to_rate, channels=channels)
+        start = time.perf_counter()
+        for chunk in chunks:
+            resampler.process_pcm(chunk)
+        elapsed = time.perf_counter() - start
+        print(f"{rate} Hz x{channels} -> {to_rate} Hz: polyphase {elapsed * 1000:8.2f}ms for {duration:g}s of audio, "
+              f"{elapsed / duration * 100:.3f}% of a core, {resampler.taps_per_phase} taps per phase")
+        if audioop is not None:
+            state = None
+            start = time.perf_counter()
+            for chunk in chunks:
+                mono = audioop.tomono(chunk, 2, 0.5, 0.5) if channels == 2 else chunk
+                _, state = audioop.ratecv(mono, 2, 1, rate, to_rate, state)
+            elapsed = time.perf_counter() - start
+            print(f"{rate} Hz x{channels} -> {to_rate} Hz: audioop   {elapsed * 1000:8.2f}ms for {duration:g}s of audio")
+
+        sweep, frequency = sine_sweep(rate, duration, 20.0, rate / 2)
+        expected, expected_frequency = sine_sweep(to_rate, duration, 20.0, rate / 2)
+        outputs = {"polyphase": sr.resample(sweep.astype(np.float32), rate, to_rate)}
+        if audioop is not None:
+            pcm = (sweep * 16384).astype(np.int16).tobytes()
+            outputs["audioop"] = np.frombuffer(audioop.ratecv(pcm, 2, 1, rate, to_rate, None)[0], dtype=np.int16) / 16384
+        passband = expected_frequency < 0.8 * nyquist
+        stopband = expected_frequency > 1.1 * nyquist
+        for name, output in outputs.items():
+            n = min(len(output), len(expected))
+            error = output[:n] - expected[:n]
+            passband_error = 10 * np.log10(np.mean(error[passband[:n]][100:] ** 2) / 0.5)
+            stopband_level = 10 * np.log10(np.mean(output[:n][stopband[:n]] ** 2) / 0.5)
+            print(f"{rate} Hz sweep {name:<10} passband error {passband_error:7.1f}dB, aliasing above {1.1 * nyquist:g} Hz {stopband_level:7.1f}dB")
+            if name == "polyphase":
+                assert passband_error < -60 and stopband_level < -60, "the resampler is not accurate enough"
+
+
+def cli():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("benchmark", choices=["kv_cache", "beam_search", "mel", "resample"], help="which benchmark to run")
+    parser.add_argument("--audio", type=str, default=None, help="audio file to decode, defaults to five seconds of noise")
+    parser.add_argument("--target", type=str, default="cpu-cpu", choices=["aie-cpu", "cpu-aie", "aie-aie", "cpu-cpu"], help="which target to run encoder and decoder models")
+    parser.add_argument("--steps", type=int, default=100, help="decoder steps to time")
+    parser.add_argument("--beam_sizes", type=int, nargs="+", default=[1, 5], help="beam sizes to time")
+    parser.add_argument("--durations", type=float, nargs="+", default=[1, 10, 600], help="audio durations in seconds for the mel benchmark")
+    parser.add_argument("--rates", type=int, nargs="+", default=[48000, 44100, 22050], help="capture sample rates for the resample benchmark")
+    parser.add_argument("--n_audios", type=int, nargs="+", default=[1, 8], help="numbers of audio decoded together by the beam search benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark == "kv_cache":
+        audio = load_benchmark_audio(args.audio)
+        model = load_model("tiny", *model_paths(args.target))
+        benchmark_kv_cache(model, audio, args.steps, args.beam_sizes)
+    elif args.benchmark == "beam_search":
+        benchmark_beam_search(args.steps, args.n_audios)
+    elif args.benchmark == "mel":
+        benchmark_mel(args.durations)
+    elif args.benchmark == "resample":
+        benchmark_resample(args.rates)
+
+
+if __name__ == "__main__":
+    cli()
@@ -11,6 +11,16 @@ class settingsModel(BaseSettings):
     record_timeout: int = 2
     phrase_timeout: int = 3
 
+    model_name: str = 'tiny'
+    model_pool_size: int = 2         # Number of decodes which may run at the same time (one inference worker each)
+    batch_latency_ms: int = 20       # How long a live session's segment waits for other sessions' to be decoded together
+    max_batch_size: int = 8          # Most segments decoded in one batch
+    subscriber_queue_size: int = 32  # Transcription events queued for a slow websocket before its oldest lines are dropped
+    ping_interval: int = 15          # Seconds between the keepalive pings of the transcription feed (protocol version 2)
+    ping_timeout: int = 10           # Seconds a client has to answer a ping before its connection is closed
+    replay_audio: str = ""           # A WAV/FLAC file or a LibriSpeech manifest replayed instead of capturing the sound devices, for load tests (see `ReplayAudioSource`)
+    replay_speed: float = 1.0        # 1 replays in real time, 2 twice as fast, 0 as fast as possible
+    replay_jitter_ms: int = 0        # Random delay of each read of the replay, like a device delivering its buffers irregularly
     encoder_target: str = 'aie'
     decoder_target: str = 'cpu'
     onnx_encoder_path: str = "models\\quant-encoder.onnx"
@@ -0,0 +1,96 @@
+import json
+from typing import Optional, Union
+
+from transcription_hub import TRANSCRIPTION_READY, Event, SegmentRevision
+from whisper.streaming import common_prefix_length
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None      # the msgpack encoding is only offered when it is installed
+
+PHRASE_COMPLETE = "[PHRASE_COMPLETE]"
+PROTOCOL_VERSIONS = (1, 2, 3)
+
+# Encodings of the structured messages, by websocket subprotocol, in order of preference
+ENCODINGS = ("msgpack", "json") if msgpack is not None else ("json",)
+
+
+def negotiate_encoding(requested) -> Optional[str]:
+    """The preferred encoding among the subprotocols requested by the client, None if it requested none we support"""
+    return next((encoding for encoding in ENCODINGS if encoding in requested), None)
+
+
+class FeedEncoder:
+    """
+    The messages of one connection of the transcription feed, for its protocol `version`:
+
+    1. Each event as plain text: the ready message, the whole current line, or `[PHRASE_COMPLETE]`.
+    2. JSON messages numbered by `seq`, a gap in the numbers means the client fell behind and missed lines:
+        {"seq": 0, "type": "ready"}, {"seq": 1, "type": "line", "text": "..."}, {"seq": 2, "type": "phrase_complete"}
+    3. Subtitle segments, sent as edits of the previous revision the client received:
+        {"seq": 1, "type": "segment", "id": 0, "rev": 3, "start": 0.0, "end": 2.56, "stable": 11,
+         "edit": [6, "world, how"], "final": false}
+       keep the first `edit[0]` characters of the segment's text and append `edit[1]`. The first `stable`
+       characters of the text are committed, the following revisions only append to them.
+       Segments are numbered from 0 and complete in order, a segment with a new `id` starts a new line.
+
+    From version 2, the server sends `{"type": "ping", "id": n}` which the client answers with
+    `{"type": "pong", "id": n}`, and the messages are encoded with JSON in text frames, or with msgpack in binary
+    frames when it was negotiated as the websocket subprotocol.
+    """
+
+    def __init__(self, version: int = 1, encoding: Optional[str] = None):
+        assert version in PROTOCOL_VERSIONS, "Unknown protocol version"
+        assert encoding in (None, *ENCODINGS), "Unsupported encoding"
+        self.version = version
+        self.encoding = encoding or "json"
+        self._segment_id = -1       # the last segment sent, and its text
+        self._segment_text = ""
+
+    def encode(self, seq: int, event: Event) -> Union[str, bytes]:
+        if self.version == 1:
+            if isinstance(event, str):
+                return event
+            return PHRASE_COMPLETE if event.final else event.text
+
+        if event == TRANSCRIPTION_READY:
+            return self._dump({"seq": seq, "type": "ready"})
+        if self.version == 2:
+            if event.final:
+                return self._dump({"seq": seq, "type": "phrase_complete"})
+            return self._dump({"seq": seq, "type": "line", "text": event.text})
+        return self._dump({"seq": seq, "type": "segment", **self._segment(event)})
+
+    def ping(self, ping_id: int) -> Union[str, bytes]:
+        return self._dump({"type": "ping", "id": ping_id})
+
+    def decode(self, message: Union[str, bytes]) -> Optional[dict]:
+        """A message of the client, None if it is not one of the protocol's"""
+        try:
+            if isinstance(message, bytes):
+                message = msgpack.unpackb(message) if msgpack is not None else None
+            else:
+                message = json.loads(message)
+        except ValueError:
+            return None
+        return message if isinstance(message, dict) else None
+
+    def _segment(self, revision: SegmentRevision) -> dict:
+        previous = self._segment_text if revision.id == self._segment_id else ""
+        keep = common_prefix_length(previous, revision.text)
+        self._segment_id, self._segment_text = revision.id, revision.text
+        return {
+            "id": revision.id,
+            "rev": revision.revision,
+            "start": round(revision.start, 3),
+            "end": round(revision.end, 3),
+            "stable": revision.stable,
+            "edit": [keep, revision.text[keep:]],
+            "final": revision.final,
+        }
+
+    def _dump(self, message: dict) -> Union[str, bytes]:
+        if self.encoding == "msgpack":
+            return msgpack.packb(message)
+        return json.dumps(message, separators=(",", ":"))
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+
+from model_registry import ModelRegistry
+from whisper.transcribe import transcribe
+
+
+class InferenceExecutor:
+    """
+    Runs model inference on a dedicated thread pool so the asyncio event loop stays responsive.
+
+    There is one worker per pooled model, and the registry splits the physical cores between the models'
+    intra-op thread pools, so running every worker at once does not oversubscribe the CPU.
+    ONNX Runtime releases the GIL while a session runs, so the workers decode in parallel.
+    """
+
+    def __init__(self, registry: ModelRegistry, max_workers: Optional[int] = None):
+        self.registry = registry
+        self.max_workers = max_workers or registry.capacity
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+
+        self._lock = threading.Lock()
+        self._queued = 0            # jobs submitted but not yet started
+        self._running = 0           # jobs currently holding a model
+        self._started = 0
+        self._completed = 0
+        self._failed = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._last_wait_time = 0.0
+        self._total_run_time = 0.0
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """
+        Awaits `fn(model, *args, **kwargs)` run on a worker thread with a model leased from the registry.
+        """
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+
+        def job():
+            started = time.perf_counter()
+            wait_time = started - submitted
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._started += 1
+                self._total_wait_time += wait_time
+                self._last_wait_time = wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+            try:
+                with self.registry.lease() as model:
+                    result = fn(model, *args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self._failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._total_run_time += time.perf_counter() - started
+            with self._lock:
+                self._completed += 1
+            return result
+
+        return await loop.run_in_executor(self._executor, job)
+
+    async def submit(self, audio: np.ndarray, **transcribe_options) -> dict:
+        """
+        Awaits the transcription of `audio`, see `whisper.transcribe.transcribe` for the options.
+        """
+        return await self.run(_transcribe, audio, **transcribe_options)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "workers": self.max_workers,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "last_wait_time": self._last_wait_time,
+                "max_wait_time": self._max_wait_time,
+                "mean_wait_time": self._total_wait_time / self._started if self._started else 0.0,
+                "mean_run_time": self._total_run_time / finished if finished else 0.0,
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+def _transcribe(model, audio: np.ndarray, **transcribe_options) -> dict:
+    return transcribe(model=model, audio=audio, **transcribe_options)
@@ -43,6 +43,10 @@ def create_app():
     app.include_router(sound.utils_api)
     app.include_router(transcription_server.transcribe_api)
 
+    # Build the ONNX Runtime sessions once, instead of once per connected client
+    app.add_event_handler("startup", transcription_server.load_models)
+    app.add_event_handler("shutdown", transcription_server.inference_executor.shutdown)
+
     # Always include the home router last as it contains a catch all route which will prevent other routes from being accessed
     app.include_router(home.home_router)
     return app
\ No newline at end of file
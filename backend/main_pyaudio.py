@@ -4,15 +4,14 @@ import argparse
 import os
 import numpy as np
 import speech_recognition as sr
-from whisper.transcribe import transcribe
 from whisper.model import load_model
+from whisper.streaming import StreamingTranscriber
 import pyaudiowpatch as pyaudio
 
 from AudioBridge import AudioBridge
+from pcm_buffer import PcmRingBuffer
 
 from datetime import datetime, timedelta
-from queue import Queue
-from time import sleep
 from sys import platform
 
 import uuid
@@ -58,8 +57,6 @@ def main():
 
     # The last time a recording was retrieved from the queue.
     phrase_time = None
-    # Thread safe Queue for passing data from the threaded recording callback.
-    data_queue = Queue()
     # We use SpeechRecognizer to record our audio because it has a nice feature where it can detect when speech ends.
     recorder = sr.Recognizer()
     recorder.energy_threshold = args.energy_threshold
@@ -81,7 +78,7 @@ def main():
     mic = int(input("Select Mic: "))
     if "Loopback" in audio.get_device_info_by_index(mic)["name"]:
         # Note: Loopback interfaces do not support sample_rates (https://github.com/s0d3s/PyAudioWPatch/issues/15#issuecomment-2025114713)
-        source = AudioBridge(device_index=mic)
+        source = AudioBridge(device_index=mic, sample_rate=16000)    # resampled from the device's rate
     else:
         source = sr.Microphone(sample_rate=16000)
 
@@ -97,18 +94,32 @@ def main():
     phrase_timeout = args.phrase_timeout
 
     transcription = ['']
+    # Arguments are hard-coded as the model does not fully support alternative options.
+    transcriber = StreamingTranscriber(task = "transcribe",
+                                       language = 'en',
+                                       beam_size = 5,
+                                       patience = None,
+                                       length_penalty = 0.08,
+                                       suppress_tokens = "-1",
+                                       logprob_threshold = -1,
+                                       no_speech_threshold = 0.6
+                                       )
 
     with source:
         recorder.adjust_for_ambient_noise(source)
 
+    # Thread safe ring buffer for passing the audio from the threaded recording callback, 30 seconds of it.
+    capture = PcmRingBuffer(capacity=30 * source.SAMPLE_RATE)
+    # The first sample not read yet.
+    cursor = 0
+
     def record_callback(_, audio:sr.AudioData) -> None:
         """
         Threaded callback function to receive audio data when recordings finish.
         audio: An AudioData containing the recorded bytes.
         """
-        # Grab the raw bytes and push it into the thread safe queue.
-        data = audio.get_raw_data()
-        data_queue.put(data)
+        # Grab the raw bytes and write them to the thread safe ring buffer.
+        capture.write(audio.get_raw_data())
 
     # Create a background thread that will pass us raw audio bytes.
     # We could do this manually but SpeechRecognizer provides a nice helper.
@@ -123,8 +134,8 @@ def main():
     while True:
         try:
             now = datetime.utcnow()
-            # Pull raw recorded audio from the queue.
-            if not data_queue.empty():
+            # Pull raw recorded audio from the ring buffer.
+            if capture.written > cursor:
                 print("PHRASE STARTED")
                 phrase_complete = False
 
@@ -140,43 +151,23 @@ def main():
                 if phrase_time and (now - phrase_time > timedelta(seconds=phrase_timeout) or now - phrase_start_time > timedelta(seconds=10)):
                     phrase_complete = True
                     phrase_start_time = None
+                    transcription[-1] = transcriber.end_phrase().text
                     print("PHRASE COMPLETE")
 
                 # This is the last time we received new audio data from the queue.
                 phrase_time = now
                 
-                # Combine audio data from queue
-                audio_data = b''.join(data_queue.queue)
-                data_queue.queue.clear()
-                
-                # Convert in-ram buffer to something the model can use directly without needing a temp file.
-                # Convert data from 16 bit wide integers to floating point with a width of 32 bits.
-                # Clamp the audio stream frequency to a PCM wavelength compatible default of 32768hz max.
-                audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+                # All the audio recorded since the last read, without copying it. The ring buffer already
+                # converted it from 16 bit wide integers to floating point with a width of 32 bits.
+                audio_np, start = capture.read(cursor)
+                cursor = start + len(audio_np)
 
                 # Save the audio_np array to a .wav file for debugging
                 save_debug_audio(audio_np, source.SAMPLE_RATE, debug_folder)
 
-                # Read the transcription.
-                # Arguments are hard-coded as the model does not fully support alternative options.
-                result = transcribe(model=model, 
-                                    audio=audio_np, 
-                                    temperature=[0],
-                                    task = "transcribe",
-                                    language = 'en',
-                                    verbose=False,
-                                    best_of = 5,
-                                    beam_size = 5,
-                                    patience = None,
-                                    length_penalty = 0.08,
-                                    suppress_tokens = "-1",
-                                    initial_prompt = None,
-                                    condition_on_previous_text = None,
-                                    compression_ratio_threshold = 2.4,
-                                    logprob_threshold = -1,
-                                    no_speech_threshold = 0.6
-                                    )
-                text = result['text'].strip()
+                # Decode the new audio together with the uncommitted audio before it.
+                transcriber.insert_audio(audio_np)
+                text = transcriber.process(model).text
 
                 # If we detected a pause between recordings, add a new item to our transcription.
                 # Otherwise edit the existing one.
@@ -192,8 +183,8 @@ def main():
                 # Flush stdout.
                 print('', end='', flush=True)
             else:
-                # Infinite loops are bad for processors, must sleep.
-                sleep(0.25)
+                # Infinite loops are bad for processors, must sleep until the listener records some audio.
+                capture.wait(cursor, timeout=0.25)
         except KeyboardInterrupt:
             break
 
@@ -0,0 +1,135 @@
+import threading
+from contextlib import contextmanager
+from queue import Queue, Empty
+from typing import Optional
+
+import numpy as np
+import psutil
+
+from whisper.audio import SAMPLE_RATE
+from whisper.model import load_model, Whisper
+from whisper.transcribe import transcribe
+
+
+class ModelPoolExhausted(RuntimeError):
+    """Raised when every pooled model is leased and none was released in time"""
+
+
+class ModelRegistry:
+    """
+    Process-wide pool of ready Whisper models.
+
+    The encoder and decoder sessions are built once by `load()`, and `capacity` Whisper instances
+    sharing those sessions are handed out with `acquire()`/`release()` (or the `lease()` context manager).
+    The registry keeps a count of the leased instances so it is never unloaded while a client uses it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        onnx_encoder_path: str,
+        onnx_decoder_path: str,
+        encoder_target: str,
+        decoder_target: str,
+        capacity: int = 2,
+        intra_op_num_threads: Optional[int] = None,
+    ):
+        assert isinstance(capacity, int) and capacity > 0, "Capacity must be a positive integer"
+        if intra_op_num_threads is None:
+            # Split the physical cores between the models which may run at the same time
+            intra_op_num_threads = max(1, (psutil.cpu_count(logical=False) or 1) // capacity)
+        self.name = name
+        self.onnx_encoder_path = onnx_encoder_path
+        self.onnx_decoder_path = onnx_decoder_path
+        self.encoder_target = encoder_target
+        self.decoder_target = decoder_target
+        self.capacity = capacity
+        self.intra_op_num_threads = intra_op_num_threads
+
+        self._lock = threading.Lock()
+        self._idle: Queue = Queue()
+        self._model: Optional[Whisper] = None
+        self._refcount = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    @property
+    def is_multilingual(self) -> bool:
+        if self._model is None:
+            raise RuntimeError("The model registry has not been loaded")
+        return self._model.is_multilingual
+
+    def load(self, warmup_options: Optional[dict] = None):
+        """
+        Builds the ONNX Runtime sessions and fills the pool.
+        If `warmup_options` is given, one second of silence is transcribed with them so the first
+        client does not pay for the sessions' lazy initialisation.
+        """
+        with self._lock:
+            if self._model is not None:
+                return
+            model = load_model(self.name, self.onnx_encoder_path, self.onnx_decoder_path, self.encoder_target, self.decoder_target,
+                               intra_op_num_threads=self.intra_op_num_threads)
+            for _ in range(self.capacity):
+                self._idle.put(model.clone())
+            self._model = model
+
+        if warmup_options is not None:
+            self.warmup(**warmup_options)
+
+    def warmup(self, **transcribe_options):
+        with self.lease() as model:
+            transcribe(model=model, audio=np.zeros(SAMPLE_RATE, dtype=np.float32), **transcribe_options)
+
+    def unload(self):
+        with self._lock:
+            if self._refcount > 0:
+                raise RuntimeError(f"Cannot unload the model registry while {self._refcount} model(s) are in use")
+            self._idle = Queue()
+            self._model = None
+
+    def acquire(self, timeout: Optional[float] = None) -> Whisper:
+        """
+        Leases a model from the pool.
+        Blocks until one is released if `timeout` is None, otherwise raises `ModelPoolExhausted`
+        after `timeout` seconds (immediately when `timeout` is 0).
+        """
+        if self._model is None:
+            raise RuntimeError("The model registry has not been loaded")
+        try:
+            if timeout == 0:
+                model = self._idle.get_nowait()
+            else:
+                model = self._idle.get(timeout=timeout)
+        except Empty:
+            raise ModelPoolExhausted(f"All {self.capacity} models are in use")
+
+        with self._lock:
+            self._refcount += 1
+        return model
+
+    def release(self, model: Whisper):
+        with self._lock:
+            assert self._refcount > 0, "Released a model which was not acquired"
+            self._refcount -= 1
+        self._idle.put(model)
+
+    @contextmanager
+    def lease(self, timeout: Optional[float] = None):
+        model = self.acquire(timeout)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def stats(self) -> dict:
+        return {
+            "model": self.name,
+            "loaded": self.loaded,
+            "capacity": self.capacity,
+            "intra_op_num_threads": self.intra_op_num_threads,
+            "in_use": self._refcount,
+            "idle": self._idle.qsize(),
+        }
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple, Union
+
+import numpy as np
+
+INT16_SCALE = np.float32(1 / 32768.0)
+
+
+class PcmRingBuffer:
+    """
+    A preallocated ring buffer of mono PCM, written by a capture thread and read by the transcription.
+
+    Samples are addressed by their index since the start of the stream. The 16 bit PCM written is converted
+    once into float32, and every sample is stored twice (at `i % capacity` and `i % capacity + capacity`), so any
+    run of up to `capacity` samples can be read as a contiguous float32 view, without copying or allocating.
+    A view stays valid until `capacity` more samples are written; a reader which falls further behind than that
+    skips to the oldest samples still stored.
+
+    The time at which each write ended is recorded, so a reader can tell when the audio it reads was captured.
+    """
+
+    def __init__(self, capacity: int, max_marks: int = 256):
+        assert isinstance(capacity, int) and capacity > 0, "The capacity must be a positive integer"
+        self.capacity = capacity
+        self.samples = np.zeros(2 * capacity, dtype=np.float32)
+        self.written = 0    # the samples written since the start of the stream
+
+        # (end of a write, time.monotonic() when it ended), for the most recent writes
+        self._marks: Deque[Tuple[int, float]] = deque(maxlen=max_marks)
+        self._written_cond = threading.Condition(threading.Lock())
+
+    @property
+    def first_sample(self) -> int:
+        """The oldest sample still stored"""
+        return max(0, self.written - self.capacity)
+
+    def write(self, pcm: Union[bytes, np.ndarray]) -> int:
+        """
+        Appends int16 PCM, given as bytes or an array, or float32 PCM in [-1, 1), and returns the new end of the
+        stream. Of a write longer than the buffer, only the last `capacity` samples are kept.
+        """
+        if isinstance(pcm, (bytes, bytearray, memoryview)):
+            pcm = np.frombuffer(pcm, dtype=np.int16)
+        n_samples = len(pcm)
+        kept = pcm[-self.capacity:]
+        with self._written_cond:
+            start = (self.written + n_samples - len(kept)) % self.capacity
+            stop = start + len(kept)
+            if kept.dtype == np.int16:
+                np.multiply(kept, INT16_SCALE, out=self.samples[start:stop])
+            else:
+                self.samples[start:stop] = kept
+            # the mirror copies: a run starting before `capacity` may end after it
+            self.samples[start + self.capacity : min(stop, self.capacity) + self.capacity] = self.samples[start : min(stop, self.capacity)]
+            if stop > self.capacity:
+                self.samples[: stop - self.capacity] = self.samples[self.capacity : stop]
+
+            self.written += n_samples
+            self._marks.append((self.written, time.monotonic()))
+            self._written_cond.notify_all()
+            return self.written
+
+    def read(self, start: int, stop: Optional[int] = None) -> Tuple[np.ndarray, int]:
+        """
+        A read-only float32 view of the samples [start, stop), up to the end of the stream if `stop` is None.
+        Returns the view and its first sample, which is later than `start` if those samples were overwritten.
+        """
+        with self._written_cond:
+            stop = self.written if stop is None else min(stop, self.written)
+            start = min(max(start, self.first_sample), stop)
+        begin = start % self.capacity
+        view = self.samples[begin : begin + stop - start]
+        view.flags.writeable = False
+        return view, start
+
+    def time_of(self, sample: int) -> Optional[float]:
+        """The `time.monotonic()` at which `sample` was written, None if it was not written yet"""
+        with self._written_cond:
+            for end, written_time in self._marks:
+                if sample < end:
+                    return written_time
+        return None
+
+    def wait(self, sample: int, timeout: Optional[float] = None) -> bool:
+        """Blocks until more than `sample` samples were written, returns False on timeout"""
+        with self._written_cond:
+            return self._written_cond.wait_for(lambda: self.written > sample, timeout)
@@ -0,0 +1,146 @@
+import json
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+import soundfile as sf
+import speech_recognition as sr
+from speech_recognition.resample import to_pcm
+
+
+def replay_files(path: str) -> List[str]:
+    """
+    The audio files to replay for `path`: a WAV/FLAC file, or the files of a LibriSpeech manifest such as
+    `librispeech-test-clean-wav.json`, in order. The manifest's paths are relative to the working directory,
+    like for `whisper --librispeech`, or else to the manifest's directory.
+    """
+    if not path.endswith(".json"):
+        return [path]
+    with open(path, "r") as f:
+        metainfo = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    files = []
+    for info in metainfo:
+        for file in info["files"]:
+            fname = file["fname"]
+            files.append(fname if os.path.isabs(fname) or os.path.exists(fname) else os.path.join(root, fname))
+    return files
+
+
+class ReplayAudioSource(sr.AudioSource):
+    """
+    Replays audio files as if they were captured by a sound device, to load test the live pipeline without one.
+
+    The files are read as they are played, downmixed and resampled to `sample_rate` by a `sr.PolyphaseResampler`,
+    and handed out as 16 bit PCM in reads of any size, like `sr.Microphone`. A read returns once its audio would
+    have been captured: at `speed` times real time (1 in real time, 0 as fast as possible), each read delayed by a
+    random extra of up to `jitter` seconds, like a device delivering its buffers irregularly; the delays do not add
+    up, a late read is followed by early ones. The delays are drawn from `seed`, so a replay is deterministic.
+
+    The files of a manifest are played one after the other from the file `start`, so that simulated speakers
+    replaying the same manifest say different things; after the last one the replay starts over if `loop`, else
+    the stream ends (reads return no data).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        speed: float = 1.0,
+        jitter: float = 0.0,
+        loop: bool = True,
+        start: int = 0,
+        seed: Optional[int] = None,
+        sample_rate: int = 16000,
+        chunk_size: int = 1024,
+    ):
+        assert speed >= 0, "The speed must be 0 (as fast as possible) or positive"
+        assert jitter >= 0, "The jitter must not be negative"
+        assert isinstance(sample_rate, int) and sample_rate > 0, "Sample rate must be a positive integer"
+        assert isinstance(chunk_size, int) and chunk_size > 0, "Chunk size must be a positive integer"
+        self.files = replay_files(path)
+        assert self.files, f"No audio file to replay in {path}"
+        self.speed = speed
+        self.jitter = jitter
+        self.loop = loop
+        self.start = start % len(self.files)
+        self.seed = seed
+
+        self.SAMPLE_WIDTH = 2  # 16-bit int sampling
+        self.SAMPLE_RATE = sample_rate
+        self.CHUNK = chunk_size
+        self.stream = None
+
+    def __enter__(self):
+        assert self.stream is None, "This audio source is already inside a context manager"
+        self.stream = ReplayAudioSource.ReplayStream(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.stream.close()
+        finally:
+            self.stream = None
+
+    class ReplayStream(object):
+        def __init__(self, source: "ReplayAudioSource"):
+            self.source = source
+            self.rng = np.random.default_rng(source.seed)
+            self.index = source.start - 1   # the file being played
+            self.file: Optional[sf.SoundFile] = None
+            self.resampler: Optional[sr.PolyphaseResampler] = None
+            self.pending = np.zeros(0, dtype=np.float32)   # resampled audio not read yet
+            self.ended = False
+            self.n_read = 0             # the samples read since the replay started
+            self.started: Optional[float] = None
+
+        def _next_file(self) -> bool:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.index += 1
+            if self.index == len(self.source.files):
+                if not self.source.loop:
+                    return False
+                self.index = 0
+            self.file = sf.SoundFile(self.source.files[self.index])
+            self.resampler = sr.PolyphaseResampler(self.file.samplerate, self.source.SAMPLE_RATE, channels=self.file.channels)
+            return True
+
+        def _fill(self, size: int):
+            # reads and resamples the files until `size` samples are pending or the replay ends
+            parts = [self.pending]
+            n_pending = len(self.pending)
+            while n_pending < size and not self.ended:
+                if self.file is None and not self._next_file():
+                    self.ended = True
+                    break
+                frames = self.file.read(max(1, self.resampler.input_frames(size - n_pending)), dtype="int16", always_2d=True)
+                if len(frames) == 0:
+                    parts.append(self.resampler.flush())
+                    self.file.close()
+                    self.file = None
+                else:
+                    parts.append(self.resampler.process(frames))
+                n_pending += len(parts[-1])
+            self.pending = np.concatenate(parts)
+
+        def read(self, size: int) -> bytes:
+            if self.started is None:
+                self.started = time.monotonic()
+            self._fill(size)
+            samples, self.pending = self.pending[:size], self.pending[size:]
+            self.n_read += len(samples)
+
+            if self.source.speed > 0:
+                # returns when the end of the read would have been captured
+                deadline = self.started + self.n_read / (self.source.SAMPLE_RATE * self.source.speed)
+                if self.source.jitter > 0:
+                    deadline += self.rng.uniform(0, self.source.jitter)
+                time.sleep(max(0.0, deadline - time.monotonic()))
+            return to_pcm(samples, self.source.SAMPLE_WIDTH)
+
+        def close(self):
+            if self.file is not None:
+                self.file.close()
+                self.file = None
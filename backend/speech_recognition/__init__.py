@@ -38,6 +38,8 @@ from .exceptions import (
     UnknownValueError,
     WaitTimeoutError,
 )
+from .resample import PolyphaseResampler, resample
+from .vad import VadEvent, VoiceActivityDetector, rms
 
 __author__ = "Anthony Zhang (Uberi)"
 __version__ = "3.10.4"
@@ -65,7 +67,7 @@ class Microphone(AudioSource):
 
     A device index is an integer between 0 and ``pyaudio.get_device_count() - 1`` (assume we have used ``import pyaudio`` beforehand) inclusive. It represents an audio device such as a microphone or speaker. See the `PyAudio documentation <http://people.csail.mit.edu/hubert/pyaudio/docs/>`__ for more details.
 
-    The microphone audio is recorded in chunks of ``chunk_size`` samples, at a rate of ``sample_rate`` samples per second (Hertz). If not specified, the value of ``sample_rate`` is determined automatically from the system's microphone settings.
+    The microphone audio is recorded in chunks of ``chunk_size`` samples, at a rate of ``sample_rate`` samples per second (Hertz). If not specified, the value of ``sample_rate`` is determined automatically from the system's microphone settings. The device is always opened at its own default rate, and its audio is resampled to ``sample_rate`` by a ``PolyphaseResampler`` if they differ.
 
     Higher ``sample_rate`` values result in better audio quality, but also more bandwidth (and therefore, slower recognition). Additionally, some CPUs, such as those in older Raspberry Pi models, can't keep up if this value is too high.
 
@@ -83,10 +85,11 @@ class Microphone(AudioSource):
             count = audio.get_device_count()  # obtain device count
             if device_index is not None:  # ensure device index is in range
                 assert 0 <= device_index < count, "Device index out of range ({} devices available; device index should be between 0 and {} inclusive)".format(count, count - 1)
+            device_info = audio.get_device_info_by_index(device_index) if device_index is not None else audio.get_default_input_device_info()
+            assert isinstance(device_info.get("defaultSampleRate"), (float, int)) and device_info["defaultSampleRate"] > 0, "Invalid device info returned from PyAudio: {}".format(device_info)
+            device_sample_rate = int(device_info["defaultSampleRate"])
             if sample_rate is None:  # automatically set the sample rate to the hardware's default sample rate if not specified
-                device_info = audio.get_device_info_by_index(device_index) if device_index is not None else audio.get_default_input_device_info()
-                assert isinstance(device_info.get("defaultSampleRate"), (float, int)) and device_info["defaultSampleRate"] > 0, "Invalid device info returned from PyAudio: {}".format(device_info)
-                sample_rate = int(device_info["defaultSampleRate"])
+                sample_rate = device_sample_rate
         finally:
             audio.terminate()
 
@@ -94,6 +97,7 @@ class Microphone(AudioSource):
         self.format = self.pyaudio_module.paInt16  # 16-bit int sampling
         self.SAMPLE_WIDTH = self.pyaudio_module.get_sample_size(self.format)  # size of each sample
         self.SAMPLE_RATE = sample_rate  # sampling rate in Hertz
+        self.device_sample_rate = device_sample_rate  # the rate the device is opened at
         self.CHUNK = chunk_size  # number of frames stored in each buffer
 
         self.audio = None
@@ -177,8 +181,9 @@ class Microphone(AudioSource):
             self.stream = Microphone.MicrophoneStream(
                 self.audio.open(
                     input_device_index=self.device_index, channels=1, format=self.format,
-                    rate=self.SAMPLE_RATE, frames_per_buffer=self.CHUNK, input=True,
-                )
+                    rate=self.device_sample_rate, frames_per_buffer=self.CHUNK, input=True,
+                ),
+                PolyphaseResampler(self.device_sample_rate, self.SAMPLE_RATE) if self.device_sample_rate != self.SAMPLE_RATE else None,
             )
         except Exception:
             self.audio.terminate()
@@ -192,11 +197,15 @@ class Microphone(AudioSource):
             self.audio.terminate()
 
     class MicrophoneStream(object):
-        def __init__(self, pyaudio_stream):
+        def __init__(self, pyaudio_stream, resampler=None):
             self.pyaudio_stream = pyaudio_stream
+            self.resampler = resampler  # from the device's rate to ``SAMPLE_RATE``, None if they are the same
 
         def read(self, size):
-            return self.pyaudio_stream.read(size, exception_on_overflow=False)
+            if self.resampler is None:
+                return self.pyaudio_stream.read(size, exception_on_overflow=False)
+            # ``size`` samples at ``SAMPLE_RATE``, read at the device's rate
+            return self.resampler.process_pcm(self.pyaudio_stream.read(self.resampler.input_frames(size), exception_on_overflow=False))
 
         def close(self):
             try:
@@ -337,6 +346,8 @@ class Recognizer(AudioSource):
 
         self.phrase_threshold = 0.3  # minimum seconds of speaking audio before we consider the speaking audio a phrase - values below this are ignored (for filtering out clicks and pops)
         self.non_speaking_duration = 0.5  # seconds of non-speaking audio to keep on both sides of the recording
+        self.vad = None  # a ``VoiceActivityDetector`` to detect the phrases with, instead of the energy threshold of each chunk (see ``recognizer_instance.phrases``)
+        self.vad_block_duration = 0.1  # seconds of audio read from the source and given to ``vad`` at a time
 
     def record(self, source, duration=None, offset=None):
         """
@@ -391,7 +402,7 @@ class Recognizer(AudioSource):
             elapsed_time += seconds_per_buffer
             if elapsed_time > duration: break
             buffer = source.stream.read(source.CHUNK)
-            energy = audioop.rms(buffer, source.SAMPLE_WIDTH)  # energy of the audio signal
+            energy = rms(buffer, source.SAMPLE_WIDTH)  # energy of the audio signal
 
             # dynamically adjust the energy threshold using asymmetric weighted average
             damping = self.dynamic_energy_adjustment_damping ** seconds_per_buffer  # account for different chunk sizes and rates
@@ -414,7 +425,7 @@ class Recognizer(AudioSource):
 
         elapsed_time = 0
         seconds_per_buffer = float(source.CHUNK) / source.SAMPLE_RATE
-        resampling_state = None
+        resampler = PolyphaseResampler(source.SAMPLE_RATE, snowboy_sample_rate)
 
         # buffers capable of holding 5 seconds of original audio
         five_seconds_buffer_count = int(math.ceil(5 / seconds_per_buffer))
@@ -435,7 +446,7 @@ class Recognizer(AudioSource):
             frames.append(buffer)
 
             # resample audio to the required sample rate
-            resampled_buffer, resampling_state = audioop.ratecv(buffer, source.SAMPLE_WIDTH, 1, source.SAMPLE_RATE, snowboy_sample_rate, resampling_state)
+            resampled_buffer = resampler.process_pcm(buffer, source.SAMPLE_WIDTH)
             resampled_frames.append(resampled_buffer)
             if time.time() - last_check > check_interval:
                 # run Snowboy on the resampled audio
@@ -460,10 +471,16 @@ class Recognizer(AudioSource):
         The ``snowboy_configuration`` parameter allows integration with `Snowboy <https://snowboy.kitt.ai/>`__, an offline, high-accuracy, power-efficient hotword recognition engine. When used, this function will pause until Snowboy detects a hotword, after which it will unpause. This parameter should either be ``None`` to turn off Snowboy support, or a tuple of the form ``(SNOWBOY_LOCATION, LIST_OF_HOT_WORD_FILES)``, where ``SNOWBOY_LOCATION`` is the path to the Snowboy root directory, and ``LIST_OF_HOT_WORD_FILES`` is a list of paths to Snowboy hotword configuration files (`*.pmdl` or `*.umdl` format).
 
         This operation will always complete within ``timeout + phrase_timeout`` seconds if both are numbers, either by returning the audio data, or by raising a ``speech_recognition.WaitTimeoutError`` exception.
+
+        If ``recognizer_instance.vad`` is set, the phrase is detected by it instead, see ``recognizer_instance.phrases``.
         """
         assert isinstance(source, AudioSource), "Source must be an audio source"
         assert source.stream is not None, "Audio source must be entered before listening, see documentation for ``AudioSource``; are you using ``source`` outside of a ``with`` statement?"
         assert self.pause_threshold >= self.non_speaking_duration >= 0
+        if self.vad is not None and snowboy_configuration is None:
+            for phrase in self.phrases(source, timeout, phrase_time_limit):
+                return phrase
+            return AudioData(b"", source.SAMPLE_RATE, source.SAMPLE_WIDTH)  # reached the end of the stream
         if snowboy_configuration is not None:
             assert os.path.isfile(os.path.join(snowboy_configuration[0], "snowboydetect.py")), "``snowboy_configuration[0]`` must be a Snowboy root directory containing ``snowboydetect.py``"
             for hot_word_file in snowboy_configuration[1]:
@@ -495,7 +512,7 @@ class Recognizer(AudioSource):
                         frames.popleft()
 
                     # detect whether speaking has started on audio input
-                    energy = audioop.rms(buffer, source.SAMPLE_WIDTH)  # energy of the audio signal
+                    energy = rms(buffer, source.SAMPLE_WIDTH)  # energy of the audio signal
                     if energy > self.energy_threshold: break
 
                     # dynamically adjust the energy threshold using asymmetric weighted average
@@ -526,7 +543,7 @@ class Recognizer(AudioSource):
                 phrase_count += 1
 
                 # check if speaking has stopped for longer than the pause threshold on the audio input
-                energy = audioop.rms(buffer, source.SAMPLE_WIDTH)  # unit energy of the audio signal within the buffer
+                energy = rms(buffer, source.SAMPLE_WIDTH)  # unit energy of the audio signal within the buffer
                 if energy > self.energy_threshold:
                     pause_count = 0
                 else:
@@ -544,13 +561,80 @@ class Recognizer(AudioSource):
 
         return AudioData(frame_data, source.SAMPLE_RATE, source.SAMPLE_WIDTH)
 
+    def phrases(self, source, timeout=None, phrase_time_limit=None, stop=None):
+        """
+        Generates the phrases of ``source`` (an ``AudioSource`` instance) as ``AudioData`` instances, detected by ``recognizer_instance.vad`` (a ``VoiceActivityDetector`` instance) in one continuous stream of audio.
+
+        The audio is read ``recognizer_instance.vad_block_duration`` seconds at a time, and each block is given to the detector at once. A phrase is cut at the samples where the detector found the speech to start and end, keeping ``recognizer_instance.non_speaking_duration`` seconds of audio on both sides.
+
+        The ``timeout`` parameter is the maximum number of seconds of audio that this will wait for the first phrase to start before throwing an ``speech_recognition.WaitTimeoutError`` exception. If ``timeout`` is ``None``, there will be no wait timeout.
+
+        The ``phrase_time_limit`` parameter is the maximum number of seconds of a phrase generated at once. A longer phrase is generated in parts of that length as it goes on, and each part continues where the previous one was cut, so no audio is lost between them.
+
+        The ``stop`` parameter is a function called after each block, which ends the generation when it returns a truthy value.
+        """
+        assert isinstance(source, AudioSource), "Source must be an audio source"
+        assert source.stream is not None, "Audio source must be entered before listening, see documentation for ``AudioSource``; are you using ``source`` outside of a ``with`` statement?"
+        assert self.vad is not None, "A voice activity detector must be set to ``recognizer_instance.vad``"
+        assert self.pause_threshold >= self.non_speaking_duration >= 0
+
+        vad = self.vad
+        vad.reset()
+        sample_width = source.SAMPLE_WIDTH
+        block_frames = source.CHUNK * max(1, int(round(self.vad_block_duration * source.SAMPLE_RATE / source.CHUNK)))
+        padding = int(self.non_speaking_duration * source.SAMPLE_RATE)  # samples of non-speaking audio to keep on both sides of a phrase
+        limit = int(phrase_time_limit * source.SAMPLE_RATE) if phrase_time_limit else None
+
+        audio = bytearray()  # the audio read from ``audio_start`` on
+        audio_start = 0  # the first sample of ``audio``, counted from the start of the stream
+        phrase_start = None  # the first sample of the current phrase
+        waiting = True  # no phrase started yet
+
+        def cut(start, stop):
+            return AudioData(bytes(audio[(start - audio_start) * sample_width:(stop - audio_start) * sample_width]), source.SAMPLE_RATE, sample_width)
+
+        while stop is None or not stop():
+            buffer = source.stream.read(block_frames)
+            if len(buffer) == 0:  # reached end of the stream
+                break
+            audio += buffer
+            audio_end = audio_start + len(audio) // sample_width
+
+            for event in vad.process(buffer, sample_width):
+                if event.kind == "start":
+                    phrase_start = max(audio_start, event.sample - padding)
+                    waiting = False
+                elif phrase_start is not None:
+                    yield cut(phrase_start, min(audio_end, event.sample + padding))
+                    phrase_start = None
+            while limit and phrase_start is not None and audio_end - phrase_start >= limit:
+                yield cut(phrase_start, phrase_start + limit)
+                phrase_start += limit
+
+            if waiting and timeout and audio_end > timeout * source.SAMPLE_RATE:
+                raise WaitTimeoutError("listening timed out while waiting for phrase to start")
+
+            # keep the audio of the current phrase, or which may become one, and the padding before it
+            if phrase_start is not None:
+                keep_from = phrase_start
+            elif vad.onset is not None:
+                keep_from = vad.onset * vad.frame_length - padding
+            else:
+                keep_from = audio_end - padding
+            keep_from = max(audio_start, keep_from)
+            del audio[: (keep_from - audio_start) * sample_width]
+            audio_start = keep_from
+
+        if phrase_start is not None and audio:
+            yield cut(phrase_start, audio_start + len(audio) // sample_width)
+
     def listen_in_background(self, source, callback, phrase_time_limit=None):
         """
         Spawns a thread to repeatedly record phrases from ``source`` (an ``AudioSource`` instance) into an ``AudioData`` instance and call ``callback`` with that ``AudioData`` instance as soon as each phrase are detected.
 
         Returns a function object that, when called, requests that the background listener thread stop. The background thread is a daemon and will not stop the program from exiting if there are no other non-daemon threads. The function accepts one parameter, ``wait_for_stop``: if truthy, the function will wait for the background listener to stop before returning, otherwise it will return immediately and the background listener thread might still be running for a second or two afterwards. Additionally, if you are using a truthy value for ``wait_for_stop``, you must call the function from the same thread you originally called ``listen_in_background`` from.
 
-        Phrase recognition uses the exact same mechanism as ``recognizer_instance.listen(source)``. The ``phrase_time_limit`` parameter works in the same way as the ``phrase_time_limit`` parameter for ``recognizer_instance.listen(source)``, as well.
+        Phrase recognition uses the exact same mechanism as ``recognizer_instance.listen(source)``. If ``recognizer_instance.vad`` is set, the phrases are generated by ``recognizer_instance.phrases(source)`` from one continuous stream instead, so a phrase cut by ``phrase_time_limit`` continues in the next ``AudioData``. The ``phrase_time_limit`` parameter works in the same way as the ``phrase_time_limit`` parameter for ``recognizer_instance.listen(source)``, as well.
 
         The ``callback`` parameter is a function that should accept two parameters - the ``recognizer_instance``, and an ``AudioData`` instance representing the captured audio. Note that ``callback`` function will be called from a non-main thread.
         """
@@ -559,6 +643,10 @@ class Recognizer(AudioSource):
 
         def threaded_listen():
             with source as s:
+                if self.vad is not None:
+                    for audio in self.phrases(s, phrase_time_limit=phrase_time_limit, stop=lambda: not running[0]):
+                        if running[0]: callback(self, audio)
+                    return
                 while running[0]:
                     try:  # listen for 1 second, then check again if the stop function has been called
                         audio = self.listen(s, 1, phrase_time_limit)
@@ -8,6 +8,9 @@ import subprocess
 import sys
 import wave
 
+from .resample import resample, to_pcm
+from .vad import SAMPLE_DTYPES, pcm_samples
+
 
 class AudioData(object):
     """
@@ -86,8 +89,10 @@ class AudioData(object):
                 raw_data, 1, -128
             )  # subtract 128 from every sample to make them act like signed samples
 
-        # resample audio at the desired rate if specified
-        if convert_rate is not None and self.sample_rate != convert_rate:
+        # resample audio at the desired rate if specified, with a polyphase low-pass filter (``audioop.ratecv`` interpolates linearly, which aliases)
+        if convert_rate is not None and self.sample_rate != convert_rate and self.sample_width in SAMPLE_DTYPES:
+            raw_data = to_pcm(resample(pcm_samples(raw_data, self.sample_width), self.sample_rate, convert_rate), self.sample_width)
+        elif convert_rate is not None and self.sample_rate != convert_rate:  # 24-bit audio, which NumPy has no type for
             raw_data, _ = audioop.ratecv(
                 raw_data,
                 self.sample_width,
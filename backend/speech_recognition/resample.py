@@ -0,0 +1,136 @@
+"""Streaming polyphase resampling and downmixing of PCM, with NumPy."""
+
+from __future__ import annotations
+
+import math
+from typing import Union
+
+import numpy as np
+
+from .vad import SAMPLE_DTYPES, pcm_samples
+
+
+def lowpass_filter(up: int, down: int, half_width: int = 24, rolloff: float = 0.92, beta: float = 8.6) -> np.ndarray:
+    """
+    Returns the Kaiser windowed sinc low-pass filter of a resampling by ``up / down``, at the upsampled rate: ``half_width`` zero crossings on each side, a cutoff at ``rolloff`` times the lower of the two Nyquist frequencies, and a gain of ``up``.
+    """
+    max_rate = max(up, down)
+    half_length = half_width * max_rate
+    cutoff = rolloff / max_rate  # relative to the Nyquist frequency of the upsampled rate
+    t = np.arange(-half_length, half_length + 1, dtype=np.float64)
+    return up * cutoff * np.sinc(cutoff * t) * np.kaiser(2 * half_length + 1, beta)
+
+
+class PolyphaseResampler(object):
+    def __init__(self, from_rate: int, to_rate: int, channels: int = 1, half_width: int = 24, rolloff: float = 0.92, beta: float = 8.6):
+        """
+        Creates a new ``PolyphaseResampler`` instance, which converts a stream of PCM given in blocks of any size from ``from_rate`` Hz and ``channels`` interleaved channels into mono at ``to_rate`` Hz.
+
+        The channels are averaged, then the rate is converted by ``up / down`` (``to_rate / from_rate`` reduced) with the low-pass filter of ``lowpass_filter``, split into its ``up`` phases: each output sample is the dot product of one phase with the last input samples, computed for all the output samples of a block at once. The last input samples of a block are kept for the next one, so the output does not depend on how the stream is cut into blocks. The output is late by ``delay`` output samples (1.5 ms from 48 kHz to 16 kHz).
+
+        If the rates are equal, the audio is only downmixed.
+        """
+        assert from_rate > 0 and to_rate > 0, "Sample rates must be positive integers"
+        assert channels >= 1, "There must be at least one channel"
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        self.channels = channels
+        divisor = math.gcd(from_rate, to_rate)
+        self.up, self.down = to_rate // divisor, from_rate // divisor
+
+        if self.up == self.down:
+            self.phases = np.ones((1, 1), dtype=np.float32)
+            self.delay = 0.0
+        else:
+            taps = lowpass_filter(self.up, self.down, half_width, rolloff, beta)
+            taps_per_phase = -(-len(taps) // self.up)
+            taps = np.pad(taps, (0, taps_per_phase * self.up - len(taps)))
+            # phase p is taps[p::up]; reversed, so that it is the dot product with the input samples in order
+            self.phases = np.ascontiguousarray(taps.reshape(taps_per_phase, self.up).T[:, ::-1], dtype=np.float32)
+            self.delay = half_width * max(self.up, self.down) / self.down  # the center of the filter, in output samples
+        self.reset()
+
+    @property
+    def taps_per_phase(self) -> int:
+        return self.phases.shape[1]
+
+    def reset(self):
+        """Starts a new stream."""
+        self.n_in = 0  # input samples given to the resampler
+        self.n_out = 0  # output samples returned
+        self._history = np.zeros(self.taps_per_phase - 1, dtype=np.float32)  # the last input samples, the first ones of the next windows
+
+    def input_frames(self, n_out: int) -> int:
+        """
+        Returns how many more input frames make the resampler return at least ``n_out`` more output samples (exactly ``n_out`` when downsampling), e.g. to read a device at its rate for a given number of samples at ``to_rate``.
+        """
+        if n_out <= 0:
+            return 0
+        return max(0, (self.n_out + n_out - 1) * self.down // self.up + 1 - self.n_in)
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """
+        Gives the next block of the stream to the resampler, an array of samples of shape (n_frames,) or (n_frames, channels) in any units, and returns the float32 output samples it completes, in the same units.
+        """
+        samples = np.asarray(samples, dtype=np.float32)
+        if samples.ndim == 2:
+            # the average of the channels, as a product with a vector (much faster than ``mean`` on a short axis)
+            samples = samples @ np.full(samples.shape[1], 1 / samples.shape[1], dtype=np.float32)
+        if self.up == self.down:
+            self.n_in += len(samples)
+            self.n_out += len(samples)
+            return samples
+
+        n_taps = self.taps_per_phase
+        buffer = np.concatenate([self._history, samples]) if n_taps > 1 else samples
+        n_in = self.n_in + len(samples)
+        n_end = (n_in * self.up + self.down - 1) // self.down  # the outputs whose last input sample was given
+        # output n is the dot product of phase (n * down) % up with the inputs up to (n * down) // up
+        positions = np.arange(self.n_out, n_end, dtype=np.int64) * self.down
+        starts = positions // self.up - self.n_in  # the first input of each window, in ``buffer``
+        windows = np.lib.stride_tricks.as_strided(buffer, (len(buffer) - n_taps + 1, n_taps), buffer.strides * 2, writeable=False)
+        if self.up == 1:
+            # a decimation: a single phase and evenly spaced windows, a matrix-vector product on a strided view of the input
+            output = np.einsum("ij,j->i", windows[starts[0]::self.down][:len(starts)], self.phases[0]) if len(starts) else np.zeros(0, dtype=np.float32)
+        else:
+            output = np.einsum("ij,ij->i", windows[starts], self.phases[positions % self.up])
+
+        self.n_in, self.n_out = n_in, n_end
+        if n_taps > 1:
+            self._history = buffer[len(buffer) - (n_taps - 1):].copy()
+        return output
+
+    def flush(self) -> np.ndarray:
+        """Returns the output samples still held back by the filter delay, as if the stream ended with silence, and starts a new stream."""
+        if self.up == self.down:
+            return np.zeros(0, dtype=np.float32)
+        output = self.process(np.zeros(int(math.ceil((self.delay + 1) * self.down / self.up)), dtype=np.float32))
+        self.reset()
+        return output
+
+    def process_pcm(self, buffer: Union[bytes, np.ndarray], sample_width: int = 2) -> bytes:
+        """
+        Like ``process``, for raw interleaved PCM of ``sample_width`` bytes per sample (signed little-endian, as ``audioop`` reads it), and returns raw PCM of the same width.
+        """
+        samples = pcm_samples(buffer, sample_width)
+        if self.channels > 1:
+            samples = samples[: len(samples) - len(samples) % self.channels].reshape(-1, self.channels)
+        return to_pcm(self.process(samples), sample_width)
+
+
+def to_pcm(samples: np.ndarray, sample_width: int = 2) -> bytes:
+    """Returns ``samples``, in the units of PCM of ``sample_width`` bytes per sample, as raw PCM: rounded and clipped."""
+    dtype = SAMPLE_DTYPES[sample_width]
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(samples), info.min, info.max).astype(dtype).tobytes()
+
+
+def resample(samples: np.ndarray, from_rate: int, to_rate: int, **kwargs) -> np.ndarray:
+    """
+    Returns the mono float32 ``samples``, the whole audio at ``from_rate`` Hz, resampled at ``to_rate`` Hz, without the filter delay: ``ceil(len(samples) * to_rate / from_rate)`` samples aligned with the input.
+    """
+    resampler = PolyphaseResampler(from_rate, to_rate, **kwargs)
+    n_out = -(-len(samples) * resampler.up // resampler.down)
+    output = np.concatenate([resampler.process(samples), resampler.flush()])
+    delay = int(round(resampler.delay))
+    return output[delay: delay + n_out]
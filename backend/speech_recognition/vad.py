@@ -0,0 +1,186 @@
+"""Streaming voice activity detection on blocks of PCM, with NumPy."""
+
+from __future__ import annotations
+
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}  # signed little-endian PCM, as ``audioop`` reads it
+
+
+def pcm_samples(buffer: Union[bytes, np.ndarray], sample_width: int = 2) -> np.ndarray:
+    """
+    Returns the samples of ``buffer``, raw PCM of ``sample_width`` bytes per sample, as an array without copying it. An array is returned as is.
+    """
+    if isinstance(buffer, np.ndarray):
+        return buffer
+    assert sample_width in SAMPLE_DTYPES, "Sample width must be 1, 2 or 4"
+    return np.frombuffer(buffer, dtype=SAMPLE_DTYPES[sample_width])
+
+
+def rms(buffer: Union[bytes, np.ndarray], sample_width: int = 2) -> int:
+    """
+    Returns the root mean square of the samples of ``buffer``, like ``audioop.rms(buffer, sample_width)``.
+    """
+    samples = pcm_samples(buffer, sample_width)
+    if len(samples) == 0:
+        return 0
+    samples = samples.astype(np.float64)
+    return int(math.sqrt(np.dot(samples, samples) / len(samples)))
+
+
+@dataclass(frozen=True)
+class VadEvent:
+    """
+    A change of voice activity: speech starts or ends at ``sample``, counted from the first sample given to the detector.
+    """
+    kind: str  # "start" or "end"
+    sample: int
+
+
+class VoiceActivityDetector(object):
+    def __init__(self, sample_rate: int = 16000, energy_threshold: float = 300, release_ratio: float = 0.7,
+                 dynamic_energy_threshold: bool = False, dynamic_energy_adjustment_damping: float = 0.15, dynamic_energy_ratio: float = 1.5,
+                 pause_threshold: float = 0.8, phrase_threshold: float = 0.3, frame_duration: float = 0.01,
+                 max_zero_crossing_rate: Optional[float] = None, max_spectral_flatness: Optional[float] = None):
+        """
+        Creates a new ``VoiceActivityDetector`` instance, which detects speech in a stream of PCM given in blocks of any size.
+
+        Each block is cut into frames of ``frame_duration`` seconds, and the features of all of its frames are computed at once: the energy (root mean square, in the units of the samples, like ``Recognizer.energy_threshold``) and, if enabled, the zero-crossing rate and the spectral flatness. A frame is loud if its energy is above ``energy_threshold``, and voiced if it is above ``energy_threshold * release_ratio`` (hysteresis); the frames with a zero-crossing rate above ``max_zero_crossing_rate`` or a spectral flatness above ``max_spectral_flatness`` (noise-like frames, between 0 and 1) are neither.
+
+        Speech starts at a loud frame, once ``phrase_threshold`` seconds of voiced frames followed it (shorter bursts, like clicks and pops, are ignored), and it ends at the first frame of ``pause_threshold`` seconds of frames which are not voiced (hangover). The events report the sample offsets of the frames, counted from the start of the stream.
+
+        If ``dynamic_energy_threshold`` is true, the threshold follows the ambient energy while there is no speech, like ``Recognizer.dynamic_energy_threshold``; it is updated once per block, from the block's frames before any speech.
+        """
+        assert sample_rate > 0, "Sample rate must be positive"
+        assert 0 < release_ratio <= 1, "The release ratio must be in (0, 1]"
+        assert pause_threshold > 0 and phrase_threshold >= 0 and frame_duration > 0
+        self.sample_rate = sample_rate
+        self.energy_threshold = energy_threshold
+        self.release_ratio = release_ratio
+        self.dynamic_energy_threshold = dynamic_energy_threshold
+        self.dynamic_energy_adjustment_damping = dynamic_energy_adjustment_damping
+        self.dynamic_energy_ratio = dynamic_energy_ratio
+        self.max_zero_crossing_rate = max_zero_crossing_rate
+        self.max_spectral_flatness = max_spectral_flatness
+
+        self.frame_length = max(1, int(round(frame_duration * sample_rate)))
+        self.pause_frames = max(1, int(math.ceil(pause_threshold * sample_rate / self.frame_length)))
+        self.phrase_frames = max(1, int(math.ceil(phrase_threshold * sample_rate / self.frame_length)))
+        self.reset()
+
+    @classmethod
+    def from_recognizer(cls, recognizer, sample_rate: int, **kwargs) -> "VoiceActivityDetector":
+        """
+        Creates a detector with the energy threshold and the timings of ``recognizer`` (a ``Recognizer`` instance), e.g. after ``recognizer.adjust_for_ambient_noise(source)``.
+        """
+        settings = dict(
+            energy_threshold=recognizer.energy_threshold,
+            dynamic_energy_threshold=recognizer.dynamic_energy_threshold,
+            dynamic_energy_adjustment_damping=recognizer.dynamic_energy_adjustment_damping,
+            dynamic_energy_ratio=recognizer.dynamic_energy_ratio,
+            pause_threshold=recognizer.pause_threshold,
+            phrase_threshold=recognizer.phrase_threshold,
+        )
+        settings.update(kwargs)
+        return cls(sample_rate=sample_rate, **settings)
+
+    def reset(self):
+        """Starts a new stream: the sample offsets restart from 0 and there is no speech."""
+        self.n_samples = 0  # samples given to the detector
+        self.in_speech = False  # a "start" event was emitted, and its "end" was not
+        self.onset = None  # the first frame of the speech, or of a burst which is not long enough to be speech yet
+        self.voiced_frames = 0  # voiced frames since ``onset``
+        self.silent_frames = 0  # frames which are not voiced, since the last voiced frame
+        self._pending = np.zeros(0, dtype=np.float32)  # the samples of the incomplete last frame
+
+    @property
+    def n_frames(self) -> int:
+        """The number of complete frames given to the detector."""
+        return self.n_samples // self.frame_length
+
+    def frame_features(self, frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Classifies ``frames``, an array of shape (n_frames, frame_length), and returns the energy of each frame, whether it is loud and whether it is voiced.
+        """
+        energy = np.sqrt(np.einsum("ij,ij->i", frames, frames) / frames.shape[1])
+        loud = energy > self.energy_threshold
+        voiced = energy > self.energy_threshold * self.release_ratio
+        if self.max_zero_crossing_rate is not None:
+            crossings = np.count_nonzero(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+            noisy = crossings > self.max_zero_crossing_rate * (frames.shape[1] - 1)
+            loud &= ~noisy
+            voiced &= ~noisy
+        if self.max_spectral_flatness is not None:
+            power = np.abs(np.fft.rfft(frames, axis=1)) ** 2 + 1e-10
+            flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+            noisy = flatness > self.max_spectral_flatness
+            loud &= ~noisy
+            voiced &= ~noisy
+        return energy, loud, voiced
+
+    def process(self, buffer: Union[bytes, np.ndarray], sample_width: int = 2) -> List[VadEvent]:
+        """
+        Gives the next block of the stream to the detector, raw PCM of ``sample_width`` bytes per sample or an array of samples, and returns the events of the frames it completes.
+        """
+        samples = pcm_samples(buffer, sample_width)
+        first_frame = self.n_frames
+        self.n_samples += len(samples)
+        if len(self._pending):
+            samples = np.concatenate([self._pending, samples])
+        n_frames = len(samples) // self.frame_length
+        self._pending = np.array(samples[n_frames * self.frame_length:], dtype=np.float32)
+        if n_frames == 0:
+            return []
+
+        frames = samples[: n_frames * self.frame_length].reshape(n_frames, self.frame_length).astype(np.float32)
+        energy, loud, voiced = self.frame_features(frames)
+
+        events: List[VadEvent] = []
+        idle_until = n_frames if self.onset is None else 0  # the frames before any speech, to adjust the threshold on
+        i = 0
+        while i < n_frames:
+            if self.onset is None:
+                # waiting for a loud frame
+                loud_frames = np.flatnonzero(loud[i:])
+                if len(loud_frames) == 0:
+                    break
+                i += loud_frames[0]
+                idle_until = min(idle_until, i)
+                self.onset, self.voiced_frames, self.silent_frames = first_frame + i, 0, 0
+
+            # the length of the run of frames which are not voiced ending at each frame, continuing the last block's
+            rest = voiced[i:]
+            positions = np.arange(len(rest))
+            last_voiced = np.maximum.accumulate(np.where(rest, positions, -1))
+            silent_run = positions - last_voiced + np.where(last_voiced < 0, self.silent_frames, 0)
+            voiced_count = self.voiced_frames + np.cumsum(rest)
+
+            pauses = np.flatnonzero(silent_run >= self.pause_frames)
+            end = pauses[0] if len(pauses) else len(rest)  # the speech ends after frame i + end
+            if not self.in_speech:
+                long_enough = np.flatnonzero(voiced_count[:end] >= self.phrase_frames)
+                if len(long_enough):
+                    self.in_speech = True
+                    events.append(VadEvent("start", self.onset * self.frame_length))
+
+            if len(pauses) == 0:
+                self.voiced_frames = int(voiced_count[-1])
+                self.silent_frames = int(silent_run[-1])
+                break
+            if self.in_speech:
+                first_silent_frame = first_frame + i + end - int(silent_run[end]) + 1
+                events.append(VadEvent("end", first_silent_frame * self.frame_length))
+            self.in_speech, self.onset = False, None
+            i += end + 1
+
+        if self.dynamic_energy_threshold and idle_until > 0:
+            # the asymmetric weighted average of ``Recognizer.listen``, over the idle frames in order
+            damping = self.dynamic_energy_adjustment_damping ** (self.frame_length / self.sample_rate)
+            weights = damping ** np.arange(idle_until - 1, -1, -1, dtype=np.float64)
+            target_energy = energy[:idle_until] * self.dynamic_energy_ratio
+            self.energy_threshold = float(self.energy_threshold * damping ** idle_until + (1 - damping) * np.dot(weights, target_energy))
+        return events
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+import types
+
+import numpy as np
+
+import transcription_hub
+from whisper.streaming import StreamingUpdate
+
+IDLE_SECONDS = 2.0
+MAX_IDLE_ITERATIONS = 20    # the loop only wakes up for timers and callbacks, not to poll for audio
+
+
+class FakeSource:
+    SAMPLE_RATE = 16000
+
+
+class FakeRecorder:
+    """Records two short phrases, then stays silent like a connected device nobody speaks into"""
+
+    def listen_in_background(self, source, callback, phrase_time_limit=None):
+        stopped = threading.Event()
+
+        def run():
+            for _ in range(2):
+                time.sleep(0.1)
+                if stopped.is_set():
+                    return
+                audio = np.zeros(1600, dtype=np.int16).tobytes()
+                callback(None, types.SimpleNamespace(get_raw_data=lambda: audio))
+
+        threading.Thread(target=run, daemon=True).start()
+        return lambda wait_for_stop=True: stopped.set()
+
+
+def test_idle_pipeline_does_not_spin(monkeypatch):
+    decodes = 0
+
+    async def process_batched(self, scheduler):
+        nonlocal decodes
+        decodes += 1
+        return StreamingUpdate(committed=f"line {decodes}", partial="")
+
+    monkeypatch.setattr(transcription_hub.StreamingTranscriber, "process_batched", process_batched)
+    monkeypatch.setattr(transcription_hub.DevicePipeline, "_open", lambda self: (FakeSource(), FakeRecorder()))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        iterations = 0
+        run_once = loop._run_once
+
+        def counted_run_once():
+            nonlocal iterations
+            iterations += 1
+            run_once()
+
+        loop._run_once = counted_run_once
+        hub = transcription_hub.TranscriptionHub(None, None, {"language": "en"})
+        subscriber = hub.subscribe(0)
+        events = [(await asyncio.wait_for(subscriber.get(), 5))[1] for _ in range(3)]
+
+        # connected, nobody speaks
+        iterations = 0
+        await asyncio.sleep(IDLE_SECONDS)
+        idle_iterations = iterations
+        hub.unsubscribe(0, subscriber)
+        return events, idle_iterations
+
+    events, idle_iterations = asyncio.run(main())
+
+    assert events[0] == transcription_hub.TRANSCRIPTION_READY
+    assert [event.text for event in events[1:]] == ["line 1", "line 2"]
+    assert decodes == 2
+    assert idle_iterations <= MAX_IDLE_ITERATIONS, f"{idle_iterations} event loop iterations in {IDLE_SECONDS}s of silence"
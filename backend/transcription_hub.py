@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+import speech_recognition as sr
+
+from batch_scheduler import BatchScheduler
+from config import Settings
+from pcm_buffer import PcmRingBuffer
+from whisper.streaming import StreamingTranscriber, StreamingUpdate
+
+TRANSCRIPTION_READY = "Transcription Ready"
+CAPTURE_BUFFER_SECONDS = 30     # how far the transcription may fall behind the capture before audio is skipped
+LATENCY_WINDOW = 256            # the last line revisions whose latency is reported
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SegmentRevision:
+    """One version of a transcription line"""
+    id: int                 # the line's index in the transcription
+    revision: int           # counts the versions of the line, from 1
+    text: str
+    stable: int             # the length of the committed prefix of `text`, the later versions keep it
+    start: float            # the line's audio, in seconds since the capture started
+    end: float
+    final: bool = False     # the line is complete, the next revision starts a new line
+
+
+Event = Union[str, SegmentRevision]     # `TRANSCRIPTION_READY` or a line
+
+
+def is_control(event: Event) -> bool:
+    # the ready event and the completed lines are never dropped
+    return isinstance(event, str) or event.final
+
+
+class Subscriber:
+    """
+    One client of a device's transcription, with its own bounded queue of events.
+
+    When a slow client lets `max_pending` events pile up, the oldest revision of a line is dropped: the revisions
+    after it update the same line, so only the intermediate versions are lost. Control events are kept.
+    Events are numbered as they are published, so a dropped event leaves a gap in the sequence numbers.
+    """
+
+    def __init__(self, max_pending: int = 32):
+        assert isinstance(max_pending, int) and max_pending > 0, "The queue size must be a positive integer"
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.sequence = 0       # the number of the next published event
+        self._pending: Deque[Tuple[int, Event]] = deque()
+        self._ready = asyncio.Event()
+        self._error: Optional[BaseException] = None
+
+    def publish(self, event: Event):
+        if len(self._pending) >= self.max_pending:
+            for index, (_, pending) in enumerate(self._pending):
+                if not is_control(pending):
+                    del self._pending[index]
+                    break
+            else:
+                self._pending.popleft()
+            self.dropped += 1
+        self._pending.append((self.sequence, event))
+        self.sequence += 1
+        self._ready.set()
+
+    def close(self, error: BaseException):
+        """Ends the subscription, `get()` raises `error` once the pending events are consumed"""
+        self._error = error
+        self._ready.set()
+
+    async def get(self) -> Tuple[int, Event]:
+        """Awaits the next event, with its sequence number"""
+        while not self._pending:
+            if self._error is not None:
+                raise self._error
+            self._ready.clear()
+            await self._ready.wait()
+        return self._pending.popleft()
+
+
+class DevicePipeline:
+    """
+    Captures one sound device and transcribes it once, for all of its subscribers.
+
+    The capture (with its ambient noise calibration and listener thread) starts with the first subscriber and
+    stops when the last one leaves. A subscriber joining later receives the ready event and the current line.
+    Each update of the current line is published as a new `SegmentRevision` of it. The latency of each update,
+    from the capture of its last audio to its publication, is kept for the metrics.
+    If the capture or the transcription fails, the error is logged, the subscribers are closed with it and
+    `on_failed` is called with the pipeline.
+    """
+
+    def __init__(
+        self,
+        device: int,
+        open_source: Callable[[int], sr.AudioSource],
+        scheduler: BatchScheduler,
+        streaming_options: dict,
+        on_audio: Optional[Callable[[np.ndarray, int], None]] = None,
+        on_failed: Optional[Callable[["DevicePipeline"], None]] = None,
+    ):
+        self.device = device
+        self.open_source = open_source
+        self.scheduler = scheduler
+        self.streaming_options = streaming_options
+        self.on_audio = on_audio    # called with each new audio fragment and its sample rate, for debugging
+        self.on_failed = on_failed
+
+        self.subscribers: Set[Subscriber] = set()
+        self.transcription: List[str] = ['']
+        self.line: Optional[SegmentRevision] = None     # the last revision of the current line
+        self.ready = False
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)    # seconds, of the last updates
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, max_pending: int = 32) -> Subscriber:
+        subscriber = Subscriber(max_pending)
+        self.subscribers.add(subscriber)
+        if self._task is None:
+            self.transcription = ['']
+            self.line = None
+            self._task = asyncio.ensure_future(self._run())
+        elif self.ready:
+            subscriber.publish(TRANSCRIPTION_READY)
+            if self.line is not None and not self.line.final:
+                subscriber.publish(self.line)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _publish(self, event: Event):
+        for subscriber in self.subscribers:
+            subscriber.publish(event)
+
+    def _publish_line(self, update: StreamingUpdate):
+        line_id = len(self.transcription) - 1
+        revision = self.line.revision + 1 if self.line is not None and self.line.id == line_id else 1
+        self.transcription[-1] = update.text
+        self.line = SegmentRevision(line_id, revision, update.text, update.stable_length, update.start, update.end, update.final)
+        self._publish(self.line)
+
+    def _open(self):
+        recorder = sr.Recognizer()      # We use SpeechRecognizer to record our audio because it has a nice feature where it can detect when speech ends.
+        recorder.energy_threshold = Settings.energy_threshold
+        recorder.dynamic_energy_threshold = False    # Set to True to always record, (Dynamic energy compensation lowers the energy threshold dramatically to a point where the SpeechRecognizer never stops recording.)
+
+        source = self.open_source(self.device)
+        with source:
+            recorder.adjust_for_ambient_noise(source)
+        # The phrases are cut from one continuous stream by the vectorized detector, with the calibrated threshold
+        recorder.vad = sr.VoiceActivityDetector.from_recognizer(recorder, source.SAMPLE_RATE)
+        return source, recorder
+
+    async def _run(self):
+        try:
+            await self._transcribe()
+        except Exception as e:
+            # nobody awaits this task, the error is reported here
+            logger.exception("The transcription of device %s failed", self.device)
+            # the subscribers' connections end with the error
+            for subscriber in self.subscribers:
+                subscriber.close(e)
+            self.subscribers.clear()
+            self._task = None
+            if self.on_failed is not None:
+                self.on_failed(self)
+
+    async def _transcribe(self):
+        loop = asyncio.get_running_loop()
+        # opening the device and calibrating blocks for about a second, off the event loop
+        source, recorder = await loop.run_in_executor(None, self._open)
+        # The recorded audio, written by the recording thread and read by the pipeline without copying.
+        capture = PcmRingBuffer(capacity=CAPTURE_BUFFER_SECONDS * source.SAMPLE_RATE)
+        audio_ready = asyncio.Event()
+
+        def record_callback(_, audio: sr.AudioData) -> None:
+            """
+            Threaded callback function to receive audio data when recordings finish.
+            audio: An AudioData containing the recorded bytes.
+            """
+            # Write the raw bytes to the capture buffer, and wake the pipeline up on the event loop.
+            capture.write(audio.get_raw_data())
+            try:
+                loop.call_soon_threadsafe(audio_ready.set)
+            except RuntimeError:
+                pass    # the event loop was closed while recording, the pipeline is gone
+
+        # Create a background thread that will pass us raw audio bytes.
+        stop_listening = recorder.listen_in_background(source, record_callback, phrase_time_limit=Settings.record_timeout)
+        try:
+            phrase_time = None      # When the last audio read was recorded.
+            cursor = 0              # The first sample not read yet.
+            transcriber = StreamingTranscriber(**self.streaming_options)     # Keeps the audio window and committed text between fragments
+            self.ready = True
+            self._publish(TRANSCRIPTION_READY)
+            while True:
+                await audio_ready.wait()    # Sleeps until the listener records some audio
+                audio_ready.clear()
+                # All the audio recorded since the last read, as float32 samples
+                audio_np, start = capture.read(cursor)
+                cursor = start + len(audio_np)
+                if len(audio_np) == 0:
+                    continue
+
+                # If enough time has passed between recordings, consider the phrase complete.
+                # Clear the current working audio buffer to start over with the new data.
+                phrase_complete = False
+                if phrase_time is not None and capture.time_of(start) - phrase_time > Settings.phrase_timeout:
+                    phrase_complete = True
+                    self._publish_line(transcriber.end_phrase())
+                phrase_time = capture.time_of(cursor - 1)
+
+                if self.on_audio is not None:
+                    self.on_audio(audio_np, source.SAMPLE_RATE)
+
+                # Only the new audio is added, the transcriber decodes it together with the uncommitted audio before it
+                transcriber.insert_audio(audio_np)
+                update = await transcriber.process_batched(self.scheduler)
+
+                # If we detected a pause between recordings, add a new item to our transcription.
+                # Otherwise edit the existing one.
+                if phrase_complete:
+                    self.transcription.append('')
+                self._publish_line(update)
+                self.latencies.append(time.monotonic() - phrase_time)
+        finally:
+            self.ready = False
+            stop_listening(wait_for_stop=False)
+
+
+def latency_percentiles(latencies: Deque[float]) -> Optional[dict]:
+    if not latencies:
+        return None
+    latencies = np.array(latencies) * 1000
+    return {"p50": float(np.percentile(latencies, 50)), "p90": float(np.percentile(latencies, 90)), "max": float(latencies.max())}
+
+
+class TranscriptionHub:
+    """
+    The transcription pipelines by sound device. Each websocket subscribes to the pipeline of its device, so any
+    number of viewers of the same device share one capture and one transcription. A pipeline which fails is
+    removed, the next subscriber of its device starts a new one.
+    """
+
+    def __init__(
+        self,
+        open_source: Callable[[int], sr.AudioSource],
+        scheduler: BatchScheduler,
+        streaming_options: dict,
+        max_pending: int = 32,
+        on_audio: Optional[Callable[[np.ndarray, int], None]] = None,
+    ):
+        self.open_source = open_source
+        self.scheduler = scheduler
+        self.streaming_options = streaming_options
+        self.max_pending = max_pending
+        self.on_audio = on_audio
+        self.pipelines: Dict[int, DevicePipeline] = {}
+
+    def subscribe(self, device: int) -> Subscriber:
+        pipeline = self.pipelines.get(device)
+        if pipeline is None:
+            pipeline = DevicePipeline(device, self.open_source, self.scheduler, self.streaming_options, self.on_audio, self._remove)
+            self.pipelines[device] = pipeline
+        return pipeline.subscribe(self.max_pending)
+
+    def _remove(self, pipeline: DevicePipeline):
+        if self.pipelines.get(pipeline.device) is pipeline:
+            del self.pipelines[pipeline.device]
+
+    def unsubscribe(self, device: int, subscriber: Subscriber):
+        pipeline = self.pipelines.get(device)
+        if pipeline is not None:
+            pipeline.unsubscribe(subscriber)
+
+    def transcription(self, device: int) -> List[str]:
+        pipeline = self.pipelines.get(device)
+        return pipeline.transcription if pipeline is not None else ['']
+
+    def stats(self) -> dict:
+        return {
+            device: {
+                "ready": pipeline.ready,
+                "subscribers": len(pipeline.subscribers),
+                "dropped": sum(subscriber.dropped for subscriber in pipeline.subscribers),
+                "latency_ms": latency_percentiles(pipeline.latencies),
+            }
+            for device, pipeline in self.pipelines.items()
+        }
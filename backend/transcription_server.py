@@ -3,114 +3,20 @@ from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 from config import Settings
 
 # Transription Imports
+import asyncio
 import os
+from typing import Optional, Union
 import numpy as np
 import speech_recognition as sr
-from whisper.transcribe import transcribe
-from whisper.model import load_model
+from model_registry import ModelRegistry
+from inference_executor import InferenceExecutor
+from batch_scheduler import BatchScheduler
+from transcription_hub import TranscriptionHub
+from feed_protocol import PROTOCOL_VERSIONS, FeedEncoder, negotiate_encoding
 import pyaudiowpatch as pyaudio
 
-import audioop
-
-class AudioBridge(sr.AudioSource):
-    """
-    Capture audio from speakers(via loopback, on Windows)
-    """
-    format = pyaudio.paInt16  # 16-bit int sampling
-
-    def __init__(self, device_index=None, sample_rate=None, chunk_size=1024):
-        assert device_index is None or isinstance(device_index, int), "Device index must be None or an integer"
-        assert sample_rate is None or (isinstance(sample_rate, int) and sample_rate > 0), "Sample rate must be None or a positive integer"
-        assert isinstance(chunk_size, int) and chunk_size > 0, "Chunk size must be a positive integer"
-
-        # set up PyAudio
-        self.pyaudio_module = self.get_pyaudio()
-        audio = self.pyaudio_module.PyAudio()
-        try:
-            count = audio.get_device_count()  # obtain device count
-            if device_index is not None:  # ensure device index is in range
-                assert 0 <= device_index < count, "Device index out of range ({} devices available; device index should be between 0 and {} inclusive)".format(count, count - 1)
-
-            device_info = None
-            if device_index is not None:
-                device_info = audio.get_device_info_by_index(device_index)
-                assert device_info.get("isLoopbackDevice", False), f"Device with index {device_index} is not a loopback"
-            else:
-                default_speaker = audio.get_default_output_device_info()
-                for loopback in audio.get_loopback_device_info_generator():
-                    if loopback["name"].startswith(default_speaker["name"]):
-                        device_info = loopback
-                        break
-
-                assert device_info is not None, "Unable to find loopback for default speakers"
-                device_index = device_info["index"]
-
-            if sample_rate is None:  # automatically set the sample rate to the hardware's default sample rate if not specified
-                assert isinstance(device_info.get("defaultSampleRate"), (float, int)) and device_info["defaultSampleRate"] > 0, "Invalid device info returned from PyAudio: {}".format(device_info)
-                sample_rate = int(device_info["defaultSampleRate"])
-
-            channels = device_info["maxInputChannels"]
-        finally:
-            audio.terminate()
-
-        self.device_index = device_index
-        self.channels = channels
-        self.SAMPLE_WIDTH = self.pyaudio_module.get_sample_size(self.format)  # size of each sample
-        self.SAMPLE_RATE = sample_rate  # sampling rate in Hertz
-        self.CHUNK = chunk_size  # number of frames stored in each buffer
-
-        self.audio = None
-        self.stream = None
-
-    def __enter__(self):
-        assert self.stream is None, "This audio source is already inside a context manager"
-        self.audio = self.pyaudio_module.PyAudio()
-        try:
-            self.stream = self.LoopbackStream(
-                self.audio.open(
-                    input_device_index=self.device_index, channels=self.channels, format=self.format,
-                    rate=self.SAMPLE_RATE, frames_per_buffer=self.CHUNK, input=True,
-                )
-            )
-        except Exception:
-            self.audio.terminate()
-
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        try:
-            self.stream.close()
-        finally:
-            self.stream = None
-            self.audio.terminate()
-
-    @staticmethod
-    def get_pyaudio():
-        return pyaudio
-
-    class LoopbackStream(object):
-        def __init__(self, pyaudio_stream):
-            self.pyaudio_stream = pyaudio_stream
-
-        def read(self, size):
-            return audioop.tomono(
-                self.pyaudio_stream.read(size, exception_on_overflow=False),
-                AudioBridge.get_pyaudio().get_sample_size(AudioBridge.format),
-                1, 1
-            )
-
-        def close(self):
-            try:
-                # sometimes, if the stream isn't stopped, closing the stream throws an exception
-                if not self.pyaudio_stream.is_stopped():
-                    self.pyaudio_stream.stop_stream()
-            finally:
-                self.pyaudio_stream.close()
-
-from datetime import datetime, timedelta
-from queue import Queue
-from time import sleep
-import asyncio
+from AudioBridge import AudioBridge
+from replay_source import ReplayAudioSource
 
 # Debug Imports
 import uuid
@@ -151,141 +57,175 @@ decoder_target: str = Settings.decoder_target
 
 debug_enabled = Settings.ENV == "development"
 debug_enabled = False
-transcription = ['']
+
+# Note: Arguments are hard-coded as the model does not fully support alternative options.
+TRANSCRIBE_OPTIONS = dict(
+    temperature=[0],
+    task = "transcribe",
+    language = 'en',
+    verbose=False,
+    best_of = 5,
+    beam_size = 5,
+    patience = None,
+    length_penalty = 0.08,
+    suppress_tokens = "-1",
+    initial_prompt = None,
+    condition_on_previous_text = None,
+    compression_ratio_threshold = 2.4,
+    logprob_threshold = -1,
+    no_speech_threshold = 0.6
+)
+
+# The live feed decodes incrementally with the same options, see `StreamingTranscriber`
+STREAMING_OPTIONS = dict(
+    task = "transcribe",
+    language = 'en',
+    beam_size = 5,
+    patience = None,
+    length_penalty = 0.08,
+    suppress_tokens = "-1",
+    logprob_threshold = -1,
+    no_speech_threshold = 0.6
+)
+
+model_registry = ModelRegistry(Settings.model_name, onnx_encoder_path, onnx_decoder_path, encoder_target, decoder_target,
+                               capacity=Settings.model_pool_size)
+# Decodes run on worker threads, never on the event loop serving every websocket and HTTP route
+inference_executor = InferenceExecutor(model_registry)
+# The live sessions' decodes are batched together instead of each taking a worker
+batch_scheduler = BatchScheduler(inference_executor, max_latency=Settings.batch_latency_ms / 1000, max_batch_size=Settings.max_batch_size)
+
+def load_models():
+    """
+    Loads the shared model pool, called once on app startup.
+    """
+    model_registry.load(warmup_options=TRANSCRIBE_OPTIONS)
+
+def open_audio_source(device_index: int) -> sr.AudioSource:
+    if Settings.replay_audio:
+        # A simulated speaker per device index, each from its own file of the manifest and with its own jitter
+        return ReplayAudioSource(Settings.replay_audio, speed=Settings.replay_speed, jitter=Settings.replay_jitter_ms / 1000,
+                                 start=device_index, seed=device_index, sample_rate=16000)
+    audio = pyaudio.PyAudio()
+    try:
+        is_loopback = "Loopback" in audio.get_device_info_by_index(device_index)["name"]
+    finally:
+        audio.terminate()
+
+    # Every source delivers the 16 kHz mono the model takes, resampled from the device's rate
+    if is_loopback:
+        # Note: Loopback interfaces do not support sample_rates (https://github.com/s0d3s/PyAudioWPatch/issues/15#issuecomment-2025114713)
+        return AudioBridge(device_index=device_index, sample_rate=16000)
+    return sr.Microphone(sample_rate=16000)
+
+
+def save_pipeline_audio(audio_np, sample_rate):
+    save_debug_audio(audio_np, sample_rate, debug_folder)    # Save the audio_np array to a .wav file for debugging
+
+
+debug_folder = uuid.uuid4().hex     # UUID Folder name for storing debug audio files
+# One capture and transcription per sound device, shared by every websocket watching it
+transcription_hub = TranscriptionHub(open_audio_source, batch_scheduler, STREAMING_OPTIONS, max_pending=Settings.subscriber_queue_size,
+                                     on_audio=save_pipeline_audio if debug_enabled else None)
+
+@transcribe_api.get("/transcription/metrics")
+def get_transcription_metrics():
+    return {"models": model_registry.stats(), "inference": inference_executor.metrics(), "batching": batch_scheduler.metrics(),
+            "pipelines": transcription_hub.stats()}
 
 @transcribe_api.get("/transcription")
 def get_transcription():
-    return transcription
+    return transcription_hub.transcription(Settings.SOUND_DEVICE)
 
 @transcribe_api.websocket("/transcription_feed")
-async def transcription_ws_endpoint(websocket: WebSocket):
-    # await manager.connect(websocket)
-    await websocket.accept()
-    active_connections_set.add(websocket)
-    
-    phrase_time = None      # The last time a recording was retrieved from the queue.
-    data_queue = Queue()    # Thread safe Queue for passing data from the threaded recording callback.
-    recorder = sr.Recognizer()      # We use SpeechRecognizer to record our audio because it has a nice feature where it can detect when speech ends.
-    recorder.energy_threshold = Settings.energy_threshold
-    record_timeout = Settings.record_timeout
-    phrase_timeout = Settings.phrase_timeout   
-    recorder.dynamic_energy_threshold = False    # Set to True to always record, (Dynamic energy compensation lowers the energy threshold dramatically to a point where the SpeechRecognizer never stops recording.)
-    
-    audio = pyaudio.PyAudio()  
-    mic = Settings.SOUND_DEVICE
-    
-    if "Loopback" in audio.get_device_info_by_index(mic)["name"]:
-        # Note: Loopback interfaces do not support sample_rates (https://github.com/s0d3s/PyAudioWPatch/issues/15#issuecomment-2025114713)
-        source = AudioBridge(device_index=mic)
-    else:
-        source = sr.Microphone(sample_rate=16000)
+async def transcription_ws_endpoint(websocket: WebSocket, version: int = 1, device: Optional[int] = None):
+    """
+    Streams the transcription of the sound device, in the feed protocol `version` (see `FeedEncoder`), e.g.
+    `/transcription_feed?version=3` with the websocket subprotocol "msgpack" or "json" for the subtitle segments.
+    `device` selects another sound device than `Settings.SOUND_DEVICE`; with `Settings.replay_audio`, each device
+    index is a simulated speaker, so N clients with `device=0..N-1` load test N live pipelines.
 
-    
+    From version 2, a `{"type": "ping", "id": n}` is sent every `Settings.ping_interval` seconds, the client
+    answers with `{"type": "pong", "id": n}` within `Settings.ping_timeout` seconds or the connection is closed.
 
-    with source:
-        recorder.adjust_for_ambient_noise(source)
-
-    def record_callback(_, audio:sr.AudioData) -> None:
-        """
-        Threaded callback function to receive audio data when recordings finish.
-        audio: An AudioData containing the recorded bytes.
-        """
-        # Grab the raw bytes and push it into the thread safe queue.
-        data = audio.get_raw_data()
-        data_queue.put(data)
-
-    # Create a background thread that will pass us raw audio bytes.
-    # We could do this manually but SpeechRecognizer provides a nice helper.
-    recorder.listen_in_background(source, record_callback, phrase_time_limit=record_timeout)
-    
-    try:        
-        if debug_enabled:
-            debug_folder = uuid.uuid4().hex     # UUID Folder name for storing debug audio files
-        transcription = ['']
-        
-        model = load_model('tiny', onnx_encoder_path, onnx_decoder_path, encoder_target, decoder_target)
-        await websocket.send_text("Transcription Ready")
-        while True:
-            now = datetime.utcnow()
-            
-            # Pull raw recorded audio from the queue.
-            if not data_queue.empty():
-                phrase_complete = False
-
-                # If enough time has passed between recordings, consider the phrase complete.
-                # Due to model limitations, the timeout is set to 10 seconds as the model becomes less accurate.
-                # Clear the current working audio buffer to start over with the new data.
-                print("Transcribing something new")
-                if phrase_time and now - phrase_time > timedelta(seconds=phrase_timeout):
-                    phrase_complete = True
-                    print("PHRASE COMPLETE")
-                    await websocket.send_text("[PHRASE_COMPLETE]")
-                    print("Websocket sent phrase complete")
-
-                phrase_time = now   # Last time new audio data was received from the queue.
-                
-                audio_data = b''.join(data_queue.queue)     # Combine audio data from queue
-                data_queue.queue.clear()
-                
-                # Convert in-ram buffer to something the model can use directly without needing a temp file.
-                # Convert data from 16 bit wide integers to floating point with a width of 32 bits.
-                # Clamp the audio stream frequency to a PCM wavelength compatible default of 32768hz max.
-                audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
-
-                if debug_enabled:
-                    save_debug_audio(audio_np, source.SAMPLE_RATE, debug_folder)    # Save the audio_np array to a .wav file for debugging
-
-                # Note: Arguments are hard-coded as the model does not fully support alternative options.
-                result = transcribe(model=model, 
-                                    audio=audio_np, 
-                                    temperature=[0],
-                                    task = "transcribe",
-                                    language = 'en',
-                                    verbose=False,
-                                    best_of = 5,
-                                    beam_size = 5,
-                                    patience = None,
-                                    length_penalty = 0.08,
-                                    suppress_tokens = "-1",
-                                    initial_prompt = None,
-                                    condition_on_previous_text = None,
-                                    compression_ratio_threshold = 2.4,
-                                    logprob_threshold = -1,
-                                    no_speech_threshold = 0.6
-                                    )
-                text = result['text'].strip()
-
-                # If we detected a pause between recordings, add a new item to our transcription.
-                # Otherwise edit the existing one.
-                if phrase_complete:
-                    transcription.append(text)
-                else:
-                    transcription[-1] = text
-
-                # Send the latest transcription line to the client.
-                await websocket.send_text(transcription[-1])
-                
-                # This call is necessary, if the client disconnects without sending a close handshake, 
-                # the server will never realise the client has disconnected and will continue to run.
-                ack = await websocket.receive_text() # Wait for the client to acknowledge the transcription.
+    Updates are never acknowledged: messages from the client are read on their own, so the feed only waits for
+    the transcription, and a client which stopped reading only loses lines of its own queue.
+    """
+    if version not in PROTOCOL_VERSIONS:
+        await websocket.close(code=1008)
+        return
+    encoding = negotiate_encoding(websocket.scope.get("subprotocols", []))
+    await websocket.accept(subprotocol=encoding)
+    active_connections_set.add(websocket)
+    encoder = FeedEncoder(version, encoding)
+    device = Settings.SOUND_DEVICE if device is None else device
+    # The websocket only relays the device pipeline's events, see `DevicePipeline`
+    subscriber = transcription_hub.subscribe(device)
+    send_lock = asyncio.Lock()  # the events and the pings are sent by different tasks
+    pongs = {}                  # ping id -> event set when its pong arrives
+
+    async def send(message: Union[str, bytes]):
+        async with send_lock:
+            if isinstance(message, bytes):
+                await websocket.send_bytes(message)
             else:
-                asyncio.sleep(600)  # Infinite loops are bad for processors, must sleep.
+                await websocket.send_text(message)
+
+    async def send_events():
+        while True:
+            try:
+                seq, event = await subscriber.get()
+            except Exception:
+                # the device pipeline failed, the hub has logged the error once for all its subscribers
+                print("Transcription pipeline failed, closing the connection")
+                await websocket.close(code=1011)
+                return
+            await send(encoder.encode(seq, event))
+
+    async def receive():
+        # Reading is also how a client disconnecting without a close handshake is noticed.
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if version < 2:
+                continue    # acks of protocol version 1
+            message = encoder.decode(message["text"] if message.get("text") is not None else message.get("bytes", b""))
+            if message is not None and message.get("type") == "pong" and message.get("id") in pongs:
+                pongs[message["id"]].set()
+
+    async def keepalive():
+        ping_id = 0
+        while True:
+            await asyncio.sleep(Settings.ping_interval)
+            pongs[ping_id] = asyncio.Event()
+            await send(encoder.ping(ping_id))
+            try:
+                await asyncio.wait_for(pongs[ping_id].wait(), Settings.ping_timeout)
+            except asyncio.TimeoutError:
+                print("Client did not answer the ping")
+                await websocket.close(code=1011)
+                return
+            finally:
+                del pongs[ping_id]
+            ping_id += 1
+
+    tasks = [asyncio.ensure_future(send_events()), asyncio.ensure_future(receive())]
+    if version >= 2:
+        tasks.append(asyncio.ensure_future(keepalive()))
+    try:
+        # The connection ends with the first task which does: the client left, or the pipeline failed
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
     except WebSocketDisconnect:
-        websocket.close()
         print("Client disconnected Normally")
-        print("\n\nTranscription:")
-        for line in transcription:
-            print(line)
-        return
     except RuntimeError:
         print("Client disconnected via RuntimeError")
-        print("\n\nTranscription:")
-        for line in transcription:
-            print(line)
-        return
     except IOError:
         print("Client disconnected via IOError")
-        print("\n\nTranscription:")
-        for line in transcription:
-            print(line)
-    
\ No newline at end of file
+    finally:
+        for task in tasks:
+            task.cancel()
+        transcription_hub.unsubscribe(device, subscriber)
+        active_connections_set.discard(websocket)
@@ -1,6 +1,6 @@
 import os
 from functools import lru_cache
-from typing import Union
+from typing import Iterator, Tuple, Union
 
 import ffmpeg
 import numpy as np
@@ -15,6 +15,7 @@ HOP_LENGTH = 160
 CHUNK_LENGTH = 10.24
 N_SAMPLES = int(CHUNK_LENGTH * SAMPLE_RATE)  # 480000: number of samples in a chunk
 N_FRAMES = exact_div(N_SAMPLES, HOP_LENGTH)  # 3000: number of frames in a mel spectrogram input
+STFT_BLOCK_FRAMES = 256  # frames transformed at a time by log_mel_frames
 
 
 def load_audio(file: str, sr: int = SAMPLE_RATE):
@@ -47,6 +48,50 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
 
 
+def load_audio_chunks(file: str, chunk_length: float = CHUNK_LENGTH / 2, sr: int = SAMPLE_RATE) -> Iterator[np.ndarray]:
+    """
+    Open an audio file like `load_audio`, but yield the waveform in chunks as ffmpeg decodes it,
+    so that a long file is never held in memory as a whole
+
+    Parameters
+    ----------
+    file: str
+        The audio file to open
+
+    chunk_length: float
+        The duration of the chunks in seconds, the last one may be shorter
+
+    sr: int
+        The sample rate to resample the audio if necessary
+
+    Returns
+    -------
+    An iterator of NumPy arrays containing the consecutive parts of the audio waveform, in float32 dtype.
+    """
+    process = (
+        ffmpeg.input(file, threads=0)
+        .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=sr)
+        .global_args("-nostdin", "-loglevel", "error")     # keeps stderr short, it is only read at the end
+        .run_async(cmd="ffmpeg", pipe_stdout=True, pipe_stderr=True)
+    )
+    chunk_bytes = 2 * max(1, int(chunk_length * sr))
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if len(data) < 2:
+                break
+            yield np.frombuffer(data[: len(data) // 2 * 2], np.int16).astype(np.float32) / 32768.0
+        process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(f"Failed to load audio: {process.stderr.read().decode()}")
+    finally:
+        if process.poll() is None:
+            process.kill()      # the chunks were not all read
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
 def pad_or_trim(array: np.ndarray, length: int = N_SAMPLES, *, axis: int = -1):
     """
     Pad or trim the audio array to N_SAMPLES, as expected by the encoder.
@@ -83,19 +128,71 @@ def sliding_window_view(x, window_shape, step=1):
     return np.lib.stride_tricks.as_strided(x, shape=shape, strides=strides)
 
 
-def numpy_stft(audio: np.ndarray, N_FFT: int, HOP_LENGTH: int):
-    window = np.hanning(N_FFT)
-    num_frames = 1 + (audio.size - N_FFT) // HOP_LENGTH
-    if (audio.size - N_FFT) % HOP_LENGTH > 0:
-        num_frames += 1
-    audio_padded = np.pad(audio, pad_width=(N_FFT//2, N_FFT//2), mode='constant')
-    frames = sliding_window_view(audio_padded, N_FFT, HOP_LENGTH)
-    frames = frames[:num_frames]
-    stft = np.fft.rfft(frames * window, axis=-1)
+@lru_cache(maxsize=None)
+def hann_window(n_fft: int = N_FFT) -> np.ndarray:
+    """The float32 Hann window of the STFT, computed once"""
+    window = np.hanning(n_fft).astype(np.float32)
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache(maxsize=None)
+def mel_filter_blocks(n_mels: int = N_MELS, block_size: int = 4) -> Tuple[Tuple[slice, slice, np.ndarray], ...]:
+    """
+    The mel filterbank as a banded operator: each filter is only non-zero over a few neighbouring frequency bins,
+    so the filters are grouped in blocks of `block_size` and each block is applied to the bins it covers only.
+    Returns (filters, bins, weights) tuples, where `weights` is `mel_filters(n_mels)[filters, bins]`.
+    """
+    filters = mel_filters(n_mels)
+    blocks = []
+    for start in range(0, n_mels, block_size):
+        rows = slice(start, min(start + block_size, n_mels))
+        nonzero = np.flatnonzero(filters[rows].any(axis=0))
+        bins = slice(nonzero[0], nonzero[-1] + 1) if len(nonzero) else slice(0, 0)
+        weights = np.ascontiguousarray(filters[rows, bins])
+        weights.flags.writeable = False
+        blocks.append((rows, bins, weights))
+    return tuple(blocks)
+
+
+def log_mel_frames(frames: np.ndarray, n_mels: int = N_MELS, out: np.ndarray = None) -> np.ndarray:
+    """
+    Compute the log10 Mel spectrogram of STFT frames, without the normalization of `log_mel_spectrogram`
+
+    Parameters
+    ----------
+    frames: np.ndarray, shape = (n_frames, N_FFT)
+        The float32 audio frames, before windowing
+
+    out: np.ndarray, shape = (n_mels, n_frames)
+        A float32 array to write the spectrogram into
+
+    Returns
+    -------
+    np.ndarray, shape = (n_mels, n_frames)
+        The spectrogram, `out` if given
+    """
+    if out is None:
+        out = np.empty((n_mels, len(frames)), dtype=np.float32)
+    window = hann_window(frames.shape[-1])
+    blocks = mel_filter_blocks(n_mels)
+
+    # a block of frames at a time, so the intermediate arrays stay in the CPU caches
+    for start in range(0, len(frames), STFT_BLOCK_FRAMES):
+        block = frames[start:start + STFT_BLOCK_FRAMES]
+        # NumPy's FFT plans are cached by the transform size; before NumPy 2 the transform runs in float64
+        stft = np.fft.rfft(block * window, axis=-1)
+        power = stft.view(stft.real.dtype).astype(np.float32)
+        power *= power
+        power = power[:, 0::2] + power[:, 1::2]
+
+        mel_spec = out[:, start:start + len(block)]
+        for rows, bins, weights in blocks:
+            np.matmul(weights, power[:, bins].T, out=mel_spec[rows])
 
-    cpstft = (np.abs(stft[:,:N_FFT//2 + 1]) ** 2).T
-    magnitudes = cpstft.astype(audio.dtype)
-    return magnitudes
+    np.maximum(out, 1e-10, out=out)
+    np.log10(out, out=out)
+    return out
 
 
 def log_mel_spectrogram(audio: Union[str, np.ndarray], n_mels: int = N_MELS):
@@ -104,26 +201,150 @@ def log_mel_spectrogram(audio: Union[str, np.ndarray], n_mels: int = N_MELS):
 
     Parameters
     ----------
-    audio: Union[str, np.ndarray], shape = (*)
-        The path to audio or either a NumPy array containing the audio waveform in 16 kHz
+    audio: Union[str, np.ndarray], shape = (*, n_samples)
+        The path to audio or either a NumPy array containing the audio waveform in 16 kHz,
+        or a batch of waveforms of the same length
 
     n_mels: int
         The number of Mel-frequency filters, only 80 is supported
 
     Returns
     -------
-    np.ndarray, shape = (80, n_frames)
+    np.ndarray, shape = (*, 80, n_frames)
         A Tensor that contains the Mel spectrogram
     """
     if isinstance(audio, str):
         audio = load_audio(audio)
+    audio = np.asarray(audio, dtype=np.float32)
 
-    magnitudes = numpy_stft(audio, N_FFT, HOP_LENGTH)
+    n_frames = num_frames(audio.shape[-1])
+    pad_widths = [(0, 0)] * (audio.ndim - 1) + [(N_FFT // 2, N_FFT // 2)]
+    audio_padded = np.pad(audio, pad_widths, mode='constant')
+    frames = np.lib.stride_tricks.sliding_window_view(audio_padded, N_FFT, axis=-1)[..., :n_frames * HOP_LENGTH:HOP_LENGTH, :]
 
-    filters = mel_filters(n_mels)
-    mel_spec = filters @ magnitudes
+    log_spec = np.empty(audio.shape[:-1] + (n_mels, n_frames), dtype=np.float32)
+    for index in np.ndindex(audio.shape[:-1]):
+        log_mel_frames(frames[index], n_mels, out=log_spec[index])
 
-    log_spec = np.log10(np.clip(mel_spec, a_min=1e-10, a_max=None))
-    log_spec = np.maximum(log_spec, np.max(log_spec) - 8.0)
-    log_spec = (log_spec + 4.0) / 4.0
+    np.maximum(log_spec, log_spec.max(axis=(-2, -1), keepdims=True) - 8.0, out=log_spec)
+    log_spec += 4.0
+    log_spec /= 4.0
     return log_spec
+
+
+def num_frames(n_samples: int) -> int:
+    """The number of STFT frames `log_mel_spectrogram` computes for `n_samples` samples"""
+    return max(0, 1 - (N_FFT - n_samples) // HOP_LENGTH)
+
+
+class IncrementalLogMel:
+    """
+    Log-Mel spectrogram of an audio stream, computed as the audio is pushed.
+
+    A STFT frame is computed once, when all of its samples were pushed: the samples which the next frames overlap
+    with are carried over between pushes, so each push costs O(new samples). The log-Mel frames are kept in a ring
+    buffer of the last `capacity` frames. The frames reaching into the zero padding at the end of the stream are
+    only computed when the spectrogram is read, so `log_mel(0, num_frames(n))` is `log_mel_spectrogram(audio[:n])`
+    of the first n samples pushed.
+    """
+
+    def __init__(self, capacity: int = 2 * N_FRAMES, n_mels: int = N_MELS):
+        self.capacity = capacity
+        self.n_mels = n_mels
+
+        # frame i is stored at columns i % capacity and i % capacity + capacity,
+        # so any run of up to `capacity` frames is a contiguous slice
+        self.frames = np.zeros((n_mels, 2 * capacity), dtype=np.float32)
+        self.frame_max = np.zeros(2 * capacity, dtype=np.float32)
+        self.reset()
+
+    def reset(self):
+        self.n_samples = 0
+        self.n_computed = 0  # frames computed so far
+        # the samples from the first sample of frame `n_computed` on, starting with the zero padding of the stream
+        self.pending = np.zeros(N_FFT // 2, dtype=np.float32)
+
+    @property
+    def n_frames(self) -> int:
+        """The number of frames of the audio pushed so far"""
+        return num_frames(self.n_samples)
+
+    @property
+    def first_frame(self) -> int:
+        """The oldest frame still in the ring buffer"""
+        return max(0, self.n_computed - self.capacity)
+
+    def push(self, audio: np.ndarray):
+        """Appends float32 PCM sampled at 16 kHz to the stream"""
+        audio = np.asarray(audio, dtype=np.float32)
+        self.pending = np.concatenate([self.pending, audio])
+        self.n_samples += len(audio)
+
+        n_new = (len(self.pending) - N_FFT) // HOP_LENGTH + 1
+        if n_new <= 0:
+            return
+        frames = sliding_window_view(self.pending, N_FFT, HOP_LENGTH)[:n_new]
+        if n_new > self.capacity:
+            # only the last `capacity` frames would be kept
+            frames = frames[n_new - self.capacity:]
+            self.n_computed += n_new - self.capacity
+        self._store(log_mel_frames(frames, self.n_mels))
+        self.pending = self.pending[n_new * HOP_LENGTH:]
+
+    def log_mel(self, start: int, stop: int, out: np.ndarray = None, length: int = N_FRAMES, normalize: bool = True) -> np.ndarray:
+        """
+        The normalized log-Mel spectrogram of the frames [start, stop), padded with zeros to `length` frames
+        like `pad_or_trim(log_mel_spectrogram(audio), length)`.
+
+        Parameters
+        ----------
+        start, stop: int
+            The frames to return, counted from the start of the stream, `first_frame <= start <= stop <= n_frames`
+
+        out: np.ndarray, shape = (n_mels, length)
+            A float32 buffer to write the spectrogram into, so that no new array is allocated
+
+        normalize: bool
+            If False, the log10 Mel frames of `log_mel_frames` are returned as they are, padded with the
+            log10 of silence, e.g. for a speech detector which needs their absolute level
+
+        Returns
+        -------
+        np.ndarray, shape = (n_mels, length)
+            The spectrogram, `out` if given
+        """
+        assert self.first_frame <= start <= stop <= self.n_frames, f"Frames [{start}, {stop}) are not available"
+        assert stop - start <= length, f"{stop - start} frames do not fit in {length}"
+        if out is None:
+            out = np.empty((self.n_mels, length), dtype=np.float32)
+
+        n_stored = max(0, min(stop, self.n_computed) - start)
+        log_spec = out[:, :stop - start]
+        peak = np.float32(-np.inf)
+        if n_stored > 0:
+            begin = start % self.capacity
+            log_spec[:, :n_stored] = self.frames[:, begin:begin + n_stored]
+            peak = self.frame_max[begin:begin + n_stored].max()
+        if stop - start > n_stored:
+            # frames reaching into the zero padding at the end of the stream
+            first = start + n_stored - self.n_computed
+            padded = np.concatenate([self.pending, np.zeros(N_FFT, dtype=np.float32)])
+            frames = sliding_window_view(padded, N_FFT, HOP_LENGTH)[first:first + stop - start - n_stored]
+            log_mel_frames(frames, self.n_mels, out=log_spec[:, n_stored:])
+            peak = max(peak, log_spec[:, n_stored:].max())
+        if not normalize:
+            out[:, stop - start:] = np.log10(np.float32(1e-10))
+            return out
+
+        np.maximum(log_spec, peak - 8.0, out=log_spec)
+        log_spec += 4.0
+        log_spec /= 4.0
+        out[:, stop - start:] = 0
+        return out
+
+    def _store(self, log_spec: np.ndarray):
+        columns = (self.n_computed + np.arange(log_spec.shape[1])) % self.capacity
+        for offset in (0, self.capacity):
+            self.frames[:, columns + offset] = log_spec
+            self.frame_max[columns + offset] = log_spec.max(axis=0)
+        self.n_computed += log_spec.shape[1]
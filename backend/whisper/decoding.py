@@ -1,4 +1,5 @@
-from dataclasses import dataclass, field
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 from typing import Dict, List, Tuple, Iterable, Optional, Sequence, Union, TYPE_CHECKING
 
 import numpy as np
@@ -20,16 +21,25 @@ if WITHOUT_TIMESTAMPS:
 else:
    sot_l = 3
 
+# write each step's key/value rows into a circular kv cache, instead of shifting the whole cache by one row
+RING_KV_CACHE = True
+# run the decoder through an ORT IOBinding with preallocated outputs, binding the audio features once per decode
+IO_BINDING = True
+# number of prepared DecodingTasks kept per model instance, see `get_decoding_task`
+DECODING_TASK_CACHE_SIZE = 8
+
 def softmax(x, dim=-1):
     e_x = np.exp(x - np.max(x, axis=dim, keepdims=True))
     return e_x / (np.sum(e_x, axis=dim, keepdims=True))
 
 def log_softmax(x, dim=-1):
-    y = softmax(x, dim=dim)
-    return np.log(y)
+    # x - logsumexp(x), without forming the softmax first
+    y = x - np.max(x, axis=dim, keepdims=True)
+    y -= np.log(np.sum(np.exp(y), axis=dim, keepdims=True))
+    return y
 
 def numpy_categorical_sample(logits, temperature):
-    logits /= temperature
+    logits = logits / temperature
     probs = softmax(logits, dim=-1)
     return np.array([np.random.choice(len(p), p=p) for p in probs])
 
@@ -114,6 +124,13 @@ class DecodingOptions:
     without_timestamps: bool = WITHOUT_TIMESTAMPS              # use <|notimestamps|> to sample text tokens only
     max_initial_timestamp: Optional[float] = 0.0  # the initial timestamp cannot be later than this
 
+    def __post_init__(self):
+        # token lists are stored as tuples so the options are hashable, they key the DecodingTask cache
+        for name in ("prompt", "prefix", "suppress_tokens"):
+            value = getattr(self, name)
+            if value is not None and not isinstance(value, (str, tuple)):
+                object.__setattr__(self, name, tuple(int(t) for t in value))
+
 
 @dataclass(frozen=True)
 class DecodingResult:
@@ -131,8 +148,11 @@ class DecodingResult:
 
 
 class Inference:
-    def logits(self, tokens: np.ndarray, audio_features: np.ndarray) -> np.ndarray:
-        """Perform a forward pass on the decoder and return per-token logits"""
+    def logits(self, tokens: np.ndarray, audio_features: np.ndarray, sot_indices: Optional[np.ndarray] = None) -> np.ndarray:
+        """Perform a forward pass on the decoder and return per-token logits
+
+        On the first pass, the logits at the positions `sot_indices` (one per row) are kept in `sot_logits`
+        """
         raise NotImplementedError
 
     def rearrange_kv_cache(self, source_indices) -> None:
@@ -145,68 +165,143 @@ class Inference:
 
 
 class OnnxInference(Inference):
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(self, model: "Whisper", initial_token_length: int, ring_kv_cache: bool = RING_KV_CACHE, io_binding: bool = IO_BINDING):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
         self.kv_cache = None
         self.n_t_ctx =  self.model.dims.n_text_ctx
-        self.mask = np.full((self.n_t_ctx, self.n_t_ctx), -np.inf)
-        self.mask[np.tril_indices(self.n_t_ctx, k=0)] = 0
-        self.pe = np.load("./tiny_pe.npy")
+        # read-only templates shared by every decode of the model
+        self.mask = model.causal_mask
+        self.pe = model.positional_embedding
         self.offset = None
 
-    def logits(self, tokens: np.ndarray, audio_features: np.ndarray) -> np.ndarray:
+        # In ring mode the kv cache slots are written in turn and never moved. Attention doesn't depend on the
+        # order of the cached slots (positions are already added through `pe`), so the mask only has to expose
+        # the slots written so far; `ring_mask` is updated one column per step.
+        self.ring_kv_cache = ring_kv_cache
+        self.ring_mask = None
+        self.ring_mask_template = None
+        self.write_index = 0
+
+        self.io_binding = io_binding
+        self.decoder_binding = None
+
+        # the logits at <|startoftranscript|>, for the no-speech probability; the prefill passes see it when
+        # the prompt and prefix push it out of the last query window
+        self.sot_indices = None
+        self.sot_logits = None
+
+    def logits(self, tokens: np.ndarray, audio_features: np.ndarray, sot_indices: Optional[np.ndarray] = None) -> np.ndarray:
         n_group = tokens.shape[0]
+        decoder_time = 0
         # print("token shape: ", tokens.shape)
         if self.kv_cache is None:
             self.kv_cache = self.model.new_kv_cache(n_group, self.initial_token_length)
-            offset = 0
-            length = self.initial_token_length
-        else:
-            # offset = self.kv_cache.shape[2]
-            offset = self.offset
-            length = offset + 1
-            # new_kv_cache = self.model.new_kv_cache(n_group, offset + 1)
-            # new_kv_cache[:, :, :offset, :] = self.kv_cache # Since hard code of model.new_kv_cache
-            # self.kv_cache = new_kv_cache
-            if static:
-                offset = offset - (sot_l - 1) # for length fixed to sot_l, need to shift back to sot_l-1
-
-        if tokens.shape[-1] > self.initial_token_length:
-            # only need to use the last token except in the first forward pass
+            self.sot_indices = sot_indices
+            if sot_indices is not None:
+                self.sot_logits = np.full((n_group, self.model.dims.n_vocab), np.nan, dtype=np.float32)
             if static:
-                tokens = tokens[:, -sot_l:] # To avoid dynamic shape, fix q length to 3;
-            else:
-                tokens = tokens[:, -1:] 
+                # The query window is fixed to sot_l tokens, so the prompt and prefix tokens before the last
+                # window are stored in the kv cache first, up to sot_l of them per decoder call. The rows of a
+                # window only attend to the rows before them, so they are final and all can be stored.
+                n_prefill = tokens.shape[-1] - sot_l
+                for start in range(0, n_prefill, sot_l):
+                    n_rows = min(sot_l, n_prefill - start)
+                    _, prefill_time = self._forward(tokens[:, start : start + sot_l], audio_features, start, n_rows)
+                    decoder_time += prefill_time
+
+        if static:
+            # the query window is the last sot_l tokens, the tokens before it are in the kv cache
+            offset = tokens.shape[-1] - sot_l
+            tokens = tokens[:, -sot_l:]
+        else:
+            offset = self.offset or 0
+            if tokens.shape[-1] > self.initial_token_length:
+                # only need to use the last token except in the first forward pass
+                tokens = tokens[:, -1:]
+
+        # the oldest row of the query window leaves the window on the next step, store it
+        output, step_time = self._forward(tokens, audio_features, offset, 1)
+        decoder_time += step_time
+        self.offset = offset + tokens.shape[-1]
+        self.sot_indices = None
+        return output, decoder_time
 
-        mask = np.concatenate((np.zeros((sot_l, offset)), self.mask[:sot_l, :self.n_t_ctx-offset]), axis=1)
-        mask = np.concatenate((np.full((sot_l, self.n_t_ctx-sot_l-offset), -np.inf), mask[:, :sot_l+offset]), axis=1)
+    def _forward(self, tokens: np.ndarray, audio_features: np.ndarray, offset: int, n_rows: int):
+        """Runs the decoder on a query window starting at position `offset`, and stores its first `n_rows` rows"""
+        if self.ring_kv_cache:
+            if self.ring_mask is None:
+                n_cache = self.kv_cache.shape[2]
+                if self.ring_mask_template is None or self.ring_mask_template.shape[1] != n_cache + sot_l:
+                    self.ring_mask_template = self._new_ring_mask(n_cache)
+                self.ring_mask = self.ring_mask_template.copy()
+            mask = self.ring_mask
+        else:
+            # `offset` tokens are cached, at the end of the shifting kv cache
+            mask = np.concatenate((np.zeros((sot_l, offset)), self.mask[:sot_l, :self.n_t_ctx-offset]), axis=1)
+            mask = np.concatenate((np.full((sot_l, self.n_t_ctx-sot_l-offset), -np.inf), mask[:, :sot_l+offset]), axis=1)
 
         # print("audio features shape: ", audio_features.shape)
+        # positions stay logical in both modes, only the storage of the kv cache is circular
         pe = self.pe[offset : offset + tokens.shape[-1]]
         # print("offset: ", offset, "token shape: ", tokens.shape[-1], "pe shape: ", pe.shape)
+        if self.io_binding and self.decoder_binding is None:
+            self.decoder_binding = self.model.decoder.bind(audio_features, self.kv_cache, sot_l, self.model.dims.n_vocab)
+
         start = time.perf_counter()
-        output, self.kv_cache, kv_s = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache, offset=offset, mask=mask, pe=pe)
+        if self.decoder_binding is not None:
+            output, self.kv_cache, kv_s = self.decoder_binding(tokens, mask=mask, pe=pe)
+        else:
+            output, self.kv_cache, kv_s = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache, offset=offset, mask=mask, pe=pe)
         end = time.perf_counter()
         decoder_time = end - start
-        
-        id = 0
-        init_s = 1
-        for cache in kv_s: #[1,3,384]
-            self.kv_cache[id, :, :-init_s, :] = np.copy(self.kv_cache[id, :, init_s:, :])  #kv_cache [8,1,512,384]
-            self.kv_cache[id, :, -init_s:, :] = cache[:, :init_s,:]  #kv_cache [8,1,512,384]
-            id += 1
-
-        # self.kv_cache = self.kv_cache[:, :, :length, :] # Since hard code of model.new_kv_cache
-        self.offset = length
+
+        if self.sot_indices is not None:
+            # copied out, the output buffer of the IOBinding is reused by the next pass
+            rows = np.flatnonzero((self.sot_indices >= offset) & (self.sot_indices < offset + tokens.shape[-1]))
+            self.sot_logits[rows] = output[rows, self.sot_indices[rows] - offset]
+
+        if self.ring_kv_cache:
+            self._write_ring(kv_s, n_rows)
+        else:
+            id = 0
+            for cache in kv_s: #[1,3,384]
+                self.kv_cache[id, :, :-n_rows, :] = np.copy(self.kv_cache[id, :, n_rows:, :])  #kv_cache [8,1,512,384]
+                self.kv_cache[id, :, -n_rows:, :] = cache[:, :n_rows,:]  #kv_cache [8,1,512,384]
+                id += 1
+
         return output, decoder_time
 
+    def _new_ring_mask(self, n_cache: int) -> np.ndarray:
+        # columns [0, n_cache) are the kv cache slots, the last sot_l columns the causal query window
+        mask = np.full((sot_l, n_cache + sot_l), -np.inf, dtype=np.float32)
+        mask[:, n_cache:] = self.mask[:sot_l, :sot_l]
+        return mask
+
+    def _write_ring(self, kv_s: List[np.ndarray], n_rows: int = 1):
+        # store the first n_rows rows of the query window in the next slots
+        for row in range(n_rows):
+            slot = self.write_index % self.kv_cache.shape[2]
+            for id, cache in enumerate(kv_s):
+                self.kv_cache[id, :, slot, :] = cache[:, row, :]
+            self.ring_mask[:, slot] = 0
+            self.write_index += 1
+
     def cleanup_caching(self):
         self.kv_cache = None
         self.offset = None
+        self.sot_indices = None
+        self.ring_mask = None
+        self.write_index = 0
+        self.decoder_binding = None
 
     def rearrange_kv_cache(self, source_indices):
-        self.kv_cache = self.kv_cache[:, source_indices]
+        if self.decoder_binding is not None and len(source_indices) == self.kv_cache.shape[1]:
+            self.kv_cache = self.decoder_binding.rearrange_kv_cache(source_indices)
+        else:
+            self.kv_cache = self.kv_cache[:, source_indices]
+            # the batch size changed, rows of completed audio left the batch; bind again on the next step
+            self.decoder_binding = None
 
 
 class SequenceRanker:
@@ -248,7 +343,9 @@ class TokenDecoder:
     def reset(self):
         """Initialize any stateful variables for decoding a new sequence"""
 
-    def update(self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray) -> Tuple[np.ndarray, bool]:
+    def update(
+        self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray, logprobs: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, bool]:
         """Specify how to select the next token, based on the current trace and logits
 
         Parameters
@@ -262,6 +359,9 @@ class TokenDecoder:
         sum_logprobs : np.ndarray, shape = (n_batch)
             cumulative log probabilities for each sequence
 
+        logprobs : np.ndarray, shape = (n_batch, vocab_size), optional
+            log_softmax of `logits`, when the caller has already computed it
+
         Returns
         -------
         tokens : np.ndarray, shape = (n_batch, current_sequence_length + 1)
@@ -273,6 +373,31 @@ class TokenDecoder:
         """
         raise NotImplementedError
 
+    def completed_audio(self, tokens: np.ndarray, n_audio: int) -> Optional[np.ndarray]:
+        """Which audio of the batch are done decoding, so that their rows can leave the batch early
+
+        Parameters
+        ----------
+        tokens : np.ndarray, shape = (n_batch, current_sequence_length)
+            the tokens returned by the last `update`
+
+        n_audio : int
+            the number of audio in the batch, `n_batch // n_group`
+
+        Returns
+        -------
+        completed : np.ndarray, shape = (n_audio), optional
+            True for the completed audio, None if the decoder can't tell before all are completed
+
+        """
+        return None
+
+    def remove_audio(self, keep: np.ndarray) -> None:
+        """Drop the completed audio from the batch, the next `update` only gets the rows of the audio in `keep`
+
+        The dropped audio are still part of `finalize`, with the tokens and log probabilities they completed with.
+        """
+
     def finalize(
         self, tokens: np.ndarray, sum_logprobs: np.ndarray
     ) -> Tuple[Sequence[Sequence[np.ndarray]], List[List[float]]]:
@@ -303,14 +428,17 @@ class GreedyDecoder(TokenDecoder):
         self.temperature = temperature
         self.eot = eot
 
-    def update(self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray) -> Tuple[np.ndarray, bool]:
+    def update(
+        self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray, logprobs: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, bool]:
         temperature = self.temperature
         if temperature == 0:
-            next_tokens = logits.argmax(dim=-1)
+            next_tokens = logits.argmax(axis=-1)
         else:
             next_tokens = numpy_categorical_sample(logits, temperature)
 
-        logprobs = log_softmax(logits, dim=-1)
+        if logprobs is None:
+            logprobs = log_softmax(logits, dim=-1)
         current_logprobs = logprobs[np.arange(logprobs.shape[0]), next_tokens]
         sum_logprobs += current_logprobs * (tokens[:, -1] != self.eot)
 
@@ -320,6 +448,9 @@ class GreedyDecoder(TokenDecoder):
         completed = (tokens[:, -1] == self.eot).all()
         return tokens, completed
 
+    def completed_audio(self, tokens: np.ndarray, n_audio: int) -> Optional[np.ndarray]:
+        return (tokens[:, -1] == self.eot).reshape(n_audio, -1).all(axis=-1)
+
     def finalize(self, tokens: np.ndarray, sum_logprobs: np.ndarray):
         # make sure each sequence has at least one EOT token at the end
         tokens = np.pad(tokens, (0, 1), constant_values=self.eot)
@@ -327,97 +458,182 @@ class GreedyDecoder(TokenDecoder):
 
 
 class BeamSearchDecoder(TokenDecoder):
+    """
+    Array based beam search.
+
+    The candidates of every audio are ranked at once: each beam proposes its top `beam_size + 1` tokens, the
+    candidates are sorted by score (ties keep beam order), and the first `beam_size` which are not EOT continue.
+    The EOT candidates ranked before them are finished hypotheses, kept in fixed size arrays per audio.
+    Token sequences live in two preallocated matrices which are swapped every step.
+    """
     def __init__(self, beam_size: int, eot: int, inference: Inference, patience: Optional[float] = None):
         self.beam_size = beam_size
         self.eot = eot
         self.inference = inference
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
-        self.finished_sequences = None
+        # finalize tops up the finished hypotheses to beam_size, which may be more than max_candidates
+        self.max_finished: int = max(self.max_candidates, beam_size)
 
         assert self.max_candidates > 0, f"Invalid beam size ({beam_size}) or patience ({patience})"
+        self.reset()
 
     def reset(self):
-        self.finished_sequences = None
-
-    def update(self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray) -> Tuple[np.ndarray, bool]:
+        self.token_buffers: Optional[List[np.ndarray]] = None
+        self.current = 0
+        self.finished_tokens: Optional[np.ndarray] = None   # (n_audio, max_finished, capacity)
+        self.finished_lengths: Optional[np.ndarray] = None  # (n_audio, max_finished)
+        self.finished_logprobs: Optional[np.ndarray] = None # (n_audio, max_finished)
+        self.finished_count: Optional[np.ndarray] = None    # (n_audio,)
+        self.audio_index: Optional[np.ndarray] = None       # the audio still in the batch
+
+    def _allocate_finished(self, n_audio: int, dtype):
+        self.finished_tokens = np.empty((n_audio, self.max_finished, 0), dtype=dtype)
+        self.finished_lengths = np.zeros((n_audio, self.max_finished), dtype=np.int64)
+        self.finished_logprobs = np.zeros((n_audio, self.max_finished))
+        self.finished_count = np.zeros(n_audio, dtype=np.int64)
+        self.audio_index = np.arange(n_audio)
+
+    def _reserve(self, n_batch: int, length: int, dtype):
+        # room for the sequences and one more token, grown by doubling
+        capacity = 0 if self.token_buffers is None else self.token_buffers[0].shape[1]
+        if capacity > length:
+            return
+        new_capacity = max(2 * capacity, length + 32)
+        buffers = [np.empty((n_batch, new_capacity), dtype=dtype) for _ in range(2)]
+        finished = np.empty(self.finished_tokens.shape[:2] + (new_capacity,), dtype=dtype)
+        if self.token_buffers is not None:
+            buffers[self.current][:, :capacity] = self.token_buffers[self.current]
+            finished[..., :capacity] = self.finished_tokens
+        self.token_buffers = buffers
+        self.finished_tokens = finished
+
+    def _merge_duplicates(self, proposed: np.ndarray, scores: np.ndarray, sources: np.ndarray, valid: np.ndarray, n_vocab: int):
+        # When the beams hold the same sequence (the first update), beams proposing the same token propose the
+        # same sequence. Like a repeated dict key it is ranked where it was first proposed, with the score and
+        # source of the last beam which proposed it; the other copies are dropped.
+        n_audio = proposed.shape[0]
+        keys = (np.arange(n_audio)[:, None] * n_vocab + proposed).ravel()
+        order = np.lexsort((sources.ravel(), keys))
+        sorted_keys = keys[order]
+        boundary = sorted_keys[1:] != sorted_keys[:-1]
+        firsts = order[np.concatenate(([True], boundary))]
+        lasts = order[np.concatenate((boundary, [True]))]
+        scores.ravel()[firsts] = scores.ravel()[lasts]
+        sources.ravel()[firsts] = sources.ravel()[lasts]
+        valid.fill(False)
+        valid.ravel()[firsts] = True
+
+    def update(
+        self, tokens: np.ndarray, logits: np.ndarray, sum_logprobs: np.ndarray, logprobs: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, bool]:
         if tokens.shape[0] % self.beam_size != 0:
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
-        n_audio = tokens.shape[0] // self.beam_size
-        if self.finished_sequences is None:  # for the first update
-            self.finished_sequences = [{} for _ in range(n_audio)]
-
-        logprobs = log_softmax(logits, dim=-1)
-        next_tokens, source_indices, finished_sequences = [], [], []
-        for i in range(n_audio):
-            scores, sources, finished = {}, {}, {}
-
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
-                idx = i * self.beam_size + j
-                prefix = list(tokens[idx])
-                topk_values, topk_indices = \
-                    -np.partition(-logprobs[idx], self.beam_size + 1)[:self.beam_size + 1], np.argpartition(-logprobs[idx], self.beam_size + 1)[:self.beam_size + 1]
-
-                sort_indices = np.argsort(-topk_values)
-                topk_values = topk_values[sort_indices]
-                topk_indices = topk_indices[sort_indices]
-                for logprob, token in zip(topk_values, topk_indices):
-                    new_logprob = (sum_logprobs[idx] + logprob)
-                    sequence = tuple(prefix + [token])
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
-
-            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
-            saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
-                else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
-
-                    saved += 1
-                    if saved == self.beam_size:
-                        break
-
-            finished_sequences.append(finished)
-
-        tokens = np.array(next_tokens)
+        n_batch, length = tokens.shape
+        n_audio = n_batch // self.beam_size
+        first_update = self.finished_count is None
+        if first_update:
+            self._allocate_finished(n_audio, tokens.dtype)
+        self._reserve(n_batch, length, tokens.dtype)
+        current = self.token_buffers[self.current]
+        if tokens.base is not current:
+            current[:, :length] = tokens
+
+        # STEP 1: the top beam_size + 1 tokens of every beam, with their cumulative log probabilities
+        n_vocab = logits.shape[-1]
+        if logprobs is None:
+            logprobs = log_softmax(logits, dim=-1)
+        n_proposed = self.beam_size + 1
+        proposed = np.argpartition(logprobs, -n_proposed, axis=-1)[:, -n_proposed:]
+        scores = sum_logprobs[:, None] + np.take_along_axis(logprobs, proposed, axis=-1)
+        sources = np.repeat(np.arange(n_batch)[:, None], n_proposed, axis=-1)
+
+        # STEP 2: rank the candidates of each audio, ties ordered by beam then token
+        proposed = proposed.reshape(n_audio, -1)
+        scores = scores.reshape(n_audio, -1)
+        sources = sources.reshape(n_audio, -1)
+        rank_key = (sources % self.beam_size) * n_vocab + proposed
+        valid = np.ones(proposed.shape, dtype=np.bool_)
+        if first_update and (tokens.reshape(n_audio, self.beam_size, length) == tokens[:: self.beam_size, None]).all():
+            self._merge_duplicates(proposed, scores, sources, valid, n_vocab)
+        order = np.lexsort((rank_key, -scores, ~valid), axis=-1)
+        proposed = np.take_along_axis(proposed, order, axis=-1)
+        scores = np.take_along_axis(scores, order, axis=-1)
+        sources = np.take_along_axis(sources, order, axis=-1)
+        valid = np.take_along_axis(valid, order, axis=-1)
+
+        # the first beam_size non-EOT candidates continue, the EOT candidates ranked above them are finished
+        is_eot = proposed == self.eot
+        n_continuing = np.cumsum(valid & ~is_eot, axis=-1)
+        keep = valid & ~is_eot & (n_continuing <= self.beam_size)
+        finished = valid & is_eot & (n_continuing < self.beam_size)
+
+        next_tokens = proposed[keep]
+        source_indices = sources[keep]
+        sum_logprobs[:] = scores[keep]
+
+        following = self.token_buffers[1 - self.current]
+        np.take(current[:, :length], source_indices, axis=0, out=following[:, :length])
+        following[:, length] = next_tokens
+        self.current = 1 - self.current
         self.inference.rearrange_kv_cache(source_indices)
 
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(self.finished_sequences, finished_sequences):
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
+        # add newly finished sequences, in rank order, until the candidate list of the audio is full
+        if finished.any():
+            batch_indices, candidate_indices = np.nonzero(finished)
+            audio_indices = self.audio_index[batch_indices]
+            rank = np.cumsum(finished, axis=-1)[batch_indices, candidate_indices] - 1
+            slots = self.finished_count[audio_indices] + rank
+            accepted = slots < self.max_candidates
+            batch_indices, candidate_indices = batch_indices[accepted], candidate_indices[accepted]
+            audio_indices, slots = audio_indices[accepted], slots[accepted]
+
+            self.finished_tokens[audio_indices, slots, :length] = current[sources[batch_indices, candidate_indices], :length]
+            self.finished_tokens[audio_indices, slots, length] = self.eot
+            self.finished_lengths[audio_indices, slots] = length + 1
+            self.finished_logprobs[audio_indices, slots] = scores[batch_indices, candidate_indices]
+            np.add.at(self.finished_count, audio_indices, 1)
 
         # mark as completed if all audio has enough number of samples
-        completed = all(
-            len(sequences) >= self.max_candidates for sequences in self.finished_sequences
-        )
-        return tokens, completed
+        completed = bool((self.finished_count[self.audio_index] >= self.max_candidates).all())
+        return following[:, : length + 1], completed
+
+    def completed_audio(self, tokens: np.ndarray, n_audio: int) -> Optional[np.ndarray]:
+        if self.finished_count is None:
+            return None
+        return self.finished_count[self.audio_index] >= self.max_candidates
+
+    def remove_audio(self, keep: np.ndarray) -> None:
+        rows = (keep[:, None] * self.beam_size + np.arange(self.beam_size)).ravel()
+        self.token_buffers = [buffer[rows] for buffer in self.token_buffers]
+        self.audio_index = self.audio_index[keep]
 
     def finalize(self, preceding_tokens: np.ndarray, sum_logprobs: np.ndarray):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
-        sum_logprobs = sum_logprobs
-        for i, sequences in enumerate(self.finished_sequences):
-            if len(sequences) < self.beam_size:  # when not enough sequences are finished
-                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
-                    sequence = list(preceding_tokens[i, j]) + [self.eot]
-                    sequences[tuple(sequence)] = sum_logprobs[i][j]
-                    if len(sequences) >= self.beam_size:
-                        break
+        n_audio, _, length = preceding_tokens.shape
+        if self.finished_count is None:
+            self._allocate_finished(n_audio, preceding_tokens.dtype)
+        n_batch = n_audio * self.beam_size if self.token_buffers is None else len(self.token_buffers[0])
+        self._reserve(n_batch, length, preceding_tokens.dtype)
+
+        for i in range(n_audio):
+            for j in list(np.argsort(sum_logprobs[i]))[::-1]:
+                slot = self.finished_count[i]
+                if slot >= self.beam_size:  # when enough sequences are finished
+                    break
+                self.finished_tokens[i, slot, :length] = preceding_tokens[i, j]
+                self.finished_tokens[i, slot, length] = self.eot
+                self.finished_lengths[i, slot] = length + 1
+                self.finished_logprobs[i, slot] = sum_logprobs[i][j]
+                self.finished_count[i] += 1
 
         tokens: List[List[np.ndarray]] = [
-            [np.array(seq) for seq in sequences.keys()] for sequences in self.finished_sequences
+            [self.finished_tokens[i, s, : self.finished_lengths[i, s]].copy() for s in range(self.finished_count[i])]
+            for i in range(n_audio)
         ]
         sum_logprobs: List[List[float]] = [
-            list(sequences.values()) for sequences in self.finished_sequences
+            self.finished_logprobs[i, : self.finished_count[i]].tolist() for i in range(n_audio)
         ]
         return tokens, sum_logprobs
 
@@ -437,23 +653,35 @@ class LogitFilter:
         """
         raise NotImplementedError
 
+    def apply_logprobs(self, logits: np.ndarray, logprobs: np.ndarray, tokens: np.ndarray) -> None:
+        """Apply rules which need the log probabilities, after every filter's `apply`
 
-class SuppressBlank(LogitFilter):
-    def __init__(self, tokenizer: Tokenizer, sample_begin: int):
-        self.tokenizer = tokenizer
-        self.sample_begin = sample_begin
-
-    def apply(self, logits: np.ndarray, tokens: np.ndarray):
-        if tokens.shape[1] == self.sample_begin:
-            logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
+        The log probabilities are computed once per step and shared with the token decoder, so a filter
+        which masks `logits` here has to update `logprobs` in-place as well.
+        """
+        pass
 
 
-class SuppressTokens(LogitFilter):
-    def __init__(self, suppress_tokens: Sequence[int]):
-        self.suppress_tokens = list(suppress_tokens)
+class SuppressMask(LogitFilter):
+    """
+    Suppresses the `suppress_tokens` at every step, and the `blank_tokens` too at the first sampled token: the
+    suppressed tokens are gathered into a boolean vocabulary mask once, and each step sets them all to -inf
+    with a single indexed write.
+    """
+    def __init__(self, n_vocab: int, suppress_tokens: Sequence[int], sample_begin: int, blank_tokens: Sequence[int] = ()):
+        self.sample_begin = sample_begin
+        mask = np.zeros(n_vocab, dtype=np.bool_)
+        mask[list(suppress_tokens)] = True
+        self.suppressed = np.flatnonzero(mask)
+        # the first sampled token additionally can't be blank
+        mask[list(blank_tokens)] = True
+        self.initial_suppressed = np.flatnonzero(mask)
 
     def apply(self, logits: np.ndarray, tokens: np.ndarray):
-        logits[:, self.suppress_tokens] = -np.inf
+        if tokens.shape[1] == self.sample_begin:
+            logits[:, self.initial_suppressed] = -np.inf
+        elif len(self.suppressed):
+            logits[:, self.suppressed] = -np.inf
 
 
 class ApplyTimestampRules(LogitFilter):
@@ -486,14 +714,43 @@ class ApplyTimestampRules(LogitFilter):
             last_allowed = self.tokenizer.timestamp_begin + self.max_initial_timestamp_index
             logits[:, last_allowed + 1 :] = -np.inf
 
+    def apply_logprobs(self, logits: np.ndarray, logprobs: np.ndarray, tokens: np.ndarray):
         # if sum of probability over timestamps is above any other token, sample timestamp
-        logprobs = log_softmax(logits, dim=-1)
-        for k in range(tokens.shape[0]):
-            max_val = np.max(logprobs[k, self.tokenizer.timestamp_begin :], axis=-1, keepdims=True)
-            timestamp_logprob = np.squeeze(max_val) + np.log(np.sum(np.exp(logprobs[k, self.tokenizer.timestamp_begin :] - max_val), axis=-1))
-            max_text_token_logprob = np.max(logprobs[k, : self.tokenizer.timestamp_begin])
-            if timestamp_logprob > max_text_token_logprob:
-                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+        timestamp_begin = self.tokenizer.timestamp_begin
+        timestamp_logprobs = logprobs[:, timestamp_begin:]
+        max_val = np.max(timestamp_logprobs, axis=-1, keepdims=True)
+        timestamp_logprob = max_val[:, 0] + np.log(np.sum(np.exp(timestamp_logprobs - max_val), axis=-1))
+        max_text_token_logprob = np.max(logprobs[:, :timestamp_begin], axis=-1)
+        rows = np.flatnonzero(timestamp_logprob > max_text_token_logprob)
+        if len(rows):
+            logits[rows, :timestamp_begin] = -np.inf
+            logprobs[rows] = log_softmax(logits[rows], dim=-1)
+
+
+def get_initial_tokens(model: "Whisper", options: DecodingOptions) -> Tuple[int]:
+    """Returns the tokens a decode with `options` starts from: the prompt, the SOT sequence and the prefix"""
+    tokenizer = get_tokenizer(model.is_multilingual, language=options.language or "en", task=options.task)
+    n_ctx = model.dims.n_text_ctx
+    sample_len = options.sample_len or n_ctx // 2
+    tokens = list(tokenizer.sot_sequence_including_notimestamps if options.without_timestamps else tokenizer.sot_sequence)
+    prefix = options.prefix
+    prompt = options.prompt
+
+    if prefix:
+        prefix_tokens = (
+            tokenizer.encode(" " + prefix.strip()) if isinstance(prefix, str) else list(prefix)
+        )
+        max_prefix_len = n_ctx // 2 - sample_len
+        prefix_tokens = prefix_tokens[-max_prefix_len:]
+        tokens = tokens + prefix_tokens
+
+    if prompt:
+        prompt_tokens = (
+            tokenizer.encode(" " + prompt.strip()) if isinstance(prompt, str) else list(prompt)
+        )
+        tokens = [tokenizer.sot_prev] + prompt_tokens[-(n_ctx // 2 - 1) :] + tokens
+
+    return tuple(tokens)
 
 
 class DecodingTask:
@@ -502,7 +759,7 @@ class DecodingTask:
     decoder: TokenDecoder
     logit_filters: List[LogitFilter]
 
-    def __init__(self, model: "Whisper", options: DecodingOptions):
+    def __init__(self, model: "Whisper", options: DecodingOptions, initial_tokens: Optional[Sequence[int]] = None):
         self.model = model
 
         language = options.language or "en"
@@ -518,9 +775,14 @@ class DecodingTask:
         if self.options.without_timestamps:
             self.sot_sequence = tokenizer.sot_sequence_including_notimestamps
 
-        self.initial_tokens: Tuple[int] = self._get_initial_tokens()
+        self.initial_tokens: Tuple[int] = tuple(initial_tokens) if initial_tokens is not None else get_initial_tokens(model, options)
         self.sample_begin: int = len(self.initial_tokens)
         self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
+        # each token needs a row of the positional embedding table, which is shorter than n_text_ctx
+        self.n_positions: int = len(model.positional_embedding)
+        if self.sample_begin >= self.n_positions:
+            raise ValueError(f"{self.sample_begin} initial tokens leave no position to sample in {self.n_positions}")
+        self.sample_len = min(self.sample_len, self.n_positions - self.sample_begin)
 
         # inference: implements the forward pass through the decoder, including kv caching
         self.inference = OnnxInference(model, len(self.initial_tokens))
@@ -538,10 +800,10 @@ class DecodingTask:
 
         # logit filters: applies various rules to suppress or penalize certain tokens
         self.logit_filters = []
-        if self.options.suppress_blank:
-            self.logit_filters.append(SuppressBlank(self.tokenizer, self.sample_begin))
-        if self.options.suppress_tokens:
-            self.logit_filters.append(SuppressTokens(self._get_suppress_tokens()))
+        suppress_tokens = self._get_suppress_tokens() if self.options.suppress_tokens else ()
+        blank_tokens = tokenizer.encode(" ") + [tokenizer.eot] if self.options.suppress_blank else ()
+        if suppress_tokens or blank_tokens:
+            self.logit_filters.append(SuppressMask(model.dims.n_vocab, suppress_tokens, self.sample_begin, blank_tokens))
         if not options.without_timestamps:
             precision = CHUNK_LENGTH / model.dims.n_audio_ctx  # usually 0.02 seconds
             max_initial_timestamp_index = None
@@ -564,41 +826,19 @@ class DecodingTask:
 
         return options
 
-    def _get_initial_tokens(self) -> Tuple[int]:
-        tokens = list(self.sot_sequence)
-        prefix = self.options.prefix
-        prompt = self.options.prompt
-
-        if prefix:
-            prefix_tokens = (
-                self.tokenizer.encode(" " + prefix.strip()) if isinstance(prefix, str) else prefix
-            )
-            if self.sample_len is not None:
-                max_prefix_len = self.n_ctx // 2 - self.sample_len
-                prefix_tokens = prefix_tokens[-max_prefix_len:]
-            tokens = tokens + prefix_tokens
-
-        if prompt:
-            prompt_tokens = (
-                self.tokenizer.encode(" " + prompt.strip()) if isinstance(prompt, str) else prompt
-            )
-            tokens = [self.tokenizer.sot_prev] + prompt_tokens[-(self.n_ctx // 2 - 1) :] + tokens
-
-        return tuple(tokens)
-
     def _get_suppress_tokens(self) -> Tuple[int]:
         suppress_tokens = self.options.suppress_tokens
 
         if isinstance(suppress_tokens, str):
             suppress_tokens = [int(t) for t in suppress_tokens.split(",")]
 
-        if -1 in suppress_tokens:
+        if suppress_tokens is None or len(suppress_tokens) == 0:
+            suppress_tokens = []  # interpret empty string as an empty list
+        elif -1 in suppress_tokens:
             suppress_tokens = [t for t in suppress_tokens if t >= 0]
             suppress_tokens.extend(self.tokenizer.non_speech_tokens)
-        elif suppress_tokens is None or len(suppress_tokens) == 0:
-            suppress_tokens = []  # interpret empty string as an empty list
         else:
-            assert isinstance(suppress_tokens, list), "suppress_tokens must be a list"
+            suppress_tokens = list(suppress_tokens)
 
         suppress_tokens.extend(
             [self.tokenizer.sot, self.tokenizer.sot_prev, self.tokenizer.sot_lm]
@@ -634,19 +874,25 @@ class DecodingTask:
 
         return languages, lang_probs
 
-    def _main_loop(self, audio_features: np.ndarray, tokens: np.ndarray):
+    def _main_loop(self, audio_features: np.ndarray, tokens: np.ndarray, sot_indices: np.ndarray):
         assert audio_features.shape[0] == tokens.shape[0]
         n_batch = tokens.shape[0]
         sum_logprobs: np.ndarray = np.zeros(n_batch)
         no_speech_probs = [np.nan] * n_batch
         total_decoder_time: float = 0
+
+        # the rows of audio which are done leave the batch, their final tokens and log probabilities are kept here
+        rows = np.arange(n_batch)
+        final_tokens: Dict[int, np.ndarray] = {}
+        final_logprobs: np.ndarray = np.zeros(n_batch)
         try:
             for i in range(self.sample_len):
-                logits, decoder_time = self.inference.logits(tokens, audio_features)
+                save_no_speech = i == 0 and self.tokenizer.no_speech is not None
+                logits, decoder_time = self.inference.logits(tokens, audio_features, sot_indices if save_no_speech else None)
                 total_decoder_time += decoder_time
 
-                if i == 0 and self.tokenizer.no_speech is not None:  # save no_speech_probs
-                    probs_at_sot = softmax(logits[:, self.sot_index], dim=-1)
+                if save_no_speech:  # save no_speech_probs
+                    probs_at_sot = softmax(self.inference.sot_logits, dim=-1)
                     no_speech_probs = list(probs_at_sot[:, self.tokenizer.no_speech])
 
                 # now we need to consider the logits at the last token only
@@ -656,28 +902,68 @@ class DecodingTask:
                 for logit_filter in self.logit_filters:
                     logit_filter.apply(logits, tokens)
 
+                # the log probabilities are computed once, for the filters which need them and the decoder
+                logprobs = log_softmax(logits, dim=-1)
+                for logit_filter in self.logit_filters:
+                    logit_filter.apply_logprobs(logits, logprobs, tokens)
+
                 # expand the tokens tensor with the selected next tokens
-                tokens, completed = self.decoder.update(tokens, logits, sum_logprobs)
+                tokens, completed = self.decoder.update(tokens, logits, sum_logprobs, logprobs)
 
-                if completed or tokens.shape[-1] > self.n_ctx:
+                if completed or tokens.shape[-1] >= self.n_positions:
                     break
+
+                if len(rows) > self.n_group:
+                    done = self.decoder.completed_audio(tokens, len(rows) // self.n_group)
+                    if done is not None and done.any():
+                        keep = np.repeat(~done, self.n_group)
+                        for row, row_tokens in zip(rows[~keep], tokens[~keep]):
+                            final_tokens[row] = row_tokens.copy()
+                        final_logprobs[rows[~keep]] = sum_logprobs[~keep]
+
+                        rows, tokens, sum_logprobs = rows[keep], tokens[keep], sum_logprobs[keep]
+                        audio_features = audio_features[keep]
+                        self.inference.rearrange_kv_cache(np.flatnonzero(keep))
+                        self.decoder.remove_audio(np.flatnonzero(~done))
         finally:
             self.inference.cleanup_caching()
 
+        if final_tokens:
+            # the audio which left early are padded with EOT to the length of the others
+            length = max(tokens.shape[-1], max(map(len, final_tokens.values())))
+            all_tokens = np.full((n_batch, length), self.tokenizer.eot, dtype=tokens.dtype)
+            all_tokens[rows, : tokens.shape[-1]] = tokens
+            for row, row_tokens in final_tokens.items():
+                all_tokens[row, : len(row_tokens)] = row_tokens
+            final_logprobs[rows] = sum_logprobs
+            tokens, sum_logprobs = all_tokens, final_logprobs
+
         return tokens, sum_logprobs, no_speech_probs, total_decoder_time
 
-    def run(self, mel: np.ndarray) -> List[DecodingResult]:
+    def run(self, mel: np.ndarray, initial_tokens: Optional[np.ndarray] = None) -> List[DecodingResult]:
+        """
+        Decodes a batch of audio, given as Mel spectrograms or encoded audio features.
+
+        `initial_tokens` of shape (n_audio, sample_begin) gives every audio its own prompt and prefix instead of
+        the options', see `decode_batch`. All the rows share the query positions, so they have the same length.
+        """
         self.decoder.reset()
         tokenizer: Tokenizer = self.tokenizer
         n_audio: int = mel.shape[0]
 
         audio_features, encoder_time = self._get_audio_features(mel)  # encoder forward pass
-        token = np.array([self.initial_tokens])
-        tokens: np.ndarray = np.broadcast_to(token, (n_audio, token.shape[1]))
+        if initial_tokens is None:
+            token = np.array([self.initial_tokens])
+            tokens: np.ndarray = np.broadcast_to(token, (n_audio, token.shape[1]))
+        else:
+            tokens = np.asarray(initial_tokens)
+            assert tokens.shape == (n_audio, self.sample_begin), f"{tokens.shape} initial tokens for {n_audio} audio of {self.sample_begin} tokens"
+        # the prompts may differ in length, so <|startoftranscript|> is found for each audio
+        sot_indices = (tokens == tokenizer.sot).argmax(axis=-1)
 
         # detect language if requested, overwriting the language token
         # languages, language_probs = self._detect_language(audio_features, tokens)
-        languages=['en']
+        languages = [self.options.language or "en"] * n_audio
         if self.options.task == "lang_id":
             return [
                 DecodingResult(audio_features=features, language=language, language_probs=probs, encoder_time=encoder_time)
@@ -688,9 +974,10 @@ class DecodingTask:
         # print("self.n_group: ", self.n_group)
         audio_features = np.repeat(a=audio_features, repeats=self.n_group, axis=0)
         tokens = np.repeat(a=tokens, repeats=self.n_group, axis=0)
+        sot_indices = np.repeat(sot_indices, self.n_group)
 
         # call the main sampling loop
-        tokens, sum_logprobs, no_speech_probs, decoder_time = self._main_loop(audio_features, tokens)
+        tokens, sum_logprobs, no_speech_probs, decoder_time = self._main_loop(audio_features, tokens, sot_indices)
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
         audio_features = audio_features[:: self.n_group]
@@ -735,6 +1022,33 @@ class DecodingTask:
         ]
 
 
+def get_decoding_task(model: "Whisper", options: DecodingOptions, initial_tokens: Optional[Sequence[int]] = None) -> DecodingTask:
+    """
+    Returns the DecodingTask for `options` and its `initial_tokens` (by default `get_initial_tokens(model, options)`),
+    building it on first use.
+
+    Preparing a task (tokenizer lookups, suppressed tokens, logit filters) is kept out of the per-phrase path by
+    caching the last `DECODING_TASK_CACHE_SIZE` tasks on the model instance. The prompt and prefix change on
+    almost every call of a live stream, but a task only depends on the number of initial tokens, so the tasks are
+    keyed by the options without them and that number; the initial tokens are given to `DecodingTask.run`.
+    A task keeps per-decode state, so a model instance must only decode on one thread at a time
+    (use `Whisper.clone()` for each thread).
+    """
+    if initial_tokens is None:
+        initial_tokens = get_initial_tokens(model, options)
+    key = (replace(options, prompt=None, prefix=None), len(initial_tokens))
+    tasks: "OrderedDict[Tuple[DecodingOptions, int], DecodingTask]" = model.decoding_tasks
+    task = tasks.get(key)
+    if task is None:
+        task = DecodingTask(model, key[0], initial_tokens)
+        tasks[key] = task
+        if len(tasks) > DECODING_TASK_CACHE_SIZE:
+            tasks.popitem(last=False)
+    else:
+        tasks.move_to_end(key)
+    return task
+
+
 def decode(model: "Whisper", mel: np.ndarray, options: DecodingOptions = DecodingOptions()) -> Union[DecodingResult, List[DecodingResult]]:
     """
     Performs decoding of 30-second audio segment(s), provided as Mel spectrogram(s).
@@ -759,9 +1073,64 @@ def decode(model: "Whisper", mel: np.ndarray, options: DecodingOptions = Decodin
     if single:
         mel = mel[np.newaxis, ...]
 
-    result = DecodingTask(model, options).run(mel)
+    initial_tokens = get_initial_tokens(model, options)
+    task = get_decoding_task(model, options, initial_tokens)
+    result = task.run(mel, np.broadcast_to(np.array([initial_tokens]), (mel.shape[0], len(initial_tokens))))
 
     if single:
         result = result[0]
 
     return result
+
+
+def _plan_batches(model: "Whisper", options: Sequence[DecodingOptions]) -> List[Tuple[List[int], DecodingTask, np.ndarray]]:
+    # Rows decoded together share the query positions, so they need initial tokens of the same length. The
+    # options of a batch may only differ in their prompt and prefix, and the rows are grouped by the length of
+    # their initial tokens as they are: a row is decoded with the same context as if it was decoded alone.
+    # A batch is run by the one cached task of its options and length.
+    groups: Dict[Tuple[DecodingOptions, int], List[Tuple[int, Tuple[int]]]] = {}
+    for index, option in enumerate(options):
+        initial_tokens = get_initial_tokens(model, option)
+        groups.setdefault((replace(option, prompt=None, prefix=None), len(initial_tokens)), []).append((index, initial_tokens))
+
+    batches = []
+    for (base_options, _), rows in groups.items():
+        initial_tokens = np.array([tokens for _, tokens in rows])
+        batches.append(([index for index, _ in rows], get_decoding_task(model, base_options, initial_tokens[0]), initial_tokens))
+    return batches
+
+
+def decode_batch(model: "Whisper", mel: np.ndarray, options: Sequence[DecodingOptions]) -> List[DecodingResult]:
+    """
+    Decodes audio segments which each have their own options, e.g. from different live streams.
+
+    All the segments are encoded in one encoder pass. The segments whose options only differ in the prompt and
+    prefix, with initial tokens of the same length, are decoded in one decoder loop; each segment's result is
+    the same as if it was decoded alone.
+
+    Parameters
+    ----------
+    model: Whisper
+        the Whisper model instance
+
+    mel: np.ndarray, shape = (n_audio, 80, 3000)
+        the Mel spectrograms of the segments
+
+    options: Sequence[DecodingOptions], length = n_audio
+        the options of each segment
+
+    Returns
+    -------
+    result: List[DecodingResult]
+        the results of the segments, in order
+    """
+    assert mel.shape[0] == len(options), f"{mel.shape[0]} segments with {len(options)} options"
+    start = time.perf_counter()
+    audio_features = model.encoder(mel)
+    encoder_time = time.perf_counter() - start
+
+    results: List[Optional[DecodingResult]] = [None] * len(options)
+    for indices, task, initial_tokens in _plan_batches(model, options):
+        for index, result in zip(indices, task.run(audio_features[indices], initial_tokens)):
+            results[index] = replace(result, encoder_time=encoder_time)
+    return results
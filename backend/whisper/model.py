@@ -1,14 +1,16 @@
 import io
 import os
+import copy
 import json
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional
 import numpy as np
 import requests
 import onnx
 import psutil
 import onnxruntime as ort
-from whisper.decoding import detect_language as detect_language_function, decode as decode_function
+from whisper.decoding import detect_language as detect_language_function, decode as decode_function, decode_batch as decode_batch_function
 from whisper.utils import onnx_dtype_to_np_dtype_convert
 from whisper.decoding import sot_l
 
@@ -48,7 +50,8 @@ def load_local_model(name: str) -> onnx.ModelProto:
         onnx_serialized_graph = onnx._serialize(onnx_graph)
     return onnx_serialized_graph
 
-def load_model(name: str, onnx_encoder_path: str, onnx_decoder_path: str, encoder_target: str, decoder_target: str):
+def load_model(name: str, onnx_encoder_path: str, onnx_decoder_path: str, encoder_target: str, decoder_target: str,
+               intra_op_num_threads: Optional[int] = None):
     """
     Load a Whisper ASR model
 
@@ -58,6 +61,10 @@ def load_model(name: str, onnx_encoder_path: str, onnx_decoder_path: str, encode
         one of the official model names listed by `whisper.available_models()`, or
         path to a model checkpoint containing the model dimensions and the model state_dict.
 
+    intra_op_num_threads : Optional[int]
+        number of threads each ONNX Runtime session may use within an operator,
+        None leaves ONNX Runtime's default (one per physical core).
+
     Returns
     -------
     model : Whisper
@@ -85,7 +92,8 @@ def load_model(name: str, onnx_encoder_path: str, onnx_decoder_path: str, encode
         raise ValueError(f"model type {name} not supported")
 
     dims = ModelDimensions(**dims_config)
-    model = Whisper(dims=dims, model_name=name, onnx_encoder_path=onnx_encoder_path, onnx_decoder_path=onnx_decoder_path, encoder_target=encoder_target, decoder_target=decoder_target)
+    model = Whisper(dims=dims, model_name=name, onnx_encoder_path=onnx_encoder_path, onnx_decoder_path=onnx_decoder_path, encoder_target=encoder_target, decoder_target=decoder_target,
+                    intra_op_num_threads=intra_op_num_threads)
     return model
 
 def available_models() -> List[str]:
@@ -112,6 +120,7 @@ class OnnxAudioEncoder():
         model: str,
         model_path: str,
         target: str,
+        intra_op_num_threads: Optional[int] = None,
     ):
         if target == "cpu":
             self.provider = "CPUExecutionProvider"
@@ -124,6 +133,8 @@ class OnnxAudioEncoder():
         sess_options = ort.SessionOptions()
         # sess_options.intra_op_num_threads = psutil.cpu_count(logical=False)
         # sess_options.intra_op_num_threads = psutil.cpu_count(1)
+        if intra_op_num_threads is not None:
+            sess_options.intra_op_num_threads = intra_op_num_threads
         self.sess = \
             ort.InferenceSession(
                 # path_or_bytes=load_local_model(name=model_path),
@@ -161,6 +172,7 @@ class OnnxTextDecoder():
         model: str,
         model_path: str,
         target: str,
+        intra_op_num_threads: Optional[int] = None,
     ):
         if target == "cpu":
             self.provider = "CPUExecutionProvider"
@@ -174,6 +186,8 @@ class OnnxTextDecoder():
         sess_options = ort.SessionOptions()
         # sess_options.intra_op_num_threads = psutil.cpu_count(logical=True)
         # sess_options.intra_op_num_threads = psutil.cpu_count(1)
+        if intra_op_num_threads is not None:
+            sess_options.intra_op_num_threads = intra_op_num_threads
         self.sess = \
             ort.InferenceSession(
                 # path_or_bytes=load_local_model(name=model_path),
@@ -200,16 +214,17 @@ class OnnxTextDecoder():
         mask: np.ndarray,
         pe: np.ndarray,
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # np.asarray only copies when the dtype differs, unlike astype
         outputs = \
             self.sess.run(
                 [], # Don't fill outputs name, since there are multi outputs.
                 input_feed={
-                    "tokens": x.astype(self.inputs["tokens"]),
-                    "audio_features": xa.astype(self.inputs["audio_features"]),
-                    "kv_cache": kv_cache.astype(self.inputs["kv_cache"]),
+                    "tokens": np.asarray(x, dtype=self.inputs["tokens"]),
+                    "audio_features": np.asarray(xa, dtype=self.inputs["audio_features"]),
+                    "kv_cache": np.asarray(kv_cache, dtype=self.inputs["kv_cache"]),
                     # "offset": np.array(offset, dtype=self.inputs["offset"]),
-                    "mask": mask.astype(self.inputs["mask"]),
-                    "pe": pe.astype(self.inputs["pe"]),
+                    "mask": np.asarray(mask, dtype=self.inputs["mask"]),
+                    "pe": np.asarray(pe, dtype=self.inputs["pe"]),
                 }
             )
         logits: np.ndarray = outputs[0]
@@ -217,6 +232,105 @@ class OnnxTextDecoder():
         kv_s: List[np.ndarray] = [tmp for tmp in outputs[2:]]
         return logits, output_kv_cache, kv_s
 
+    def bind(self, audio_features: np.ndarray, kv_cache: np.ndarray, n_query: int, n_vocab: int) -> "DecoderIOBinding":
+        """Returns an IOBinding runner for one decode of `audio_features`, starting from `kv_cache`"""
+        return DecoderIOBinding(self, audio_features, kv_cache, n_query, n_vocab)
+
+
+class DecoderIOBinding():
+    """
+    Runs the decoder through an ORT IOBinding which lives for one decode.
+
+    `audio_features` are bound once, and the logits and kv outputs are written into buffers preallocated here
+    and reused on every step, so each step only hands the new tokens, mask and positional embedding to ORT.
+    The kv cache is double buffered: the cache bound as input is never the one bound as output.
+    """
+    def __init__(
+        self,
+        decoder: OnnxTextDecoder,
+        audio_features: np.ndarray,
+        kv_cache: np.ndarray,
+        n_query: int,
+        n_vocab: int,
+    ):
+        self.decoder = decoder
+        self.binding = decoder.sess.io_binding()
+
+        self.audio_features = np.ascontiguousarray(audio_features, dtype=decoder.inputs["audio_features"])
+        self.binding.bind_cpu_input("audio_features", self.audio_features)
+
+        kv_dtype = decoder.inputs["kv_cache"]
+        self.kv_caches = [np.ascontiguousarray(kv_cache, dtype=kv_dtype), np.empty(kv_cache.shape, dtype=kv_dtype)]
+        self.kv_values = [ort.OrtValue.ortvalue_from_numpy(cache) for cache in self.kv_caches]
+        self.current = 0
+
+        n_group, n_state = kv_cache.shape[1], kv_cache.shape[-1]
+        outputs = decoder.sess.get_outputs()
+        self.kv_cache_name = outputs[1].name
+        self.outputs: List[Optional[np.ndarray]] = []
+        for index, output in enumerate(outputs):
+            if index == 0:
+                shape = (n_group, n_query, n_vocab)
+            elif index == 1:
+                shape = kv_cache.shape
+            else:
+                shape = (n_group, n_query, n_state)
+
+            if index == 1:
+                self.outputs.append(None)   # bound to the spare kv cache on every step
+            elif self._matches(output.shape, shape):
+                buffer = np.empty(shape, dtype=onnx_dtype_to_np_dtype_convert(output.type))
+                self.binding.bind_ortvalue_output(output.name, ort.OrtValue.ortvalue_from_numpy(buffer))
+                self.outputs.append(buffer)
+            else:
+                # unexpected static shape, let ORT allocate this output
+                self.binding.bind_output(output.name, "cpu")
+                self.outputs.append(None)
+
+    @staticmethod
+    def _matches(declared_shape, shape) -> bool:
+        if len(declared_shape) != len(shape):
+            return False
+        return all(not isinstance(d, int) or d == s for d, s in zip(declared_shape, shape))
+
+    @property
+    def kv_cache(self) -> np.ndarray:
+        return self.kv_caches[self.current]
+
+    def __call__(
+        self,
+        x: np.ndarray,
+        mask: np.ndarray,
+        pe: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, List[np.ndarray]]:
+        inputs = self.decoder.inputs
+        # keep references to the bound arrays until the run is done, ORT may read them in place
+        x = np.ascontiguousarray(x, dtype=inputs["tokens"])
+        mask = np.ascontiguousarray(mask, dtype=inputs["mask"])
+        pe = np.ascontiguousarray(pe, dtype=inputs["pe"])
+        self.binding.bind_cpu_input("tokens", x)
+        self.binding.bind_cpu_input("mask", mask)
+        self.binding.bind_cpu_input("pe", pe)
+        self.binding.bind_ortvalue_input("kv_cache", self.kv_values[self.current])
+        self.binding.bind_ortvalue_output(self.kv_cache_name, self.kv_values[1 - self.current])
+
+        self.decoder.sess.run_with_iobinding(self.binding)
+        self.current = 1 - self.current
+
+        outputs = self.outputs
+        if any(buffer is None for index, buffer in enumerate(outputs) if index != 1):
+            ort_outputs = self.binding.get_outputs()
+            outputs = [
+                buffer if buffer is not None or index == 1 else ort_outputs[index].numpy()
+                for index, buffer in enumerate(outputs)
+            ]
+        return outputs[0], self.kv_cache, outputs[2:]
+
+    def rearrange_kv_cache(self, source_indices) -> np.ndarray:
+        np.take(self.kv_caches[self.current], source_indices, axis=1, out=self.kv_caches[1 - self.current], mode="clip")
+        self.current = 1 - self.current
+        return self.kv_cache
+
 
 class Whisper():
     def __init__(
@@ -227,14 +341,26 @@ class Whisper():
         onnx_decoder_path: str,
         encoder_target: str,
         decoder_target: str,
+        intra_op_num_threads: Optional[int] = None,
     ):
         self.model_name = model_name
         self.dims = dims
 
         # encoder target: `cpu` or `aie`
-        self.encoder = OnnxAudioEncoder(model=model_name, model_path=onnx_encoder_path, target=encoder_target)
+        self.encoder = OnnxAudioEncoder(model=model_name, model_path=onnx_encoder_path, target=encoder_target, intra_op_num_threads=intra_op_num_threads)
         # decoder target: `cpu` or `aie`
-        self.decoder = OnnxTextDecoder(model=model_name, model_path=onnx_decoder_path, target=decoder_target)
+        self.decoder = OnnxTextDecoder(model=model_name, model_path=onnx_decoder_path, target=decoder_target, intra_op_num_threads=intra_op_num_threads)
+
+        # decoder inputs which are the same for every decode, shared by the clones so they are read-only
+        self.positional_embedding = np.load("./tiny_pe.npy")
+        self.positional_embedding.flags.writeable = False
+        n_text_ctx = dims.n_text_ctx
+        self.causal_mask = np.full((n_text_ctx, n_text_ctx), -np.inf)
+        self.causal_mask[np.tril_indices(n_text_ctx, k=0)] = 0
+        self.causal_mask.flags.writeable = False
+
+        # prepared DecodingTasks keyed by DecodingOptions without prompt and prefix and the number of initial tokens, see `whisper.decoding.get_decoding_task`
+        self.decoding_tasks = OrderedDict()
 
     def embed_audio(
         self,
@@ -260,6 +386,17 @@ class Whisper():
         output, _ = self.decoder(tokens, self.encoder(mel), kv_cache=kv_cache, offset=0)
         return output
 
+    def clone(self) -> "Whisper":
+        """
+        Returns a new Whisper instance which shares this instance's ONNX Runtime sessions.
+        Building the sessions is the expensive part of loading a model (minutes on the VitisAI EP),
+        while `InferenceSession.run` is safe to call from several threads at once.
+        The decoding tasks hold per-decode state, so the clone starts with its own empty cache.
+        """
+        clone = copy.copy(self)
+        clone.decoding_tasks = OrderedDict()
+        return clone
+
     @property
     def is_multilingual(self):
         return self.dims.n_vocab == 51865
@@ -288,3 +425,4 @@ class Whisper():
     detect_language = detect_language_function
     # transcribe = transcribe_function
     decode = decode_function
+    decode_batch = decode_batch_function
@@ -0,0 +1,215 @@
+from dataclasses import dataclass
+from typing import Generator, List, Optional, Tuple, TYPE_CHECKING
+
+import numpy as np
+
+from whisper.audio import HOP_LENGTH, N_FRAMES, N_SAMPLES, SAMPLE_RATE, IncrementalLogMel, num_frames
+from whisper.decoding import DecodingOptions, DecodingResult
+from whisper.tokenizer import IncrementalDetokenizer, Tokenizer, get_tokenizer
+
+if TYPE_CHECKING:
+    from whisper.model import Whisper
+    from batch_scheduler import BatchScheduler
+
+
+@dataclass(frozen=True)
+class StreamingUpdate:
+    committed: str          # committed text of the current line, later updates only append to it
+    partial: str            # unstable tail of the current line, the next update may rewrite it
+    final: bool = False     # the line is complete, the next update starts a new line
+    start: float = 0.0      # the start of the line's audio, in seconds since the start of the stream
+    end: float = 0.0        # the end of the decoded audio of the line
+
+    @property
+    def text(self) -> str:
+        return (self.committed + self.partial).strip()
+
+    @property
+    def stable_length(self) -> int:
+        """The length of the committed prefix of `text`"""
+        return min(len(self.committed.lstrip()), len(self.text))
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class StreamingTranscriber:
+    """
+    Incremental transcription of a live 16 kHz audio stream.
+
+    New PCM is appended to a rolling window of at most `N_SAMPLES` (10.24 seconds), and each `process()` decodes
+    the window once. The tokens on which two consecutive hypotheses agree (local agreement) are committed:
+    they are forced as the decoding prefix of the following decodes, so they are not decoded again, and text
+    committed in earlier windows is given as the prompt. When the window is full it rolls over: the last
+    hypothesis is committed and the window restarts at the audio which was not decoded yet.
+
+    The log-Mel frames are computed as the audio is inserted (see `IncrementalLogMel`), so a `process()` only
+    pays for the STFT of the new audio.
+
+    A transcriber holds the state of one stream and is not thread safe, but `process()` may run on any thread
+    with any model instance, e.g. `await inference_executor.run(transcriber.process)`, or its decodes can be
+    batched with other streams' by `process_batched()`.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_prompt_tokens: int = 64,
+        no_speech_threshold: Optional[float] = 0.6,
+        logprob_threshold: Optional[float] = -1.0,
+        **decode_options,
+    ):
+        """
+        Parameters
+        ----------
+        max_prompt_tokens: int
+            How many of the last committed tokens before the window are given as the prompt, 0 disables the prompt
+
+        no_speech_threshold: float
+            If the no_speech probability is higher than this value AND the average log probability
+            over sampled tokens is below `logprob_threshold`, the window is considered silent
+
+        logprob_threshold: float
+            See `no_speech_threshold`
+
+        decode_options: dict
+            Keyword arguments to construct the `DecodingOptions`, except `prompt` and `prefix`
+        """
+        self.max_prompt_tokens = max_prompt_tokens
+        self.no_speech_threshold = no_speech_threshold
+        self.logprob_threshold = logprob_threshold
+        self.decode_options = decode_options
+        self.tokenizer: Optional[Tokenizer] = None
+
+        self.frontend = IncrementalLogMel()
+        self.mel = np.zeros((self.frontend.n_mels, N_FRAMES), dtype=np.float32)
+        self.window_start = 0                       # the first sample of the window, since the last roll over
+        self.decoded_until = 0                      # the end of the audio covered by `hypothesis`
+        self.line_start = 0                         # the first sample of the current line
+        self.window_tokens: List[int] = []          # committed in this window, the decoding prefix
+        self.context_tokens: List[int] = []         # committed before this window, the decoding prompt
+        self.line_text: Optional[IncrementalDetokenizer] = None   # the text committed in the current line
+        self.hypothesis: List[int] = []             # decoded after `window_tokens`, not agreed on yet
+
+    def insert_audio(self, audio: np.ndarray):
+        """Appends float32 PCM sampled at 16 kHz to the window"""
+        self.frontend.push(audio)
+
+    def process(self, model: "Whisper") -> StreamingUpdate:
+        """
+        Decodes the audio inserted since the last call with `model`, and returns the current line.
+        """
+        self._init_tokenizer(model.is_multilingual)
+        steps = self._process()
+        try:
+            mel, options = next(steps)
+            while True:
+                mel, options = steps.send(model.decode(mel, options))
+        except StopIteration as stop:
+            return stop.value
+
+    async def process_batched(self, scheduler: "BatchScheduler") -> StreamingUpdate:
+        """
+        Like `process()`, but the decodes are batched with the other sessions' by `scheduler` (see `BatchScheduler`).
+        """
+        self._init_tokenizer(scheduler.is_multilingual)
+        steps = self._process()
+        try:
+            mel, options = next(steps)
+            while True:
+                mel, options = steps.send(await scheduler.decode(mel, options))
+        except StopIteration as stop:
+            return stop.value
+
+    def _process(self) -> Generator[Tuple[np.ndarray, DecodingOptions], DecodingResult, StreamingUpdate]:
+        # yields the (mel, options) to decode and is sent the results, so the decodes can run anywhere
+        end = self.frontend.n_samples
+        if end == self.decoded_until:
+            return self._update()
+
+        while end - self.window_start > N_SAMPLES:
+            if self.decoded_until == self.window_start:
+                # more than a window of new audio, decode its first window on its own
+                self.hypothesis = self._hypothesis((yield self._decoding_input(self.window_start + N_SAMPLES)))
+                self.decoded_until = self.window_start + N_SAMPLES
+            self._roll_over()
+
+        hypothesis = self._hypothesis((yield self._decoding_input(end)))
+        self.decoded_until = end
+
+        agreed = common_prefix_length(self.hypothesis, hypothesis)
+        self._commit(hypothesis[:agreed])
+        self.hypothesis = hypothesis[agreed:]
+        return self._update()
+
+    def end_phrase(self) -> StreamingUpdate:
+        """
+        Completes the current line: the last hypothesis is committed and the window is cleared.
+        Audio inserted since the last `process()` is dropped.
+        """
+        self._commit(self.hypothesis)
+        self.hypothesis = []
+        if self.line_text is not None:
+            self.line_text.flush()
+        update = self._update(final=True)
+
+        self._extend_context()
+        self.window_start = self.decoded_until = self.line_start = self.frontend.n_samples
+        self.window_tokens = []
+        if self.tokenizer is not None:
+            self.line_text = IncrementalDetokenizer(self.tokenizer)
+        return update
+
+    def _init_tokenizer(self, multilingual: bool):
+        if self.tokenizer is None:
+            self.tokenizer = get_tokenizer(
+                multilingual, language=self.decode_options.get("language") or "en", task=self.decode_options.get("task", "transcribe")
+            )
+            self.line_text = IncrementalDetokenizer(self.tokenizer)
+
+    def _decoding_input(self, end: int) -> Tuple[np.ndarray, DecodingOptions]:
+        # the window up to the sample `end`; the frames older than the ring buffer were never decoded, they are skipped
+        start = max(self.window_start // HOP_LENGTH, self.frontend.first_frame)
+        stop = min(num_frames(end), start + N_FRAMES)
+        mel = self.frontend.log_mel(start, stop, out=self.mel)
+        options = DecodingOptions(**self.decode_options, prompt=self.context_tokens or None, prefix=self.window_tokens or None)
+        return mel, options
+
+    def _hypothesis(self, result: DecodingResult) -> List[int]:
+        if self.no_speech_threshold is not None and result.no_speech_prob > self.no_speech_threshold:
+            if self.logprob_threshold is None or result.avg_logprob <= self.logprob_threshold:
+                return []
+        return [token for token in result.tokens if token < self.tokenizer.eot]
+
+    def _commit(self, tokens: List[int]):
+        self.window_tokens += tokens
+        if self.line_text is not None:
+            self.line_text.push(tokens)
+
+    def _extend_context(self):
+        # the window's committed tokens become part of the prompt for the next window
+        if self.max_prompt_tokens > 0:
+            self.context_tokens = (self.context_tokens + self.window_tokens)[-self.max_prompt_tokens:]
+
+    def _roll_over(self):
+        # the window is full, commit what was decoded of it and restart at the audio which was not
+        self._commit(self.hypothesis)
+        self.hypothesis = []
+        self._extend_context()
+        self.window_tokens = []
+        self.window_start = self.decoded_until
+
+    def _update(self, final: bool = False) -> StreamingUpdate:
+        start, end = self.line_start / SAMPLE_RATE, self.decoded_until / SAMPLE_RATE
+        if self.line_text is None:
+            return StreamingUpdate(committed="", partial="", final=final, start=start, end=end)
+        # only the hypothesis is decoded again, the committed text was decoded as its tokens were committed
+        committed = self.line_text.text
+        partial = self.line_text.preview(self.hypothesis)
+        return StreamingUpdate(committed=committed, partial=partial, final=final, start=start, end=end)
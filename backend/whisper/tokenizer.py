@@ -1,10 +1,12 @@
+import codecs
+import json
 import os
 from dataclasses import dataclass
 from functools import lru_cache
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
-from transformers import GPT2TokenizerFast
+import regex
 
 LANGUAGES = {
     "en": "english",
@@ -125,19 +127,151 @@ TO_LANGUAGE_CODE = {
 }
 
 
+@lru_cache()
+def bytes_to_unicode() -> Dict[int, str]:
+    """
+    GPT-2's reversible mapping of the bytes to printable unicode characters, the BPE vocabulary is written with
+    these characters
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(256):
+        if b not in bs:
+            bs.append(b)
+            cs.append(256 + n)
+            n += 1
+    return dict(zip(bs, map(chr, cs)))
+
+
+class ByteLevelBPE:
+    """
+    GPT-2's byte-level BPE, read from the `vocab.json`, `merges.txt` and `added_tokens.json` of a tokenizer directory.
+
+    It encodes and decodes exactly as the `GPT2TokenizerFast` this module used to build from the same files
+    (including the clean up of the spaces before punctuation when decoding), without importing `transformers`.
+    The special tokens are added after the vocabulary, in order, and are matched in the text before the BPE.
+    """
+
+    pattern = regex.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+
+    def __init__(self, path: str, special_tokens: Sequence[str] = (), cache_size: int = 2**14):
+        with open(os.path.join(path, "vocab.json"), encoding="utf-8") as f:
+            self.vocab: Dict[str, int] = json.load(f)
+        added_tokens: Dict[str, int] = {}
+        if os.path.exists(os.path.join(path, "added_tokens.json")):
+            with open(os.path.join(path, "added_tokens.json"), encoding="utf-8") as f:
+                added_tokens = json.load(f)
+        with open(os.path.join(path, "special_tokens_map.json"), encoding="utf-8") as f:
+            self.eos_token: str = json.load(f)["eos_token"]
+        with open(os.path.join(path, "merges.txt"), encoding="utf-8") as f:
+            # like GPT2Tokenizer, the first line is skipped as the version header and the last as empty
+            merges = [tuple(merge.split()) for merge in f.read().split("\n")[1:-1]]
+        self.ranks: Dict[Tuple[str, str], int] = {merge: rank for rank, merge in enumerate(merges)}
+
+        for token, token_id in sorted(added_tokens.items(), key=lambda item: item[1]):
+            self.vocab.setdefault(token, token_id)
+        self.additional_special_tokens: List[str] = list(special_tokens)
+        for token in self.additional_special_tokens:
+            self.vocab.setdefault(token, len(self.vocab))
+        self.additional_special_tokens_ids: List[int] = [self.vocab[token] for token in self.additional_special_tokens]
+        self.eos_token_id: int = self.vocab[self.eos_token]
+        self.all_special_ids: List[int] = [self.eos_token_id, *self.additional_special_tokens_ids]
+
+        # the special tokens are matched in the text as a whole, the longest first
+        specials = sorted({self.eos_token, *added_tokens, *self.additional_special_tokens}, key=len, reverse=True)
+        self.special_pattern = regex.compile("|".join(map(regex.escape, specials)))
+        self.special_tokens = frozenset(specials)
+
+        # the bytes of each token id, the ids which are not in the vocabulary decode to nothing
+        byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+        self.byte_encoder = bytes_to_unicode()
+        self.token_bytes: List[bytes] = [b""] * len(self.vocab)
+        for token, token_id in self.vocab.items():
+            if token in self.special_tokens or any(c not in byte_decoder for c in token):
+                self.token_bytes[token_id] = token.encode("utf-8")
+            else:
+                self.token_bytes[token_id] = bytes(byte_decoder[c] for c in token)
+
+        self._bpe = lru_cache(maxsize=cache_size)(self._merge)
+
+    def __len__(self) -> int:
+        return len(self.vocab)
+
+    def encode(self, text: str) -> List[int]:
+        tokens = []
+        start = 0
+        for special in self.special_pattern.finditer(text):
+            self._encode_ordinary(text[start : special.start()], tokens)
+            tokens.append(self.vocab[special.group()])
+            start = special.end()
+        self._encode_ordinary(text[start:], tokens)
+        return tokens
+
+    def decode(self, token_ids: Union[int, List[int], np.ndarray]) -> str:
+        return clean_up_tokenization(self.decode_bytes(token_ids).decode("utf-8", errors="replace"))
+
+    def decode_bytes(self, token_ids: Union[int, List[int], np.ndarray]) -> bytes:
+        """The UTF-8 bytes of the tokens, before they are decoded to text"""
+        if isinstance(token_ids, (int, np.integer)):
+            token_ids = [token_ids]
+        n_tokens = len(self.token_bytes)
+        return b"".join(self.token_bytes[i] for i in map(int, token_ids) if 0 <= i < n_tokens)
+
+    def _encode_ordinary(self, text: str, tokens: List[int]):
+        for word in self.pattern.findall(text):
+            tokens.extend(self._bpe("".join(self.byte_encoder[b] for b in word.encode("utf-8"))))
+
+    def _merge(self, word: str) -> Tuple[int]:
+        parts = list(word)
+        while len(parts) > 1:
+            ranks = [self.ranks.get(pair, -1) for pair in zip(parts, parts[1:])]
+            best = min((rank for rank in ranks if rank >= 0), default=-1)
+            if best < 0:
+                break
+            # merge every occurrence of the best pair, from the left
+            merged = []
+            i = 0
+            while i < len(parts):
+                if i < len(parts) - 1 and ranks[i] == best:
+                    merged.append(parts[i] + parts[i + 1])
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = merged
+        return tuple(self.vocab[part] for part in parts)
+
+
+def clean_up_tokenization(text: str) -> str:
+    """Removes the spaces before punctuation and contractions, as `transformers` does after decoding"""
+    return (
+        text.replace(" .", ".")
+        .replace(" ?", "?")
+        .replace(" !", "!")
+        .replace(" ,", ",")
+        .replace(" ' ", "'")
+        .replace(" n't", "n't")
+        .replace(" 'm", "'m")
+        .replace(" 's", "'s")
+        .replace(" 've", "'ve")
+        .replace(" 're", "'re")
+    )
+
+
 @dataclass(frozen=True)
 class Tokenizer:
-    """A thin wrapper around `GPT2TokenizerFast` providing quick access to special tokens"""
+    """A thin wrapper around `ByteLevelBPE` providing quick access to special tokens"""
 
-    tokenizer: "GPT2TokenizerFast"
+    tokenizer: ByteLevelBPE
     language: Optional[str]
     sot_sequence: Tuple[int]
 
-    def encode(self, text, **kwargs):
-        return self.tokenizer.encode(text, **kwargs)
+    def encode(self, text):
+        return self.tokenizer.encode(text)
 
-    def decode(self, token_ids: Union[int, List[int], np.ndarray], **kwargs):
-        return self.tokenizer.decode(token_ids, **kwargs)
+    def decode(self, token_ids: Union[int, List[int], np.ndarray]):
+        return self.tokenizer.decode(token_ids)
 
     def decode_with_timestamps(self, tokens) -> str:
         """
@@ -269,11 +403,57 @@ class Tokenizer:
         return tokens[0]
 
 
+class IncrementalDetokenizer:
+    """
+    Decodes a stream of tokens as they arrive, `push()` returns only the text completed by the new tokens, so each
+    call costs in proportion to them. A character whose UTF-8 bytes are split across tokens is emitted with its
+    last byte, and the last few characters, which the spaces clean up of `decode()` may still change, are held back
+    until the next tokens settle them. After `flush()`, the emitted text is `decode()` of all the tokens.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""      # decoded, but not emitted yet
+        self._emitted: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """The text emitted so far"""
+        return "".join(self._emitted)
+
+    def push(self, token_ids: Union[int, List[int], np.ndarray]) -> str:
+        """Adds tokens to the stream, and returns the text they completed"""
+        self._pending += self._decoder.decode(self.tokenizer.tokenizer.decode_bytes(token_ids))
+        # the clean up patterns start with a space and are at most 4 characters long, so none of them can cross
+        # a split which has no space among the 3 characters before it
+        split = len(self._pending)
+        while " " in self._pending[max(split - 3, 0) : split]:
+            split = self._pending.rfind(" ", 0, split)
+        return self._emit(split)
+
+    def flush(self) -> str:
+        """Ends the stream, and returns the rest of its text"""
+        self._pending += self._decoder.decode(b"", final=True)
+        return self._emit(len(self._pending))
+
+    def preview(self, token_ids: Union[int, List[int], np.ndarray] = ()) -> str:
+        """The text which pushing `token_ids` and flushing would emit, without changing the stream"""
+        buffered, _ = self._decoder.getstate()
+        data = buffered + self.tokenizer.tokenizer.decode_bytes(token_ids)
+        return clean_up_tokenization(self._pending + data.decode("utf-8", errors="replace"))
+
+    def _emit(self, split: int) -> str:
+        text = clean_up_tokenization(self._pending[:split])
+        self._pending = self._pending[split:]
+        if text:
+            self._emitted.append(text)
+        return text
+
+
 @lru_cache(maxsize=None)
 def build_tokenizer(name: str = "gpt2"):
-    os.environ["TOKENIZERS_PARALLELISM"] = "false"
     path = os.path.join(os.path.dirname(__file__), "assets", name)
-    tokenizer = GPT2TokenizerFast.from_pretrained(path)
 
     specials = [
         "<|startoftranscript|>",
@@ -286,8 +466,7 @@ def build_tokenizer(name: str = "gpt2"):
         "<|notimestamps|>",
     ]
 
-    tokenizer.add_special_tokens(dict(additional_special_tokens=specials))
-    return tokenizer
+    return ByteLevelBPE(path, specials)
 
 
 @lru_cache(maxsize=None)
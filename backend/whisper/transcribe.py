@@ -6,8 +6,11 @@ import json
 import argparse
 import time
 import warnings
+import glob
 import multiprocessing
-from typing import List, Optional, Tuple, Union, TYPE_CHECKING
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Any, List, Optional, Tuple, Union, TYPE_CHECKING
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -17,17 +20,19 @@ warnings.simplefilter(action='ignore', category=RuntimeWarning)
 warnings.filterwarnings(action="ignore", message="None of PyTorch, TensorFlow >= 2.0, or Flax have been found.*")
 
 import numpy as np
+import psutil
 import tqdm
 import pyaudiowpatch as pyaudio
 import soundfile as sf
 import speech_recognition as sr
 
 from whisper.model import load_model, available_models
-from whisper.audio import SAMPLE_RATE, N_FRAMES, HOP_LENGTH, pad_or_trim, log_mel_spectrogram
+from whisper.audio import SAMPLE_RATE, N_FRAMES, N_SAMPLES, HOP_LENGTH, IncrementalLogMel, load_audio, load_audio_chunks
 from whisper.decoding import DecodingOptions, DecodingResult
-from whisper.tokenizer import LANGUAGES, TO_LANGUAGE_CODE, get_tokenizer
-from whisper.utils import exact_div, format_timestamp, optional_int, optional_float, str2bool, DisplayCPU
+from whisper.tokenizer import LANGUAGES, TO_LANGUAGE_CODE, IncrementalDetokenizer, get_tokenizer
+from whisper.utils import exact_div, format_timestamp, optional_int, optional_float, str2bool, prefetch, DisplayCPU, write_srt, write_txt, write_vtt
 from whisper.metrics import postprocess, word_error_rate
+from whisper.vad import SpeechDetector, load_speech_detector
 
 if TYPE_CHECKING:
     from whisper.model import Whisper
@@ -57,6 +62,25 @@ class Color:
     BG_DEFAULT     = '\033[49m'
     RESET          = '\033[0m'
 
+OVERLAP_FRAMES = 200    # 2 seconds: how much a window overlaps with the previous one, when it had no timestamps
+OVERLAP_TOKENS = 48     # the tokens compared to find the text decoded from the overlap twice
+
+
+def overlap_length(previous: List[int], tokens: List[int], min_length: int = 2) -> int:
+    """
+    How many of the first `tokens` repeat `previous`, which was decoded from a window overlapping with theirs:
+    the tokens up to the end of the longest run the two have in common, if it has at least `min_length` tokens
+    """
+    best, end = 0, 0
+    run = [0] * (len(tokens) + 1)   # run[j]: the common run ending at the current token of `previous` and tokens[j - 1]
+    for token in previous:
+        for j in range(len(tokens), 0, -1):
+            run[j] = run[j - 1] + 1 if tokens[j - 1] == token else 0
+            if run[j] > best:
+                best, end = run[j], j
+    return end if best >= min_length else 0
+
+
 def transcribe(
     *,
     model: "Whisper",
@@ -67,6 +91,7 @@ def transcribe(
     logprob_threshold: Optional[float] = -1.0,
     no_speech_threshold: Optional[float] = 0.6,
     condition_on_previous_text: bool = True,
+    speech_detector: Union[str, SpeechDetector, None] = None,
     **decode_options,
 ):
     """
@@ -103,6 +128,12 @@ def transcribe(
         disabling may make the text inconsistent across windows, but the model becomes less prone to
         getting stuck in a failure loop, such as repetition looping or timestamps going out of sync.
 
+    speech_detector: Union[str, SpeechDetector]
+        Checks each window for speech before it is encoded, the windows without speech are neither encoded nor
+        decoded: "energy", the path to an ONNX model or a `SpeechDetector` (see `load_speech_detector`).
+        If None, every window is encoded, and a silent one is only skipped after its first decoder step
+        by `no_speech_threshold`
+
     decode_options: dict
         Keyword arguments to construct `DecodingOptions` instances
 
@@ -110,19 +141,74 @@ def transcribe(
     -------
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
     the spoken language ("language"), which is detected when `decode_options["language"]` is None.
+    "windows" counts the windows of the audio, and "skipped_windows" those the speech detector found no
+    speech in, their ratio is "vad_skip_ratio". "encoder_guesses" counts the windows encoded ahead of the
+    decoder, "encoder_guess_hits" those which were the next window, and "guess_hit_rate" their ratio.
+
+    The audio is read and turned into log-Mel frames one window at a time (see `IncrementalLogMel`), so a long
+    file is transcribed in constant memory. Each window is normalized on its own; audio of up to one window
+    (10.24 seconds) gives the same spectrogram as `log_mel_spectrogram`.
+
+    The work is pipelined: ffmpeg decodes the file ahead on a background thread, and while the decoder loop
+    runs on a window, the next window is read, turned into log-Mel frames and encoded by the encoder stage.
+    This is done only where the next window's start is known before decoding: after a window without speech,
+    and without timestamps (the no-speech check may still move it). With timestamps the next window starts at
+    the last decoded timestamp, so it is encoded once the current window is decoded.
     """
-    mel: np.ndarray = log_mel_spectrogram(audio)
+    if isinstance(audio, str):
+        chunks = prefetch(load_audio_chunks(audio), size=4)
+    else:
+        audio = np.asarray(audio, dtype=np.float32)
+        chunks = (audio[i : i + N_SAMPLES // 2] for i in range(0, len(audio), N_SAMPLES // 2))
+    audio_chunks = chunks
+    # the chunks are at most half a window long, so the frames from the current window on stay in the ring
+    # buffer while the encoder stage reads up to the end of the window after the next one
+    frontend = IncrementalLogMel(capacity=3 * N_FRAMES)
+    window = np.zeros((1, frontend.n_mels, N_FRAMES), dtype=np.float32)
+    speech_detector = load_speech_detector(speech_detector)
+
+    def read_frames(stop: int) -> int:
+        """Reads the audio until the frames up to `stop` can be computed, returns the last available frame up to it"""
+        nonlocal chunks
+        while chunks is not None and frontend.n_computed < stop:
+            chunk = next(chunks, None)
+            if chunk is None:
+                chunks = None   # the end of the audio, its last frames reach into the zero padding
+            else:
+                frontend.push(chunk)
+        return min(stop, frontend.n_frames if chunks is None else frontend.n_computed)
+
+    def encode_window(start: int) -> Tuple[int, bool, Optional[np.ndarray], float, Any]:
+        """
+        Runs on the encoder stage: computes the window from the frame `start`, returns the end of its audio,
+        whether more audio follows a full window, its audio features, the encoder running time and the state
+        of the speech detector after the window, committed if the window is the one decoded next.
+        The audio features are None for a window without speech, which is not encoded
+        """
+        stop = read_frames(start + N_FRAMES)
+        if start >= stop:
+            return stop, False, None, 0.0, None
+        has_more = stop == start + N_FRAMES and read_frames(stop + 1) > stop
+        detector_state = None
+        if speech_detector is not None:
+            log_spec = frontend.log_mel(start, stop, out=window[0], normalize=False)
+            has_speech, detector_state = speech_detector.detect(log_spec[:, :stop - start])
+            if not has_speech:
+                return stop, has_more, None, 0.0, detector_state
+        frontend.log_mel(start, stop, out=window[0])
+        encoder_start = time.perf_counter()
+        audio_features = model.encoder(window)
+        return stop, has_more, audio_features, time.perf_counter() - encoder_start, detector_state
 
     if decode_options.get("language", None) is None:
         if verbose:
             print("Detecting language using up to the first 30 seconds. Use `--language` to specify the language")
-        segment = pad_or_trim(mel, N_FRAMES)
+        segment = frontend.log_mel(0, read_frames(N_FRAMES))
         _, probs = model.detect_language(segment)
         decode_options["language"] = max(probs, key=probs.get)
         if verbose is not None:
             print(f"Detected language: {LANGUAGES[decode_options['language']].title()}")
 
-    mel = mel[np.newaxis, ...]
     language = decode_options["language"]
     task = decode_options.get("task", "transcribe")
     tokenizer = get_tokenizer(model.is_multilingual, language=language, task=task)
@@ -177,6 +263,12 @@ def transcribe(
     all_tokens = []
     all_segments = []
     prompt_reset_since = 0
+    transcript = IncrementalDetokenizer(tokenizer)  # the text of the tokens after the initial prompt, decoded as they are added
+    # <|startofprev|>, the prompt, the SOT sequence and the sampled tokens each take a row of the positional
+    # embedding table, which is shorter than n_text_ctx
+    sot_sequence = tokenizer.sot_sequence_including_notimestamps if decode_options.get("without_timestamps") else tokenizer.sot_sequence
+    sample_len = decode_options.get("sample_len") or model.dims.n_text_ctx // 2
+    max_prompt_len = max(0, len(model.positional_embedding) - 1 - len(sot_sequence) - sample_len)
 
     initial_prompt = decode_options.pop("initial_prompt", None) or []
     if initial_prompt:
@@ -207,25 +299,59 @@ def transcribe(
         if verbose:
             print(f"[{format_timestamp(start)} --> {format_timestamp(end)}] {text}", flush=True)
 
-    # show the progress bar when verbose is False (otherwise the transcribed text will be printed)
-    num_frames = mel.shape[-1]
-    previous_seek_value = seek
-    audio_duration = num_frames * HOP_LENGTH / SAMPLE_RATE
-
-    # with tqdm.tqdm(total=num_frames, unit='frames', disable=verbose is not False) as pbar:
     encoder_time, decoder_time = 0, 0
-    for _ in range(num_frames):
-        # print(f"num_frames: {num_frames}")
-        while seek < num_frames:
-            timestamp_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
-            segment = pad_or_trim(mel[:, :, seek:], N_FRAMES)
-            segment_duration = segment.shape[-1] * HOP_LENGTH / SAMPLE_RATE
-            decode_options["prompt"] = all_tokens[prompt_reset_since:]
-            results, once_encoder_time, once_decoder_time = decode_with_fallback(segment)
+    overlap_until = 0.0     # the end of the previous window, when the current one overlaps with it
+    overlap_tokens = []     # the last tokens decoded from the previous window
+    segment_duration = N_FRAMES * HOP_LENGTH / SAMPLE_RATE
+    n_windows, skipped_windows = 0, 0
+    n_guesses, guess_hits = 0, 0
+    # one thread, so the windows are read and encoded in order, while the decoder loop runs on this one
+    encoder_stage = ThreadPoolExecutor(max_workers=1, thread_name_prefix="encoder")
+    try:
+        encoding = (seek, encoder_stage.submit(encode_window, seek))   # the window being encoded, and its start
+        while True:
+            if encoding is None or encoding[0] != seek:
+                # not encoded ahead, or a wrong guess: the actual window is encoded after it
+                encoding = (seek, encoder_stage.submit(encode_window, seek))
+            elif n_windows > 0:
+                guess_hits += 1
+            stop, has_more, audio_features, once_encoder_time, detector_state = encoding[1].result()
+            if seek >= stop:
+                break
+            if speech_detector is not None:
+                # before the next window is looked at, so the windows encoded ahead don't change the detection
+                speech_detector.commit(detector_state)
+            n_windows += 1
             encoder_time += once_encoder_time
+            # the next window is encoded while this one is decoded, if its start is known
+            if audio_features is None:
+                guess = seek + N_FRAMES
+            elif decode_options.get("without_timestamps"):
+                guess = seek + N_FRAMES - OVERLAP_FRAMES if has_more else seek + N_FRAMES
+            else:
+                guess = None
+            encoding = None
+            if guess is not None:
+                n_guesses += 1
+                encoding = (guess, encoder_stage.submit(encode_window, guess))
+
+            if audio_features is None:
+                # no speech in the window, it was not encoded
+                skipped_windows += 1
+                overlap_until, overlap_tokens = 0.0, []
+                seek += N_FRAMES
+                continue
+
+            timestamp_offset = float(seek * HOP_LENGTH / SAMPLE_RATE)
+            decode_options["prompt"] = all_tokens[max(prompt_reset_since, len(all_tokens) - max_prompt_len):]
+            results, _, once_decoder_time = decode_with_fallback(audio_features)
             decoder_time += once_decoder_time
             result = results[0]
-            tokens = result.tokens
+            tokens = np.asarray(result.tokens, dtype=np.int64)
+
+            previous_overlap_until, previous_overlap_tokens = overlap_until, overlap_tokens
+            overlap_until, overlap_tokens = 0.0, []
+            previous_seek = seek
 
             if no_speech_threshold is not None:
                 # no voice activity check
@@ -235,13 +361,14 @@ def transcribe(
                     should_skip = False
 
                 if should_skip:
-                    seek += segment.shape[-1]  # fast-forward to the next segment boundary
+                    seek += N_FRAMES  # fast-forward to the next segment boundary
                     continue
 
             timestamp_tokens: np.ndarray = np.greater_equal(tokens, tokenizer.timestamp_begin)
             consecutive = np.add(np.where(timestamp_tokens[:-1] & timestamp_tokens[1:])[0], 1)
             if len(consecutive) > 0:  # if the output contains two consecutive timestamp tokens
                 last_slice = 0
+                keep_from = None    # the segments ending in the overlap with the previous window were transcribed with it
                 for current_slice in consecutive:
                     sliced_tokens = tokens[last_slice:current_slice]
                     start_timestamp_position = (
@@ -250,50 +377,201 @@ def transcribe(
                     end_timestamp_position = (
                         sliced_tokens[-1] - tokenizer.timestamp_begin
                     )
-                    add_segment(
-                        start=timestamp_offset + start_timestamp_position * time_precision,
-                        end=timestamp_offset + end_timestamp_position * time_precision,
-                        text_tokens=sliced_tokens[1:-1],
-                        result=result,
-                    )
+                    end = timestamp_offset + end_timestamp_position * time_precision
+                    if end > previous_overlap_until:
+                        keep_from = last_slice if keep_from is None else keep_from
+                        add_segment(
+                            start=timestamp_offset + start_timestamp_position * time_precision,
+                            end=end,
+                            text_tokens=sliced_tokens[1:-1],
+                            result=result,
+                        )
                     last_slice = current_slice
                 last_timestamp_position = (
                     tokens[last_slice - 1] - tokenizer.timestamp_begin
                 )
                 seek += last_timestamp_position * input_stride
-                all_tokens.extend(list(tokens[: last_slice + 1]))
+                kept_tokens = tokens[keep_from : last_slice + 1] if keep_from is not None else tokens[:0]
             else:
                 duration = segment_duration
-                tokens = np.asarray(tokens) if isinstance(tokens, list) else tokens
-                timestamps = tokens[
-                    np.ravel_multi_index(np.nonzero(timestamp_tokens), timestamp_tokens.shape)
-                ]
+                timestamps = tokens[timestamp_tokens]
                 if len(timestamps) > 0:
                     # no consecutive timestamps but it has a timestamp; use the last one.
                     # single timestamp at the end means no speech after the last timestamp.
                     last_timestamp_position = timestamps[-1] - tokenizer.timestamp_begin
                     duration = last_timestamp_position * time_precision
 
+                # the tokens repeating the end of the previous window were decoded from the overlap
+                kept_tokens = tokens[overlap_length(previous_overlap_tokens, tokens[:OVERLAP_TOKENS].tolist()):]
                 add_segment(
                     start=timestamp_offset,
                     end=timestamp_offset + duration,
-                    text_tokens=tokens,
+                    text_tokens=kept_tokens,
                     result=result,
                 )
 
-                seek += segment.shape[-1]
-                all_tokens.extend(list(tokens))
+                if len(timestamps) == 0 and has_more:
+                    # the speech may go on past the window, and a word may be cut at its end:
+                    # the next window starts a little earlier, and the tokens of the overlap are merged
+                    seek += N_FRAMES - OVERLAP_FRAMES
+                    overlap_until = float(stop * HOP_LENGTH / SAMPLE_RATE)
+                    overlap_tokens = tokens[-OVERLAP_TOKENS:].tolist()
+                else:
+                    seek += N_FRAMES
+
+            if seek <= previous_seek:
+                seek = previous_seek + N_FRAMES    # a window ending with the timestamp 0, it must not be decoded again
+            all_tokens.extend(kept_tokens.tolist())
+            transcript.push(kept_tokens)
 
             if not condition_on_previous_text or result.temperature > 0.5:
                 # do not feed the prompt tokens if a high temperature was used
                 prompt_reset_since = len(all_tokens)
+    finally:
+        encoder_stage.shutdown(cancel_futures=True)
+        audio_chunks.close()
+
+    transcript.flush()
+    audio_duration = frontend.n_frames * HOP_LENGTH / SAMPLE_RATE
+    return dict(text=transcript.text, segments=all_segments, language=language, 
+                audio_duration=audio_duration, encoder_time=encoder_time, decoder_time=decoder_time,
+                windows=n_windows, skipped_windows=skipped_windows, vad_skip_ratio=skipped_windows / max(n_windows, 1),
+                encoder_guesses=n_guesses, encoder_guess_hits=guess_hits, guess_hit_rate=guess_hits / max(n_guesses, 1))
+
+
+def expand_audio_paths(pattern: str) -> List[str]:
+    """The audio files of a directory, or the files matching a glob pattern, in sorted order"""
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern) if not name.startswith(".")]
+    else:
+        paths = glob.glob(pattern, recursive=True)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def write_result(result: dict, audio_path: str, output_dir: str) -> str:
+    """Saves the transcript of `audio_path` as txt, srt, vtt and json files in `output_dir`, returns their base path"""
+    base_path = os.path.join(output_dir, os.path.basename(audio_path))
+    with open(base_path + ".txt", "w", encoding="utf-8") as wf:
+        write_txt(result["segments"], file=wf)
+    with open(base_path + ".srt", "w", encoding="utf-8") as wf:
+        write_srt(result["segments"], file=wf)
+    with open(base_path + ".vtt", "w", encoding="utf-8") as wf:
+        write_vtt(result["segments"], file=wf)
+    with open(base_path + ".json", "w", encoding="utf-8") as wf:
+        # the token ids and decoding statistics may be NumPy scalars
+        json.dump(result, wf, ensure_ascii=False, default=lambda value: value.item() if isinstance(value, np.generic) else value.tolist())
+    return base_path
+
+
+_worker_model: Optional["Whisper"] = None     # the model of a batch worker process
+
+
+def _init_batch_worker(model_args: tuple, intra_op_num_threads: int):
+    global _worker_model
+    _worker_model = load_model(*model_args, intra_op_num_threads=intra_op_num_threads)
 
-            # update progress bar
-            # pbar.update(min(num_frames, seek) - previous_seek_value)
-            previous_seek_value = seek
 
-    return dict(text=tokenizer.decode(all_tokens[len(initial_prompt):]), segments=all_segments, language=language, 
-                audio_duration=audio_duration, encoder_time=encoder_time, decoder_time=decoder_time)
+def _transcribe_in_worker(audio: np.ndarray, transcribe_options: dict) -> Tuple[dict, float]:
+    start_time = time.perf_counter()
+    result = transcribe(model=_worker_model, audio=audio, **transcribe_options)
+    return result, time.perf_counter() - start_time
+
+
+def transcribe_batch(
+    audio_paths: List[str],
+    output_dir: str,
+    model_args: tuple,
+    workers: int = 1,
+    prefetch: Optional[int] = None,
+    **transcribe_options,
+) -> dict:
+    """
+    Transcribe many audio files in parallel, each result is saved by `write_result` as soon as it is done
+
+    Parameters
+    ----------
+    audio_paths: List[str]
+        The audio files to transcribe
+
+    output_dir: str
+        The directory to save the outputs
+
+    model_args: tuple
+        The arguments of `load_model` which each worker process loads its model with
+
+    workers: int
+        The number of worker processes, the physical cores are split between their ONNX Runtime sessions
+
+    prefetch: int
+        How many files are decoded by ffmpeg ahead of the workers, `workers` by default
+
+    transcribe_options: dict
+        Keyword arguments of `transcribe`
+
+    Returns
+    -------
+    A dictionary with the number of files transcribed ("files") and failed ("failed"), the total audio
+    duration ("audio_duration") and wall-clock time ("wall_time") in seconds, and their ratio ("throughput"),
+    the hours of audio transcribed per hour; "vad_skip_ratio" is the share of the windows of all the files
+    which the speech detector skipped.
+    """
+    assert isinstance(workers, int) and workers > 0, "The number of workers must be a positive integer"
+    prefetch = prefetch or workers
+    intra_op_num_threads = max(1, (psutil.cpu_count(logical=False) or 1) // workers)
+
+    paths = iter(audio_paths)
+    loading = deque()   # the files being decoded by ffmpeg, in order
+    running = {}        # the transcriptions by future, with their file and audio duration
+    files, failed, total_audio_duration = 0, 0, 0.0
+    windows, skipped_windows = 0, 0
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="ffmpeg") as loader, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(model_args, intra_op_num_threads)) as pool:
+
+        def load_next():
+            path = next(paths, None)
+            if path is not None:
+                loading.append((path, loader.submit(load_audio, path)))
+
+        for _ in range(prefetch):
+            load_next()
+        while loading or running:
+            # hand the decoded audio over, and wait for the decoding only when a worker would be idle;
+            # at most one file per worker is queued in the pool, so the audio held in memory stays bounded
+            while loading and len(running) < 2 * workers and (loading[0][1].done() or len(running) < workers):
+                path, loaded = loading.popleft()
+                load_next()
+                try:
+                    audio = loaded.result()
+                except RuntimeError as e:
+                    failed += 1
+                    print(f"{Color.RED}ERROR:{Color.RESET} {path}: {e}")
+                    continue
+                running[pool.submit(_transcribe_in_worker, audio, transcribe_options)] = (path, len(audio) / SAMPLE_RATE)
+                del audio
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, audio_duration = running.pop(future)
+                try:
+                    result, pred_duration = future.result()
+                    base_path = write_result(result, path, output_dir)
+                except Exception as e:
+                    failed += 1
+                    print(f"{Color.RED}ERROR:{Color.RESET} {path}: {e!r}")
+                    continue
+                files += 1
+                total_audio_duration += audio_duration
+                windows += result["windows"]
+                skipped_windows += result["skipped_windows"]
+                print(f"[Info] {path}: Real time factor: {round(pred_duration / max(audio_duration, 1e-6), 3)}, "
+                      f"Audio duration: {round(audio_duration, 2)}s, saved into {base_path}.{{txt,srt,vtt,json}}")
+    wall_time = time.perf_counter() - start_time
+
+    return dict(files=files, failed=failed, audio_duration=total_audio_duration, wall_time=wall_time,
+                throughput=total_audio_duration / wall_time, vad_skip_ratio=skipped_windows / max(windows, 1))
+
 
 def cli():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -303,8 +581,11 @@ def cli():
             raise argparse.ArgumentTypeError(f"{value} must be greater than or equal to 0.")
         return ivalue
     parser.add_argument("--audio", nargs="*", type=str, help="Specify the path to at least one or more audio files (wav, mp4, mp3, etc.). e.g. --audio aaa.mp4 bbb.mp3 ccc.mp4")
+    parser.add_argument("--batch", type=str, default=None, help="transcribe every audio file of a directory, or matching a glob pattern, in parallel, and save txt, srt, vtt and json outputs for each. e.g. --batch recordings/ or --batch \"recordings/**/*.mp3\"")
+    parser.add_argument("--workers", type=check_range, default=None, help="worker processes of --batch, each with its own model; the physical cores are split between them, half of the physical cores if not set")
     parser.add_argument("--output_dir", "-o", type=str, default=".", help="directory to save the outputs")
     parser.add_argument("--target",  type=str, default="cpu-aie", choices=["aie-cpu", "cpu-aie", "aie-aie"], help="which target to run encoder and decoder models")
+    parser.add_argument("--vad", type=str, default="energy", help="speech detector run on the log-Mel frames of each window before the encoder, the windows without speech are skipped: \"energy\", the path to an ONNX VAD model, or \"none\" to encode every window")
     parser.add_argument("--librispeech",  type=str, default=None, help="test WER of LibriSpeech dataset if you set path of LibriSpeech dataset.")
     parser.add_argument("--test_num",  type=check_range, default=0, help="dataset samples count to calculate WER, 0 means whole dataset.")
 
@@ -328,12 +609,15 @@ def cli():
     args["compression_ratio_threshold"] = 2.4
     args["logprob_threshold"] = -1
     args["no_speech_threshold"] = 0.6
+    args["speech_detector"] = args.pop("vad")
 
     mode: str = args.pop("mode")
     model_name: str = args.pop("model")
     output_dir: str = args.pop("output_dir")
     target: str = args.pop("target")
     test_num: int = args.pop("test_num")
+    batch: Optional[str] = args.pop("batch")
+    workers: Optional[int] = args.pop("workers")
 
     os.makedirs(output_dir, exist_ok=True)
 
@@ -363,6 +647,31 @@ def cli():
     else:
         temperature = [temperature]
 
+    if batch:
+        audio_paths = expand_audio_paths(batch)
+        if not audio_paths:
+            print(f"{Color.RED}ERROR:{Color.RESET} No audio file matches {batch}")
+            sys.exit(0)
+        workers = min(workers or max(1, (psutil.cpu_count(logical=False) or 1) // 2), len(audio_paths))
+        for key in ("audio", "librispeech"):
+            args.pop(key)
+        print(f"[Info] Transcribing {len(audio_paths)} files with {workers} workers...")
+        summary = transcribe_batch(
+            audio_paths,
+            output_dir,
+            (model_name, onnx_encoder_path, onnx_decoder_path, encoder_target, decoder_target),
+            workers=workers,
+            temperature=temperature,
+            **args,
+        )
+        print('---------------------result----------------------')
+        print(f"Transcribed files: {summary['files']}, Failed files: {summary['failed']}")
+        print(f"Audio duration: {round(summary['audio_duration'], 2)}s, Wall time: {round(summary['wall_time'], 2)}s")
+        print(f"Throughput: {round(summary['throughput'], 2)} audio hours per hour")
+        print(f"Windows skipped by the speech detector: {round(100 * summary['vad_skip_ratio'], 1)}%")
+        print('-------------------------------------------------')
+        return
+
     model = load_model(model_name, onnx_encoder_path, onnx_decoder_path, encoder_target, decoder_target)
     librispeech = args.pop("librispeech", None)
     pid = os.getpid()
@@ -392,24 +701,26 @@ def cli():
                 pred_duration = end_time - start_time
                 other_process_time = round((pred_duration - encoder_time - decoder_time), 2)
                 real_time_factor = round(pred_duration/audio_duration, 3)
-                if audio_duration > 10.24:
-                    print(f"{Color.RED}[Warning]:{Color.RESET} The audio duration more than 10.24 seconds, the part which after 10.24 seconds maybe decoded not well.")
                 print('---------------------result----------------------')
                 print("Prediction Result: ", result['text'])
                 print(f"Encoder running time: {encoder_time}s, Decoder running time: {decoder_time}s, Other process time: {other_process_time}s")
+                print(f"Windows encoded ahead: {result['encoder_guesses']}, guess hit rate: {round(100 * result['guess_hit_rate'], 1)}%")
                 print(f"Real time factor: {real_time_factor}, Audio duration: {audio_duration}s, Decoding time: {round(pred_duration, 2)}s")
+                print(f"Windows skipped by the speech detector: {result['skipped_windows']}/{result['windows']} ({round(100 * result['vad_skip_ratio'], 1)}%)")
                 print('-------------------------------------------------')
-            
-            audio_basename = os.path.basename(audio_path)
 
-            # save text result
-            with open(os.path.join(output_dir, audio_basename + ".txt"), "w", encoding="utf-8") as wf:
-                wf.write(f"Audio file name: {audio_basename}\n")
-                wf.write(f"Prediction: {result['text']}\n")
-                wf.write(f"Encoder running time: {encoder_time}s, Decoder running time: {decoder_time}s, Other process time: {other_process_time}s\n")
-                wf.write(f"Real time factor: {real_time_factor}, Audio duration: {audio_duration}s, Decoding time: {round(pred_duration, 2)}s\n")
+                audio_basename = os.path.basename(audio_path)
+
+                # save text result
+                with open(os.path.join(output_dir, audio_basename + ".txt"), "w", encoding="utf-8") as wf:
+                    wf.write(f"Audio file name: {audio_basename}\n")
+                    wf.write(f"Prediction: {result['text']}\n")
+                    wf.write(f"Encoder running time: {encoder_time}s, Decoder running time: {decoder_time}s, Other process time: {other_process_time}s\n")
+                    wf.write(f"Windows encoded ahead: {result['encoder_guesses']}, guess hit rate: {round(100 * result['guess_hit_rate'], 1)}%\n")
+                    wf.write(f"Real time factor: {real_time_factor}, Audio duration: {audio_duration}s, Decoding time: {round(pred_duration, 2)}s\n")
+                    wf.write(f"Windows skipped by the speech detector: {result['skipped_windows']}/{result['windows']}\n")
 
-            print(f"[Info] Save the transcribe result into {os.path.join(output_dir, audio_basename)}.txt successfully.")
+                print(f"[Info] Save the transcribe result into {os.path.join(output_dir, audio_basename)}.txt successfully.")
     
     if librispeech:
         with open(librispeech, 'r') as f:
@@ -430,6 +741,8 @@ def cli():
         total_encoder_running_time = 0
         total_decoder_running_time = 0
         total_other_process_time = 0
+        total_windows, total_skipped_windows = 0, 0
+        total_guesses, total_guess_hits = 0, 0
         
         # Becasue we fix input length to 1024, we make some filter of the input wavs
         metainfo = [info for info in metainfo if info["original_duration"] <= 10]
@@ -472,6 +785,10 @@ def cli():
             total_encoder_running_time += encoder_time
             total_decoder_running_time += decoder_time
             total_other_process_time += other_process_time
+            total_windows += result["windows"]
+            total_skipped_windows += result["skipped_windows"]
+            total_guesses += result["encoder_guesses"]
+            total_guess_hits += result["encoder_guess_hits"]
             rtf = round(pred_duration/audio_duration, 3)
             rtf_ls.append(rtf)
             
@@ -518,8 +835,10 @@ def cli():
                                         "RTF 90%": rtf_90, "RTF 99%": rtf_99, 
                                         "total decoding time": str(total_decoding_time)+"s",
                                         "total encoder running time": str(total_encoder_running_time)+"s",
+                                        "encoder guess hit rate": round(total_guess_hits / max(total_guesses, 1), 4),
                                         "total decoder running time": str(total_decoder_running_time)+"s",
-                                        "total other process time": str(total_other_process_time)+"s"}
+                                        "total other process time": str(total_other_process_time)+"s",
+                                        "VAD skip ratio": round(total_skipped_windows / max(total_windows, 1), 4)}
         
         final_results.insert(0, final_result)
         with open(save_json_path, "w") as wf:
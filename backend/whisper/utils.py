@@ -3,7 +3,11 @@ import psutil
 import multiprocessing
 import numpy as np
 import os
-from typing import Iterator, TextIO
+import queue
+import threading
+from typing import Iterable, Iterator, TextIO, TypeVar
+
+T = TypeVar("T")
 
 
 class DisplayCPU(multiprocessing.Process):
@@ -37,6 +41,53 @@ class DisplayCPU(multiprocessing.Process):
         # print("DisplayCPU exit successfully.")
 
 
+def prefetch(iterable: Iterable[T], size: int = 2) -> Iterator[T]:
+    """
+    Iterates `iterable` on a background thread, which runs up to `size` items ahead of the consumer.
+    An exception raised by `iterable` is raised by the consumer when it reaches it, and closing the
+    returned iterator stops the thread and closes `iterable`.
+    """
+    items: queue.Queue = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
 def exact_div(x, y):
     assert x % y == 0
     return x // y
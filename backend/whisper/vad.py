@@ -0,0 +1,225 @@
+from functools import lru_cache
+from typing import Any, Optional, Tuple, Union
+
+import numpy as np
+import onnxruntime as ort
+
+from whisper.audio import HOP_LENGTH, N_FFT, N_MELS, SAMPLE_RATE, hann_window, mel_filters
+
+
+class SpeechDetector:
+    """
+    Decides from its log-Mel frames whether a window of audio has speech, before it is encoded.
+
+    A detector is given the log10 Mel frames of `log_mel_frames` (see `IncrementalLogMel.log_mel(normalize=False)`).
+    Detecting speech does not change the detector, so a window may be looked at ahead of time or more than once;
+    a detector which follows the stream is moved past a window by `commit()`, with the state `detect()` returned,
+    once the window is consumed. `reset()` starts a new stream. Subclasses implement `speech_frames()`.
+    """
+
+    def __init__(self, min_speech_duration: float = 0.2):
+        """
+        Parameters
+        ----------
+        min_speech_duration: float
+            The seconds of speech frames a window needs to be encoded
+        """
+        self.min_speech_frames = max(1, int(round(min_speech_duration * SAMPLE_RATE / HOP_LENGTH)))
+
+    def reset(self):
+        """Starts a new stream"""
+
+    def speech_frames(self, log_spec: np.ndarray) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        log_spec: np.ndarray, shape = (n_mels, n_frames)
+            The log10 Mel frames of the window, without the padding
+
+        Returns
+        -------
+        np.ndarray, shape = (n_frames,)
+            Whether each frame is speech
+        """
+        raise NotImplementedError
+
+    def has_speech(self, log_spec: np.ndarray) -> bool:
+        return np.count_nonzero(self.speech_frames(log_spec)) >= self.min_speech_frames
+
+    def detect(self, log_spec: np.ndarray) -> Tuple[bool, Any]:
+        """Whether the window has speech, and the state of the stream after it, for `commit()`"""
+        return self.has_speech(log_spec), None
+
+    def commit(self, state: Any):
+        """Moves the stream past a window which was consumed, given the state `detect()` returned for it"""
+
+
+@lru_cache(maxsize=None)
+def speech_band(low: float, high: float, n_mels: int = N_MELS) -> Tuple[slice, float]:
+    """
+    The Mel filters whose peak is in [low, high] Hz, and the power they give to white noise of unit variance,
+    which scales the band power of a frame into the mean square of the samples
+    """
+    filters = mel_filters(n_mels)
+    peaks = np.argmax(filters, axis=1) * SAMPLE_RATE / N_FFT
+    rows = np.flatnonzero((peaks >= low) & (peaks <= high))
+    band = slice(rows[0], rows[-1] + 1)
+    # each bin of the STFT of white noise has the expected power sum(window ** 2)
+    window = hann_window(N_FFT)
+    unit_power = float(np.dot(window, window)) * float(filters[band].sum())
+    return band, unit_power
+
+
+class EnergySpeechDetector(SpeechDetector):
+    """
+    A statistical detector: a frame is speech if its level in the speech band is above an absolute threshold,
+    and far enough above the noise floor of the stream.
+
+    The level is the mean square, in dBFS, of white noise with the same power in the band, so -20 dB is
+    about the level of speech recorded at a normal gain. The noise floor is a low percentile of the levels
+    of each window; it follows a quieter window at once, and a louder one by at most `floor_rise_db` per
+    window, so the constant level of continuous music or noise becomes the floor, while speech stays above it.
+    """
+
+    def __init__(
+        self,
+        threshold_db: float = -50.0,
+        margin_db: float = 10.0,
+        band: Tuple[float, float] = (250.0, 4000.0),
+        noise_percentile: float = 10.0,
+        floor_rise_db: float = 3.0,
+        min_speech_duration: float = 0.2,
+    ):
+        """
+        Parameters
+        ----------
+        threshold_db: float
+            The level in dBFS below which a frame is never speech
+
+        margin_db: float
+            How far above the noise floor a speech frame is, in dB
+
+        band: Tuple[float, float]
+            The frequencies of speech in Hz, the Mel filters outside are ignored (hum, hiss)
+
+        noise_percentile: float
+            The percentile of the levels of a window which estimates its noise floor
+
+        floor_rise_db: float
+            How much the noise floor may rise per window, in dB
+
+        min_speech_duration: float
+            The seconds of speech frames a window needs to be encoded
+        """
+        super().__init__(min_speech_duration)
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.band = band
+        self.noise_percentile = noise_percentile
+        self.floor_rise_db = floor_rise_db
+        self.reset()
+
+    def reset(self):
+        self.noise_floor_db: Optional[float] = None
+
+    def level(self, log_spec: np.ndarray) -> np.ndarray:
+        """The level in dBFS of each frame, in the speech band"""
+        band, unit_power = speech_band(*self.band, n_mels=log_spec.shape[0])
+        power = np.power(np.float32(10), log_spec[band]).sum(axis=0)
+        return 10 * np.log10(np.maximum(power / unit_power, 1e-20))
+
+    def noise_floor(self, level: np.ndarray) -> Optional[float]:
+        """The noise floor of the stream after a window with the frame levels `level`"""
+        if len(level) == 0:
+            return self.noise_floor_db
+        floor = float(np.percentile(level, self.noise_percentile))
+        if self.noise_floor_db is not None:
+            floor = min(floor, self.noise_floor_db + self.floor_rise_db)
+        return floor
+
+    def _speech_frames(self, level: np.ndarray, floor: Optional[float]) -> np.ndarray:
+        if floor is None:
+            return np.zeros(len(level), dtype=bool)
+        return (level > self.threshold_db) & (level > floor + self.margin_db)
+
+    def speech_frames(self, log_spec: np.ndarray) -> np.ndarray:
+        level = self.level(log_spec)
+        return self._speech_frames(level, self.noise_floor(level))
+
+    def detect(self, log_spec: np.ndarray) -> Tuple[bool, Optional[float]]:
+        level = self.level(log_spec)
+        floor = self.noise_floor(level)
+        return np.count_nonzero(self._speech_frames(level, floor)) >= self.min_speech_frames, floor
+
+    def commit(self, state: Optional[float]):
+        self.noise_floor_db = state
+
+
+@lru_cache(maxsize=None)
+def _vad_session(model_path: str):
+    # one session per model, shared by the detectors: `InferenceSession.run` is safe to call from several threads
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = 1
+    return ort.InferenceSession(model_path, providers=["CPUExecutionProvider"], sess_options=sess_options)
+
+
+class OnnxSpeechDetector(SpeechDetector):
+    """
+    A small neural detector, run by ONNX Runtime on the CPU.
+
+    The model takes the log-Mel frames of a window, shape (1, n_mels, n_frames), and returns the probability
+    of speech, shape (1, n) for any n: per frame, or per group of frames (n_frames / n frames each), or of
+    the whole window (n = 1).
+    """
+
+    def __init__(self, model_path: str, threshold: float = 0.5, normalize: bool = True, min_speech_duration: float = 0.2):
+        """
+        Parameters
+        ----------
+        model_path: str
+            The path to the ONNX model
+
+        threshold: float
+            The probability above which a frame is speech
+
+        normalize: bool
+            Whether the model takes the frames normalized like Whisper's input, or their log10 as they are
+
+        min_speech_duration: float
+            The seconds of speech frames a window needs to be encoded
+        """
+        super().__init__(min_speech_duration)
+        self.sess = _vad_session(model_path)
+        self.input_name = self.sess.get_inputs()[0].name
+        self.threshold = threshold
+        self.normalize = normalize
+
+    def speech_frames(self, log_spec: np.ndarray) -> np.ndarray:
+        n_frames = log_spec.shape[1]
+        if n_frames == 0:
+            return np.zeros(0, dtype=bool)
+        features = np.array(log_spec, dtype=np.float32)
+        if self.normalize:
+            np.maximum(features, features.max() - 8.0, out=features)
+            features += 4.0
+            features /= 4.0
+        probs = np.asarray(self.sess.run(None, {self.input_name: features[np.newaxis]})[0]).reshape(-1)
+        return probs[np.arange(n_frames) * len(probs) // n_frames] > self.threshold
+
+
+def load_speech_detector(detector: Union[str, SpeechDetector, None]) -> Optional[SpeechDetector]:
+    """
+    A new detector for "energy" (`EnergySpeechDetector`) or the path to an ONNX model (`OnnxSpeechDetector`),
+    None for None or "none"; a `SpeechDetector` is reset and returned
+    """
+    if detector is None or isinstance(detector, SpeechDetector):
+        if detector is not None:
+            detector.reset()
+        return detector
+    if detector == "none":
+        return None
+    if detector == "energy":
+        return EnergySpeechDetector()
+    if detector.endswith(".onnx"):
+        return OnnxSpeechDetector(detector)
+    raise ValueError(f"Unknown speech detector: {detector}, expected 'energy', 'none' or the path to an ONNX model")
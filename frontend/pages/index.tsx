@@ -40,6 +40,7 @@ export default function Home() {
   const [downloadButtonActive, setDownloadButtonActive] = useState(false);
   const [wsConnected, setWsConnected] = useState(false);
   const wsRef = useRef<WebSocket | null>(null);
+  const pendingLineRef = useRef("");   // the line which is not complete yet
 
   // useEffect(() => {
   //   if (typeof window !== 'undefined' && localStorage.getItem("settings") !== null) {
@@ -55,34 +56,47 @@ export default function Home() {
       console.log("Websocket already connected");
       return;
     }
-    const ws = new WebSocket("ws://localhost:6789/transcription_feed");
+    // Protocol version 3: the current line is sent as edits of its previous revision
+    const ws = new WebSocket("ws://localhost:6789/transcription_feed?version=3", "json");
+    let lastSeq = -1;
+    let segmentId = -1;
+    let segmentText = "";
     ws.onopen = function(e) {
       console.log("Connected to server");
       setDownloadButtonActive(false);
     };
     ws.onmessage = function(event) {
       // console.log(event.data);
-      if (event.data === "[PHRASE_COMPLETE]") {
-        console.log("Phrase Acknowledged");
-        // setTranscription(prevTranscription => {
-        //   const updatedTranscription = [...prevTranscription, phrase];
-        //   console.log("Updated Transcription" + updatedTranscription); // Log the updated transcription
-        //   return updatedTranscription;
-        // });
+      const message = JSON.parse(event.data);
+      if (message.type === "ping") {
+        ws.send(JSON.stringify({ type: "pong", id: message.id }));
+        return;
+      }
+      if (message.seq !== lastSeq + 1) {
+        console.log("Missed " + (message.seq - lastSeq - 1) + " transcription updates");
+      }
+      lastSeq = message.seq;
 
-      } else {
-        // Note: This is supposed to be run when the phrase is complete.
-        // However, there is a bug in the backend which only acknowledges that the phrase is complete sometimes.
-        // Therefore, this is run every time a new transcription is received.
-        // #TODO: Remove this when the backend is fixed.
-        setPhrase(event.data);
-        setTranscription(prevTranscription => {
-          const newTranscription = prevTranscription + "\n" + event.data;
-          console.log("New Transcription: " + newTranscription);
-          return newTranscription;
-        });
+      if (message.type === "segment") {
+        if (message.id !== segmentId) {
+          segmentId = message.id;
+          segmentText = "";
+        }
+        segmentText = segmentText.slice(0, message.edit[0]) + message.edit[1];
+        setPhrase(segmentText);
+        if (message.final) {
+          console.log("Phrase Acknowledged");
+          const line = segmentText;
+          pendingLineRef.current = "";
+          setTranscription(prevTranscription => {
+            const newTranscription = prevTranscription + "\n" + line;
+            console.log("New Transcription: " + newTranscription);
+            return newTranscription;
+          });
+        } else {
+          pendingLineRef.current = segmentText;
+        }
       }
-      ws.send("ack");
     };
     wsRef.current = ws;
     setWsConnected(true);
@@ -110,7 +124,8 @@ export default function Home() {
   
   
   function downloadTranscription() {
-    const blob = new Blob([transcription], { type: 'text/plain' });
+    const text = pendingLineRef.current ? transcription + "\n" + pendingLineRef.current : transcription;
+    const blob = new Blob([text], { type: 'text/plain' });
     console.log(transcription);
     const url = URL.createObjectURL(blob);
     const a = document.createElement('a');